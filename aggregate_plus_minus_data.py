@@ -1,196 +1,139 @@
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-import random
-from requests.exceptions import ReadTimeout
-import time
-
-
-def safe_retry(func, *args, retries=3, backoff=5, backoff_factor=2, **kwargs):
-    """
-    Call `func(*args, **kwargs)`, retrying up to `retries` times on ReadTimeout.
-    Sleeps `backoff` seconds before first retry, then multiplies by backoff_factor.
-    """
-    delay = backoff
-    for attempt in range(1, retries+1):
-        try:
-            return func(*args, **kwargs)
-        except (ReadTimeout, ConnectionError) as e:
-            if attempt == retries:
-                raise
-            print(f"{type(e).__name__} on attempt {attempt}/{retries}, retrying in {delay:.0f}s…")
-            time.sleep(delay)
-            delay *= backoff_factor
-
-session = requests.Session()
-
-# Wrap session.request to inject default timeout
-_orig_request = session.request
-def _request_with_timeout(method, url, **kwargs):
-    kwargs.setdefault("timeout", (5, 60))
-    return _orig_request(method, url, **kwargs)
-session.request = _request_with_timeout
-
-# Configure retry strategy
-retry_strategy = Retry(
-    total=5,                       # up to 5 attempts
-    backoff_factor=1,              # 1s → 2s → 4s → 8s → 16s
-    status_forcelist=[429,500,502,503,504],
-    allowed_methods=False
-)
-adapter = HTTPAdapter(max_retries=retry_strategy)
-session.mount("https://", adapter)
-session.mount("http://", adapter)
-
-# 2) Monkey-patch NBA API’s HTTP layer *before* importing any endpoints:
-import nba_api.stats.library.http as http_lib
-http_lib.Session = lambda: session
-
-from nba_api.stats.endpoints import LeagueGameLog
+from nba_api.stats.endpoints import LeagueGameLog, GameRotation, PlayByPlayV3
+from api_cache import install_cache, offline_cache
+from artifact_cache import ArtifactCache, code_version
+from fetch_scheduler import FetchScheduler, TokenBucket, make_session, use_session
+from pipeline import GamePipeline, install_offline_cache
 import pandas as pd
 import numpy as np
 from get_lineups import get_lineups
+from lineup_store import write_part, merge_store, part_name, REGULAR_SEASON
+from checkpoint import Checkpoint, DONE_STATUSES
+from metrics import registry, init_worker
 from label_play_by_play import get_labelled_play_by_play
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import lineup_keys
 from tqdm import tqdm
+import collections
+import functools
+import argparse
+import inspect
+import time
+import re
 import os
 
 
+# Columns of the aggregated lineup data
+columns = ['ID'] + [f'P{i}{loc}' for loc in ['H', 'V'] for i in range(1, 6)] + ['Home_Team_ID', 'Away_Team_ID'] + ['Plus_Off', 'Minus_Def', 'Plus/Minus'] + ['Home_Poss_Off', 'Home_Poss_Def', 'Poss_Tot'] + ['Time']
+player_columns = [f'Player_{i}_{loc}_ID' for loc in ['Home', 'Away'] for i in range(1, 6)]
+team_columns = ['Home_Team_ID', 'Away_Team_ID']
+play_columns = ['scoreHome', 'scoreAway', 'possessionH', 'possessionV', 'possessionCount']
 
-def calculate_diff(series: pd.Series) -> pd.Series:
+# Season type given by the third digit of a game ID
+GAME_ID_SEASON_TYPES = {'1': 'Pre Season', '2': REGULAR_SEASON, '4': 'Playoffs', '5': 'PlayIn'}
+
+
+def prepare_game(game_id: str, lineup: pd.DataFrame, pbp: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
     """
-    Calculate the difference between consecutive elements in a pandas Series.
-    The first element is set to its original value.
+    Sorts the stints and labelled plays of one game for `aggregate_games` and checks that they can be joined.
+
     Parameters
     ----------
-    series : pd.Series
-        The input pandas Series for which to calculate the difference.
+    game_id : str
+        The unique identifier for the NBA game.
+    lineup : pd.DataFrame
+        Stints as returned by get_lineups.
+    pbp : pd.DataFrame
+        Labelled plays as returned by get_labelled_play_by_play.
+
     Returns
     -------
-    pd.Series
-        A new pandas Series containing the differences between consecutive elements.
-    """
-
-    s = series.astype(int)
-    diff = s.diff()
-    diff.iat[0] = s.iat[0]
-    return diff.astype(int)
-
-seasons = ['2022-23']
-directory = 'data'
-
-# Create final output Dataframe
-columns = ['ID'] + [f'P{i}{loc}' for loc in ['H', 'V'] for i in range(1, 6)] + ['Plus_Off', 'Minus_Def', 'Plus/Minus'] + ['Home_Poss_Off', 'Home_Poss_Def', 'Poss_Tot'] + ['Time']
-df = pd.DataFrame(columns=columns)
-columns_to_keep = ['ID'] + [f'Player_{i}_{loc}_ID' for loc in ['Home', 'Away'] for i in range(1, 6)]
-
-problem = 0
-problematic_lineup = 0
-empty_boxscore_df = 0
-nobody_played = 0
-
-# Get game_ids
-for season in seasons:
-    game_log = LeagueGameLog(season=season).get_data_frames()[0]
-
-    game_log = pd.DataFrame(game_log)
-    game_ids = game_log['GAME_ID'].unique()
-
-    # Get data
-    i = 0
-    for game_id in tqdm(game_ids, desc= f"Processing season {season}"):
-        i += 1
-        time.sleep(2)
-
-        try:
-            lineup = safe_retry(get_lineups, game_id=game_id, retries=3, backoff=60*20)
-            if lineup is None:
-                problematic_lineup += 1
-                continue
-        except Exception as e:
-            problem += 1
-            print(f"[Lineups] {game_id} → {e}")
-            continue
-
-        time.sleep(2)
-        try:
-            pbp = safe_retry(get_labelled_play_by_play, game_id=game_id, retries=3, backoff=60*20)
-            if pbp is None:
-                empty_boxscore_df += 1
-                continue
-            if isinstance(pbp, str) and pbp == 'Nobody played':
-                nobody_played += 1
-                continue
-        except Exception as e:
-            problem += 1
-            print(f"[PBP] {game_id} → {e}")
-            continue
-
-        try:
-            pbp = pbp.sort_values(by='time')
-            lineup = lineup.sort_values(by='End_Time')
-
-            # Transform data
-            merged = pd.merge_asof(lineup, pbp, left_on = 'End_Time', right_on= 'time', direction = 'backward')
-
-            merged['scoreHome'] = calculate_diff(merged['scoreHome'])
-            merged['scoreAway'] = calculate_diff(merged['scoreAway'])
-            merged['plusMinus'] = merged['scoreHome'] - merged['scoreAway']
-
-            merged['possessionH'] = calculate_diff(merged['possessionH'])
-            merged['possessionV'] = calculate_diff(merged['possessionV'])
-            merged['possessionCount'] = calculate_diff(merged['possessionCount'])
-
-            # Create output
-            for idx, row in merged.iterrows():
-                id = row['ID']
-
-                time_played = row['End_Time'] - row['Start_Time'] 
-
-                if len(df[df['ID'] == id]) == 0:
-                    initializing_row = [row[col] for col in columns_to_keep] + [0, 0, 0, 0, 0, 0, 0]
-                    init_df_row = pd.DataFrame([initializing_row], columns=df.columns)
-                    if df.empty:
-                        df = init_df_row
-                    else:
-                        df = pd.concat([df, init_df_row], ignore_index=True)
-
-                assert len(df[df['ID'] == id]) == 1, f"Multiple rows with same lineup ID"
-                mask = df['ID'] == id
-                df.loc[mask, 'Plus_Off'] += row['scoreHome']
-                df.loc[mask, 'Minus_Def'] += row['scoreAway']
-                df.loc[mask, 'Plus/Minus'] += row['plusMinus']
-                df.loc[mask, 'Home_Poss_Off'] += row['possessionH']
-                df.loc[mask, 'Home_Poss_Def'] += row['possessionV']
-                df.loc[mask, 'Poss_Tot'] += row['possessionCount']
-                df.loc[mask, 'Time'] += time_played
- 
-        except Exception as e:
-            problem += 1
-            print(f"Error processing game ID {game_id}: {e}")
-            continue
-
-        if i % 100 == 0:
-            part = i // 100
-
-            # Final additions
-            df['Off_Rating'] = df['Plus_Off'] / df['Home_Poss_Off'] * 100
-            df.loc[df['Home_Poss_Off'] == 0, 'Off_Rating'] = np.nan
-            df['Def_Rating'] = df['Minus_Def'] / df['Home_Poss_Def'] * 100
-            df.loc[df['Home_Poss_Def'] == 0, 'Def_Rating'] = np.nan
-            df['Net_Rating'] = df['Off_Rating'] - df['Def_Rating']
-            df['h'] = (df['Home_Poss_Def'] + df['Home_Poss_Off']) / (df['Home_Poss_Def'] * df['Home_Poss_Off'])
-            df['Season'] = season
-
-            # Export
-            os.makedirs(directory, exist_ok=True)
-            filepath = os.path.join(directory, f'data_{season}_{part}.csv')
-            df.to_csv(filepath, index=False)
-
-            # Setup
-            df = pd.DataFrame(columns=columns)
-            time.sleep(10)
-
-    # Final additions
+    lineup, pbp : pd.DataFrame
+        The columns needed for aggregation, sorted by time, with a GAME key column.
+        Scores and possession counts are cast to float (the labelled plays hold them as objects).
+
+    Raises
+    ------
+    ValueError
+        If a stint ends before the first play with a score.
+    """
+
+    # Sorted per game, so plays sharing a time keep the same order as in a game-by-game join
+    pbp = pbp.sort_values(by='time')
+    lineup = lineup.sort_values(by='End_Time')
+
+    # Play each stint is joined to (see merge_asof in aggregate_games)
+    joined = np.searchsorted(pbp['time'].to_numpy(), lineup['End_Time'].to_numpy(), side='right') - 1
+    if (joined < 0).any() or pbp[play_columns].iloc[joined].isna().any(axis=None):
+        raise ValueError("Stint ends before the first scored play")
+
+    lineup = lineup[['ID', 'Start_Time', 'End_Time'] + player_columns + team_columns].assign(GAME=game_id)
+    pbp = pbp[['time'] + play_columns].astype(float).assign(GAME=game_id)
+    return lineup, pbp
+
+
+def aggregate_games(games: list) -> pd.DataFrame:
+    """
+    Joins the stints of many games to the score and possession counts at their end, and sums them per lineup.
+
+    Parameters
+    ----------
+    games : list of tuple
+        (lineup, pbp) pairs as returned by `prepare_game`, in processing order.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per lineup key (see lineup_keys), in order of first appearance, with the columns
+        in `columns`: the players and teams of the lineup, points scored by home and away team, possessions and time played.
+    """
+
+    if not games:
+        return pd.DataFrame(columns=columns)
+
+    lineups = pd.concat([lineup for lineup, _ in games], ignore_index=True)
+    plays = pd.concat([pbp for _, pbp in games], ignore_index=True)
+
+    # merge_asof needs both sides sorted by time; a stable sort keeps the per-game order of ties
+    lineups = lineups.sort_values(by='End_Time', kind='mergesort')
+    plays = plays.sort_values(by='time', kind='mergesort')
+    merged = pd.merge_asof(lineups, plays, left_on='End_Time', right_on='time', by='GAME', direction='backward')
+
+    # Back to processing order
+    merged.index = lineups.index
+    merged = merged.sort_index()
+
+    # Counts are cumulative within a game: take differences between consecutive stints
+    game = merged['GAME']
+    for col in play_columns:
+        s = merged[col].astype(int)
+        merged[col] = s.groupby(game).diff().fillna(s).astype(int)
+    merged['plusMinus'] = merged['scoreHome'] - merged['scoreAway']
+    merged['Time'] = merged['End_Time'] - merged['Start_Time']
+
+    # Sum per lineup
+    aggregations = {f'P{i}{loc}': (f'Player_{i}_{team}_ID', 'first') for team, loc in [('Home', 'H'), ('Away', 'V')] for i in range(1, 6)}
+    aggregations.update({col: (col, 'first') for col in team_columns})
+    aggregations.update({
+        'Plus_Off': ('scoreHome', 'sum'),
+        'Minus_Def': ('scoreAway', 'sum'),
+        'Plus/Minus': ('plusMinus', 'sum'),
+        'Home_Poss_Off': ('possessionH', 'sum'),
+        'Home_Poss_Def': ('possessionV', 'sum'),
+        'Poss_Tot': ('possessionCount', 'sum'),
+        'Time': ('Time', 'sum'),
+    })
+    df = merged.groupby('ID', sort=False).agg(**aggregations).reset_index()
+    if (df['Time'] % 1 == 0).all():
+        df['Time'] = df['Time'].astype(int)
+
+    return df[columns]
+
+
+def add_ratings(df: pd.DataFrame, season: str) -> pd.DataFrame:
+    """
+    Adds offensive, defensive and net rating per 100 possessions, the regression weight term h and the season.
+    """
+
     df['Off_Rating'] = df['Plus_Off'] / df['Home_Poss_Off'] * 100
     df.loc[df['Home_Poss_Off'] == 0, 'Off_Rating'] = np.nan
     df['Def_Rating'] = df['Minus_Def'] / df['Home_Poss_Def'] * 100
@@ -198,18 +141,418 @@ for season in seasons:
     df['Net_Rating'] = df['Off_Rating'] - df['Def_Rating']
     df['h'] = (df['Home_Poss_Def'] + df['Home_Poss_Off']) / (df['Home_Poss_Def'] * df['Home_Poss_Off'])
     df['Season'] = season
+    return df
+
+
+@functools.cache
+def artifact_versions() -> dict:
+    """
+    Code version of every stage cached by `label_game`, see artifact_cache.code_version.
+    """
+
+    return {
+        'lineups': code_version(inspect.getmodule(get_lineups), lineup_keys),
+        'pbp': code_version(inspect.getmodule(get_labelled_play_by_play)),
+        # prepare_game also reads the column lists, which are not part of its source
+        'prepared': code_version(prepare_game, player_columns, team_columns, play_columns),
+    }
+
+
+def label_game(game_id: str, artifacts: ArtifactCache = None) -> dict:
+    """
+    Reconstructs the lineups and labels the plays of a fetched game. Runs in the worker processes
+    of the pipeline, so it only reads the response cache and leaves the checkpoint to the caller.
+
+    With `artifacts`, the outputs of get_lineups, get_labelled_play_by_play and prepare_game are
+    read from the artifact cache when neither their code nor their raw responses changed, and
+    stored there otherwise.
+
+    Parameters
+    ----------
+    game_id : str
+        The unique identifier for the NBA game.
+    artifacts : ArtifactCache, optional
+        Cache of the per-game stage outputs. Default is None (compute every stage).
+
+    Returns
+    -------
+    result : dict
+        - status : 'labelled', 'skipped' or 'failed'.
+        - stage  : stage a game was skipped or failed at ('lineups', 'pbp' or 'prepare'), else None.
+        - reason : why it was skipped or failed, else None.
+        - lineup, pbp : prepared stints and plays (see `prepare_game`) of a labelled game, else None.
+    """
+
+    def outcome(status, stage=None, reason=None, lineup=None, pbp=None):
+        return {'status': status, 'stage': stage, 'reason': reason, 'lineup': lineup, 'pbp': pbp}
+
+    def run_stage(stage, compute, endpoints=(), upstream=()):
+        if artifacts is None:
+            return compute(), None
+        return artifacts.run(stage, game_id, compute, artifact_versions()[stage], endpoints, upstream)
+
+    # All responses of the game are cached at this point
+    try:
+        lineup, lineup_key = run_stage('lineups', lambda: get_lineups(game_id=game_id), endpoints=(GameRotation,))
+        if lineup is None or not lineup['Valid'].all():
+            return outcome('skipped', 'lineups', 'Problematic lineup')
+    except Exception as e:
+        print(f"[Lineups] {game_id} → {e}")
+        return outcome('failed', 'lineups', str(e))
+
+    try:
+        pbp, pbp_key = run_stage('pbp', lambda: get_labelled_play_by_play(game_id=game_id), endpoints=(PlayByPlayV3,))
+        if pbp is None:
+            return outcome('skipped', 'pbp', 'Empty play-by-play')
+        if isinstance(pbp, str) and pbp == 'Nobody played':
+            return outcome('skipped', 'pbp', 'Nobody played')
+    except Exception as e:
+        print(f"[PBP] {game_id} → {e}")
+        return outcome('failed', 'pbp', str(e))
+
+    try:
+        with registry.timed('prepare', game_id):
+            lineup, pbp = run_stage('prepared', lambda: prepare_game(game_id, lineup, pbp), upstream=(lineup_key, pbp_key))[0]
+    except Exception as e:
+        print(f"Error processing game ID {game_id}: {e}")
+        return outcome('failed', 'prepare', str(e))
+
+    return outcome('labelled', lineup=lineup, pbp=pbp)
+
+
+def record_game(game_id: str, result: dict, checkpoint: Checkpoint) -> None:
+    """
+    Records the outcome of `label_game` in the checkpoint, with the prepared data of a labelled game.
+    """
+
+    registry.increment('games_total', status=result['status'])
+    with registry.timed('checkpoint', game_id):
+        if result['status'] == 'labelled':
+            checkpoint.save_game(game_id, result['lineup'], result['pbp'])
+        else:
+            checkpoint.mark(game_id, result['status'], stage=result['stage'], reason=result['reason'])
+
+
+def export_part(directory: str, season: str, part: int, game_ids: list, checkpoint: Checkpoint, season_type: str = REGULAR_SEASON) -> int:
+    """
+    Aggregates the labelled games of a part from the checkpoint, writes the part to the lineup
+    store and marks its games as aggregated. Parts without any labelled game are not written.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the lineup store.
+    season : str
+        Season of the part.
+    part : int
+        Number of the part within the season.
+    game_ids : list of str
+        All games of the part, in game log order.
+    checkpoint : Checkpoint
+        Checkpoint of the part.
+    season_type : str, optional
+        Season type of the part. Default is 'Regular Season'.
+
+    Returns
+    -------
+    rows : int
+        Number of lineups written.
+    """
+
+    labelled = [game_id for game_id in game_ids if checkpoint.status(game_id) in ('labelled', 'aggregated')]
+    if not labelled:
+        return 0
+
+    with registry.timed('aggregation'):
+        df = add_ratings(aggregate_games([checkpoint.load_game(game_id) for game_id in labelled]), season)
+        write_part(directory, season, part, df, game_ids=labelled, season_type=season_type)
+    registry.increment('rows_total', len(df), stage='aggregation')
+    checkpoint.mark(labelled, 'aggregated')
+    return len(df)
+
+
+def season_range(spec: str) -> list:
+    """
+    Expands a season or an inclusive range of seasons, e.g. '2022-23:2024-25', into a list of seasons.
+    """
+
+    bounds = spec.split(':')
+    years = []
+    for season in bounds:
+        match = re.fullmatch(r'(\d{4})-(\d{2})', season)
+        if len(bounds) > 2 or match is None or (int(match.group(1)) + 1) % 100 != int(match.group(2)):
+            raise ValueError(f"Invalid season range {spec}, expected e.g. 2022-23 or 2022-23:2024-25")
+        years.append(int(match.group(1)))
+    return [f'{year}-{(year + 1) % 100:02d}' for year in range(years[0], years[-1] + 1)]
+
+
+def season_of_game(game_id: str) -> tuple[str, str]:
+    """
+    Reads the season and season type of a game from its ID: '0022200001' is a game of the
+    2022-23 regular season.
+    """
+
+    game_id = str(game_id).zfill(10)
+    if game_id[2] not in GAME_ID_SEASON_TYPES:
+        raise ValueError(f"Unknown season type in game ID {game_id}")
+    year = 2000 + int(game_id[3:5]) if int(game_id[3:5]) < 46 else 1900 + int(game_id[3:5])
+    return f'{year}-{(year + 1) % 100:02d}', GAME_ID_SEASON_TYPES[game_id[2]]
+
+
+def plan_shards(seasons, season_types, game_ids=None, games_per_part: int = 100) -> list:
+    """
+    Splits a backfill into shards, one per part of the lineup store: a batch of `games_per_part`
+    consecutive games of the game log of a season and season type. Parts are fixed batches of the
+    game log, so a shard always covers the same games whichever games are requested.
+
+    Parameters
+    ----------
+    seasons : list of str
+        Seasons to backfill. Ignored if `game_ids` is given.
+    season_types : list of str
+        Season types to backfill, e.g. ['Regular Season', 'Playoffs']. Ignored if `game_ids` is given.
+    game_ids : list of str, optional
+        Backfill only these games; their seasons and season types are read from the IDs.
+    games_per_part : int, optional
+        Games per part. Default is 100.
+
+    Returns
+    -------
+    shards : list of dict
+        - season, season_type, part : the part of the lineup store written by the shard.
+        - game_ids : all games of the part, in game log order.
+        - todo     : games of the part to process.
+    """
+
+    if game_ids is not None:
+        game_ids = {str(game_id).zfill(10) for game_id in game_ids}
+        runs = sorted({season_of_game(game_id) for game_id in game_ids})
+    else:
+        runs = [(season, season_type) for season in seasons for season_type in season_types]
+
+    shards = []
+    for season, season_type in runs:
+        game_log = LeagueGameLog(season=season, season_type_all_star=season_type).get_data_frames()[0]
+        season_game_ids = list(game_log['GAME_ID'].unique())
+        if game_ids is not None:
+            for game_id in sorted(game_ids - set(season_game_ids)):
+                if season_of_game(game_id) == (season, season_type):
+                    print(f"[Plan] {game_id} is not in the {season} {season_type} game log")
+
+        for start in range(0, len(season_game_ids), games_per_part):
+            part_game_ids = season_game_ids[start:start + games_per_part]
+            todo = part_game_ids if game_ids is None else [game_id for game_id in part_game_ids if game_id in game_ids]
+            if todo:
+                shards.append({
+                    'season': season,
+                    'season_type': season_type,
+                    'part': start // games_per_part + 1,
+                    'game_ids': part_game_ids,
+                    'todo': todo,
+                })
+    return shards
+
+
+def run_shard(shard: dict, options: dict) -> dict:
+    """
+    Processes the games of one shard (see `plan_shards`) and writes its part to a staging store
+    in the shard's checkpoint directory, to be merged into the lineup store by the caller.
+    Runs in a worker process of `backfill`: it sets up its own connections, response cache,
+    rate limit and pipeline.
+
+    Parameters
+    ----------
+    shard : dict
+        Shard as returned by `plan_shards`.
+    options : dict
+        Keys cache_directory, checkpoint_directory, offline, resume, max_in_flight,
+        request_rate (of this shard), workers and queue_size, see `backfill`.
+
+    Returns
+    -------
+    report : dict
+        - shard   : the shard.
+        - staging : directory of the staging store.
+        - games   : number of games processed.
+        - rows    : number of lineups written (0 if the part was up to date).
+        - seconds : wall time.
+        - counts  : collections.Counter of the checkpoint statuses, see Checkpoint.counts.
+        - metrics : measurements of the shard, see metrics.Metrics.collect.
+    """
+
+    started = time.perf_counter()
+
+    # Pooled keep-alive connections shared by all fetch workers
+    use_session(make_session(pool_size=options['max_in_flight']))
+
+    # Serve repeated requests from the raw response cache, and rate limit the ones that hit the network
+    rate_limit = TokenBucket(rate=options['request_rate'], capacity=options['max_in_flight'])
+    install_cache(options['cache_directory'], offline=options['offline'], refresh_endpoints=('leaguegamelog',), throttle=rate_limit.acquire)
+    scheduler = FetchScheduler(max_in_flight=options['max_in_flight'], retries=3, backoff=60*5)
+
+    # Fetch in threads, label in worker processes reading the cache, aggregate here
+    process = label_game
+    if options.get('artifact_directory'):
+        process = functools.partial(label_game, artifacts=ArtifactCache(options['artifact_directory'], options['cache_directory']))
+    pipeline = GamePipeline(scheduler, process, workers=options['workers'], queue_size=options['queue_size'],
+                            initializer=install_offline_cache, initargs=(options['cache_directory'],),
+                            local_context=functools.partial(offline_cache, options['cache_directory']))
+
+    season, season_type, part = shard['season'], shard['season_type'], shard['part']
+    checkpoint = Checkpoint(options['checkpoint_directory'], os.path.join(season, part_name(part, season_type)))
+    if not options['resume']:
+        checkpoint.reset()
+
+    todo = [game_id for game_id in shard['todo'] if checkpoint.status(game_id) not in DONE_STATUSES]
+    for game_id, fetch_error, result in pipeline.run(todo):
+        if fetch_error is not None:
+            print(f"[Fetch] {game_id} → {fetch_error}")
+            registry.increment('games_total', status='failed')
+            checkpoint.mark(game_id, 'failed', stage='fetch', reason=str(fetch_error))
+        else:
+            record_game(game_id, result, checkpoint)
+
+    # Write the part if any of its games changed since it was last written
+    staging = os.path.join(checkpoint.directory, 'store')
+    rows = 0
+    if any(checkpoint.status(game_id) == 'labelled' for game_id in shard['game_ids']):
+        rows = export_part(staging, season, part, shard['game_ids'], checkpoint, season_type)
+
+    return {
+        'shard': shard,
+        'staging': staging,
+        'games': len(todo),
+        'rows': rows,
+        'seconds': time.perf_counter() - started,
+        'counts': checkpoint.counts(),
+        'metrics': registry.collect(),
+    }
+
+
+def backfill(shards: list, directory: str = 'data', shard_workers: int = 1, **options) -> collections.Counter:
+    """
+    Runs shards (see `plan_shards`) in parallel worker processes and merges every finished shard
+    into the lineup store, reporting its throughput. The store is only written by the calling
+    process, and each shard has its own checkpoint, so shards never write the same file.
+    The measurements of every shard are merged into metrics.registry.
+
+    Parameters
+    ----------
+    shards : list of dict
+        Shards as returned by `plan_shards`.
+    directory : str, optional
+        Directory of the lineup store. Default is 'data'.
+    shard_workers : int, optional
+        Number of shards processed at a time. 0 runs them one by one in the calling process. Default is 1.
+    **options
+        - cache_directory      : raw response cache.
+        - checkpoint_directory : root directory of the shard checkpoints.
+        - offline              : replay everything from the cache without network access.
+        - resume               : skip the games completed by a previous run and retry the failed ones.
+        - max_in_flight        : games fetched concurrently per shard.
+        - request_rate         : sustained API requests per second, shared by all running shards.
+        - workers              : labeling processes per shard (0 labels in the shard's process).
+        - queue_size           : fetched games waiting for labeling before fetching pauses.
+        - artifact_directory   : cache of the per-game stage outputs (see `label_game`), None for none.
+
+    Returns
+    -------
+    counts : collections.Counter
+        Statuses of the games of all shards, see Checkpoint.counts.
+    """
+
+    options['request_rate'] = options['request_rate'] / max(shard_workers, 1)
+    counts = collections.Counter()
+    started = time.perf_counter()
+    games = 0
+
+    def merge(report):
+        nonlocal games
+        shard = report['shard']
+        merge_store(report['staging'], directory)
+        registry.merge(report['metrics'])
+        counts.update(report['counts'])
+        games += report['games']
+        rate = report['games'] / report['seconds'] if report['seconds'] > 0 else 0
+        tqdm.write(f"{shard['season']} {shard['season_type']} part {shard['part']}: {report['games']} games, "
+                   f"{report['rows']} lineups in {report['seconds']:.1f}s ({rate:.2f} games/s)")
+
+    if shard_workers:
+        with ProcessPoolExecutor(shard_workers, initializer=init_worker) as executor:
+            futures = [executor.submit(run_shard, shard, options) for shard in shards]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Shards"):
+                merge(future.result())
+    else:
+        for shard in tqdm(shards, desc="Shards"):
+            merge(run_shard(shard, options))
+
+    seconds = time.perf_counter() - started
+    print(f"{games} games in {seconds:.1f}s ({games / seconds if seconds > 0 else 0:.2f} games/s)")
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill the lineup store from the NBA stats API, in parallel shards of games.")
+    parser.add_argument('--seasons', nargs='+', default=[], type=season_range,
+                        help="Seasons or inclusive ranges of seasons, e.g. 2015-16:2024-25 (default: 2022-23)")
+    parser.add_argument('--season-types', nargs='+', default=[REGULAR_SEASON],
+                        choices=sorted(set(GAME_ID_SEASON_TYPES.values())), help="Season types (default: Regular Season)")
+    parser.add_argument('--game-ids', nargs='+', help="Backfill only these games; their seasons are read from the IDs")
+    parser.add_argument('--game-ids-file', help="File with one game ID per line, like --game-ids")
+    parser.add_argument('--directory', default='data', help="Lineup store directory")
+    parser.add_argument('--cache', default='cache', help="Raw response cache directory")
+    parser.add_argument('--checkpoint', default='checkpoint', help="Checkpoint directory")
+    parser.add_argument('--artifacts', default='artifacts', help="Cache of the per-game lineups and labelled plays, reused while their code and responses are unchanged")
+    parser.add_argument('--no-artifacts', action='store_true', help="Recompute every stage of every game without reading or writing the artifact cache")
+    parser.add_argument('--offline', action='store_true', help="Replay everything from the cache without network access")
+    parser.add_argument('--restart', action='store_true', help="Discard the checkpoints of the planned shards instead of resuming")
+    parser.add_argument('--shards', type=int, default=os.cpu_count(), help="Shards processed in parallel, 0 for none (default: number of cores)")
+    parser.add_argument('--workers', type=int, default=0, help="Labeling processes per shard (default: 0, label in the shard's process, reading only the response cache while fetching stays online)")
+    parser.add_argument('--queue-size', type=int, default=16, help="Fetched games waiting for labeling before fetching pauses")
+    parser.add_argument('--max-in-flight', type=int, default=4, help="Games fetched concurrently per shard")
+    parser.add_argument('--request-rate', type=float, default=0.75, help="Sustained API requests per second over all shards")
+    parser.add_argument('--games-per-part', type=int, default=100, help="Games per part of the lineup store")
+    parser.add_argument('--report', default='run_report', help="Run report path, written as .json and .prom (Prometheus text format)")
+    args = parser.parse_args()
+    started = time.perf_counter()
+
+    game_ids = args.game_ids
+    if args.game_ids_file:
+        with open(args.game_ids_file, 'r', encoding='utf-8') as f:
+            game_ids = (game_ids or []) + [line.strip() for line in f if line.strip()]
+
+    # The game logs are fetched here, through the cache
+    use_session(make_session())
+    install_cache(args.cache, offline=args.offline, refresh_endpoints=('leaguegamelog',), throttle=TokenBucket(rate=args.request_rate).acquire)
+    seasons = [season for seasons in args.seasons for season in seasons] or ['2022-23']
+    shards = plan_shards(seasons, args.season_types, game_ids=game_ids, games_per_part=args.games_per_part)
+
+    counts = backfill(
+        shards,
+        directory=args.directory,
+        shard_workers=args.shards,
+        cache_directory=args.cache,
+        checkpoint_directory=args.checkpoint,
+        offline=args.offline,
+        resume=not args.restart,
+        max_in_flight=args.max_in_flight,
+        request_rate=args.request_rate,
+        workers=args.workers,
+        queue_size=args.queue_size,
+        artifact_directory=None if args.no_artifacts else args.artifacts,
+    )
 
     # Problems
-    print(f"Number of problems encountered: {problem}")
-    print(f"Problematic lineups (API issue): {problematic_lineup}")
-    print(f"Empty boxscore dataframes: {empty_boxscore_df}")
-    print(f"Nobody played: {nobody_played}")
-    
-    # Export
-    os.makedirs(directory, exist_ok=True)
-    filepath = os.path.join(directory, f'data_{season}_{part+1}.csv')
-    df.to_csv(filepath, index=False)
-
-    # Setup
-    df = pd.DataFrame(columns=columns)
-    time.sleep(10)
+    print(f"Number of problems encountered: {counts['failed', None]}")
+    print(f"Problematic lineups (API issue): {counts['skipped', 'Problematic lineup']}")
+    print(f"Empty play-by-play dataframes: {counts['skipped', 'Empty play-by-play']}")
+    print(f"Nobody played: {counts['skipped', 'Nobody played']}")
+
+    # Where the time went
+    report = registry.report(time.perf_counter() - started)
+    for stage, summary in report['stages'].items():
+        rate = f", {summary['rows_per_second']:.0f} rows/s" if summary['rows_per_second'] else ''
+        print(f"{stage:<12} {summary['seconds']:9.1f}s over {summary['count']} calls, mean {summary['mean'] * 1000:.1f} ms{rate}")
+    print(f"Peak RSS: {report['peak_rss_mb']['max']:.0f} MiB")
+    for path in registry.write(args.report, report['wall_seconds']):
+        print(f"Run report written to {path}")
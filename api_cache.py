@@ -0,0 +1,228 @@
+from nba_api.stats.library.http import NBAStatsHTTP
+from metrics import registry
+import hashlib
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class CacheMiss(Exception):
+    """
+    Raised in offline mode when a requested endpoint response is not in the cache.
+    """
+
+
+_original_send_api_request = NBAStatsHTTP.send_api_request
+
+# Request function of install_cache, and the one of `offline_cache` of the current thread
+_installed = {'send': _original_send_api_request}
+_scope = threading.local()
+
+
+def _send_api_request(self, endpoint, parameters, *args, **kwargs):
+    # Replaces NBAStatsHTTP.send_api_request: a thread inside `offline_cache` reads its cache,
+    # the others go through the one of install_cache
+    send = getattr(_scope, 'send', None) or _installed['send']
+    return send(self, endpoint, parameters, *args, **kwargs)
+
+
+def cache_key(endpoint: str, parameters: dict) -> str:
+    """
+    Computes the cache key of an endpoint request.
+
+    Parameters
+    ----------
+    endpoint : str
+        Name of the nba_api endpoint (e.g. 'playbyplayv3').
+    parameters : dict
+        Request parameters as passed to the endpoint. Parameters set to None are not sent
+        by requests, so they are left out of the key.
+
+    Returns
+    -------
+    key : str
+        SHA-256 hex digest of the endpoint name and its sorted parameters.
+    """
+
+    items = sorted((str(k), str(v)) for k, v in dict(parameters).items() if v is not None)
+    canonical = json.dumps([endpoint.lower(), items], separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def cache_path(directory: str, endpoint: str, key: str) -> str:
+    """
+    Returns the file path of a cached response.
+
+    Parameters
+    ----------
+    directory : str
+        Root directory of the cache.
+    endpoint : str
+        Name of the nba_api endpoint.
+    key : str
+        Cache key as returned by `cache_key`.
+
+    Returns
+    -------
+    path : str
+        Path of the form {directory}/{endpoint}/{key[:2]}/{key}.json
+    """
+
+    return os.path.join(directory, endpoint.lower(), key[:2], f'{key}.json')
+
+
+def load_response(directory: str, endpoint: str, parameters: dict) -> str | None:
+    """
+    Reads a raw response from the cache.
+
+    Parameters
+    ----------
+    directory : str
+        Root directory of the cache.
+    endpoint : str
+        Name of the nba_api endpoint.
+    parameters : dict
+        Request parameters.
+
+    Returns
+    -------
+    contents : str or None
+        Raw response text, or None if the response is not cached.
+    """
+
+    path = cache_path(directory, endpoint, cache_key(endpoint, parameters))
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def store_response(directory: str, endpoint: str, parameters: dict, contents: str) -> str:
+    """
+    Writes a raw response to the cache. The file is written to a temporary path first and then
+    renamed, so an interrupted run never leaves a truncated response behind.
+
+    Parameters
+    ----------
+    directory : str
+        Root directory of the cache.
+    endpoint : str
+        Name of the nba_api endpoint.
+    parameters : dict
+        Request parameters.
+    contents : str
+        Raw response text.
+
+    Returns
+    -------
+    path : str
+        Path of the cached response.
+    """
+
+    path = cache_path(directory, endpoint, cache_key(endpoint, parameters))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(contents)
+    os.replace(tmp_path, path)
+    return path
+
+
+def is_cached(directory: str, endpoint: str, parameters: dict) -> bool:
+    """
+    Checks whether a response is present in the cache.
+    """
+
+    return os.path.isfile(cache_path(directory, endpoint, cache_key(endpoint, parameters)))
+
+
+def install_cache(directory: str = 'cache', offline: bool = False, refresh_endpoints: tuple = (), throttle=None) -> None:
+    """
+    Routes every nba_api stats request through the on-disk cache, recording the latency of
+    cache hits and network requests per endpoint in metrics.registry.
+
+    Cached responses are served without touching the network. Responses fetched from the
+    network are stored if they are valid JSON. In offline mode a cache miss raises `CacheMiss`
+    instead of sending a request, so the whole pipeline can be replayed without network access.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Root directory of the cache. Default is 'cache'.
+    offline : bool, optional
+        If True, never send requests. Default is False.
+    refresh_endpoints : tuple of str, optional
+        Endpoints that are always re-fetched when online (e.g. 'leaguegamelog', whose
+        response changes during a season). Offline, they are served from the cache.
+    throttle : callable, optional
+        Called without arguments before every network request, e.g. `TokenBucket.acquire`.
+        Cache hits are not throttled.
+    """
+
+    _installed['send'] = _cached_request(directory, offline, refresh_endpoints, throttle)
+    NBAStatsHTTP.send_api_request = _send_api_request
+
+
+def _cached_request(directory: str, offline: bool, refresh_endpoints: tuple, throttle):
+    # Request function serving the cache, see install_cache
+    refresh = {endpoint.lower() for endpoint in refresh_endpoints}
+
+    def send_api_request(self, endpoint, parameters, *args, **kwargs):
+        if offline or endpoint.lower() not in refresh:
+            started = time.perf_counter()
+            contents = load_response(directory, endpoint, parameters)
+            if contents is not None:
+                registry.observe('endpoint_seconds', time.perf_counter() - started, endpoint=endpoint.lower(), source='cache')
+                return self.nba_response(response=contents, status_code=200, url=None)
+        if offline:
+            raise CacheMiss(f"No cached response for {endpoint} with parameters {parameters}")
+
+        if throttle is not None:
+            started = time.perf_counter()
+            throttle()
+            registry.increment('throttle_wait_seconds_total', time.perf_counter() - started)
+
+        started = time.perf_counter()
+        try:
+            response = _original_send_api_request(self, endpoint, parameters, *args, **kwargs)
+        finally:
+            registry.observe('endpoint_seconds', time.perf_counter() - started, endpoint=endpoint.lower(), source='network')
+        if response._status_code == 200 and response.valid_json():
+            store_response(directory, endpoint, parameters, response.get_response())
+        return response
+
+    return send_api_request
+
+
+def uninstall_cache() -> None:
+    """
+    Restores the original nba_api request function.
+    """
+
+    _installed['send'] = _original_send_api_request
+    NBAStatsHTTP.send_api_request = _original_send_api_request
+
+
+@contextlib.contextmanager
+def offline_cache(directory: str = 'cache'):
+    """
+    Serves the nba_api requests of the calling thread from the cache in offline mode (see
+    `install_cache`) for the duration of the block, leaving the cache that other threads use
+    untouched, e.g. to label games in the thread that aggregates them while fetch threads keep
+    downloading.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Root directory of the cache. Default is 'cache'.
+    """
+
+    NBAStatsHTTP.send_api_request = _send_api_request
+    previous = getattr(_scope, 'send', None)
+    _scope.send = _cached_request(directory, True, (), None)
+    try:
+        yield
+    finally:
+        _scope.send = previous
@@ -0,0 +1,157 @@
+from api_cache import cache_key, cache_path
+from metrics import registry
+from importlib.metadata import version
+import pandas as pd
+import hashlib
+import inspect
+import shutil
+import glob
+import json
+import os
+
+
+# Bumped whenever the layout of the artifacts changes, so older ones are not reused
+ARTIFACT_FORMAT = 1
+
+
+def code_version(*objects) -> str:
+    """
+    Hash of the source code of modules or functions, of the value of constants they read (e.g.
+    lists of column names, hashed by repr) and of the nba_api version that parses the responses:
+    an artifact computed by older code gets a different key.
+    """
+
+    digest = hashlib.sha256(version('nba_api').encode('utf-8'))
+    for obj in objects:
+        if inspect.ismodule(obj) or inspect.isclass(obj) or inspect.isroutine(obj):
+            digest.update(inspect.getsource(obj).encode('utf-8'))
+        else:
+            digest.update(repr(obj).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ArtifactCache:
+    """
+    On-disk cache of the per-game outputs of the ingestion stages (lineup reconstruction,
+    play labeling, game preparation), so that rebuilding the lineup store after a change to a
+    later stage does not parse every game again.
+
+    An artifact is stored as {directory}/{stage}/{game_id}.{key}.pkl. Pickles rather than Parquet,
+    as the labelled plays hold mixed-type object columns and the stages also return tuples of
+    DataFrames, None or 'Nobody played', all of which must come back exactly as computed.
+    The key hashes the code version of the stage, the size and modification time of the raw
+    responses it reads (see api_cache) and the keys of the stages it depends on, so a stage is
+    only recomputed when its code or its inputs changed. Artifacts of older keys are deleted
+    when a game is recomputed.
+
+    Parameters
+    ----------
+    directory : str
+        Root directory of the artifacts.
+    response_directory : str
+        Raw response cache the stages read from.
+    """
+
+    def __init__(self, directory: str = 'artifacts', response_directory: str = 'cache'):
+        self.directory = directory
+        self.response_directory = response_directory
+
+    def _response_fingerprint(self, endpoint, game_id: str):
+        parameters = endpoint(game_id=game_id, get_request=False).parameters
+        path = cache_path(self.response_directory, endpoint.endpoint, cache_key(endpoint.endpoint, parameters))
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        return [endpoint.endpoint, stat.st_size, stat.st_mtime_ns]
+
+    def key(self, stage: str, game_id: str, version: str, endpoints=(), upstream=()) -> str | None:
+        """
+        Computes the key of the artifact of a stage of a game, or None if one of its raw
+        responses is not cached yet (the artifact is then computed but not stored).
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage.
+        game_id : str
+            The unique identifier for the NBA game.
+        version : str
+            Code version of the stage, see `code_version`.
+        endpoints : iterable of nba_api endpoint classes, optional
+            Endpoints whose responses the stage reads.
+        upstream : iterable of str, optional
+            Keys of the artifacts the stage is computed from.
+        """
+
+        inputs = [self._response_fingerprint(endpoint, game_id) for endpoint in endpoints]
+        if None in inputs or None in upstream:
+            return None
+        canonical = json.dumps([ARTIFACT_FORMAT, stage, game_id, version, inputs, list(upstream)], separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:32]
+
+    def _path(self, stage: str, game_id: str, key: str) -> str:
+        return os.path.join(self.directory, stage, f'{game_id}.{key}.pkl')
+
+    def load(self, stage: str, game_id: str, key: str):
+        """
+        Returns (True, result) for a stored artifact, or (False, None).
+        """
+
+        path = self._path(stage, game_id, key)
+        if not os.path.isfile(path):
+            return False, None
+        return True, pd.read_pickle(path)
+
+    def save(self, stage: str, game_id: str, key: str, result) -> None:
+        """
+        Stores an artifact atomically and deletes the artifacts of other keys of the game.
+        """
+
+        path = self._path(stage, game_id, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        for stale in glob.glob(os.path.join(glob.escape(os.path.dirname(path)), f'{game_id}.*.pkl')):
+            if stale != path:
+                os.remove(stale)
+
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        pd.to_pickle(result, tmp_path)
+        os.replace(tmp_path, path)
+
+    def run(self, stage: str, game_id: str, compute, version: str, endpoints=(), upstream=()) -> tuple:
+        """
+        Returns the stored artifact of a stage of a game, or computes and stores it.
+
+        Parameters
+        ----------
+        stage, game_id, version, endpoints, upstream
+            See `key`.
+        compute : callable
+            Called without arguments to compute the result on a miss. Exceptions are not cached.
+
+        Returns
+        -------
+        result : object
+            Whatever `compute` returned, e.g. a DataFrame, a tuple of DataFrames or None.
+        key : str or None
+            Key of the artifact, to pass as `upstream` to later stages.
+        """
+
+        key = self.key(stage, game_id, version, endpoints, upstream)
+        if key is not None:
+            found, result = self.load(stage, game_id, key)
+            if found:
+                registry.increment('artifacts_total', stage=stage, outcome='hit')
+                return result, key
+
+        result = compute()
+        registry.increment('artifacts_total', stage=stage, outcome='miss')
+        if key is not None:
+            self.save(stage, game_id, key, result)
+        return result, key
+
+    def clear(self) -> None:
+        """
+        Deletes every artifact.
+        """
+
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,320 @@
+from nba_api.stats.endpoints import LeagueGameLog
+from api_cache import install_cache, is_cached, uninstall_cache
+from aggregate_plus_minus_data import prepare_game, aggregate_games, add_ratings
+from get_lineups import get_lineups
+from label_play_by_play import get_labelled_play_by_play
+from regression import build_design
+from ridge import fit_ridge
+from synthetic_data import make_league, write_season
+import pandas as pd
+import numpy as np
+import tracemalloc
+import platform
+import argparse
+import resource
+import json
+import time
+import os
+
+
+# Stages timed by the benchmark, in pipeline order, with the unit of their throughput
+STAGES = {
+    'lineups': 'games',        # get_lineups: GameRotation parsing and stint reconstruction
+    'labelling': 'games',      # get_labelled_play_by_play: PlayByPlayV3 parsing and labeling
+    'prepare': 'games',        # prepare_game
+    'aggregation': 'games',    # aggregate_games and add_ratings, per season
+    'design': 'lineups',       # regression.build_design
+    'ridge_cv': 'lineups',     # ridge.fit_ridge with 5-fold CV over 50 alphas
+}
+
+
+def synthetic_fixture(directory: str, n_seasons: int, games_per_season: int = 1230, first_season: int = 2022, seed: int = 0) -> dict:
+    """
+    Returns a fixture of `n_seasons` synthetic seasons, simulating into a raw response cache the
+    seasons that are not in it yet. Fixtures with the same parameters share a cache, and a fixture
+    of fewer seasons uses the first seasons of a larger one.
+
+    Parameters
+    ----------
+    directory : str
+        Root directory of the fixtures.
+    n_seasons : int
+        Number of seasons.
+    games_per_season : int, optional
+        Games per season. Default is 1230, a full regular season.
+    first_season : int, optional
+        Starting year of the first season. Default is 2022.
+    seed : int, optional
+        Random seed of the league and the games. Default is 0.
+
+    Returns
+    -------
+    fixture : dict
+        - name  : e.g. 'synthetic-2x1230'.
+        - cache : raw response cache of the fixture.
+        - games : {season: [game IDs]}.
+    """
+
+    cache = os.path.join(directory, f'synthetic-g{games_per_season}-seed{seed}')
+    seasons = [f'{year}-{(year + 1) % 100:02d}' for year in range(first_season, first_season + n_seasons)]
+
+    league = None
+    games = {}
+    for season in seasons:
+        # The game log is written last, so a season with a game log is complete
+        parameters = LeagueGameLog(season=season, get_request=False).parameters
+        if is_cached(cache, LeagueGameLog.endpoint, parameters):
+            games[season] = game_log_ids(cache, season)
+            continue
+        if league is None:
+            # Rosters of season k only depend on the seed, not on the number of seasons generated
+            league = make_league(n_seasons=len(seasons), first_season=first_season, seed=seed)
+        print(f"Simulating {games_per_season} games of {season} into {cache}")
+        games[season] = write_season(cache, league, season, n_games=games_per_season, seed=seed)
+
+    return {'name': f'synthetic-{n_seasons}x{games_per_season}', 'cache': cache, 'games': games}
+
+
+def game_log_ids(cache: str, season: str) -> list:
+    """
+    Reads the game IDs of a season from the game log in a raw response cache.
+    """
+
+    install_cache(cache, offline=True)
+    try:
+        return list(LeagueGameLog(season=season).get_data_frames()[0]['GAME_ID'].unique())
+    finally:
+        uninstall_cache()
+
+
+def recorded_fixture(cache: str, seasons: list, max_games: int = None) -> dict:
+    """
+    Returns a fixture of recorded games: the games of `seasons` in the game logs of a raw response
+    cache that has all their responses, at most `max_games` per season.
+    """
+
+    games = {}
+    for season in seasons:
+        season_games = game_log_ids(cache, season)
+        games[season] = season_games[:max_games] if max_games else season_games
+    n_games = sum(len(game_ids) for game_ids in games.values())
+    return {'name': f'recorded-{n_games}', 'cache': cache, 'games': games}
+
+
+def measure(function, repeat: int = 1, memory: bool = True) -> tuple:
+    """
+    Calls `function` `repeat` times and once more under tracemalloc if `memory` is set.
+
+    Returns
+    -------
+    result : object
+        Return value of the last call.
+    seconds : float
+        Best wall time of the timed calls, which run without tracemalloc.
+    peak_mb : float or None
+        Peak Python heap allocated during the traced call (numpy and pandas buffers included), in MiB.
+    """
+
+    seconds = np.inf
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        seconds = min(seconds, time.perf_counter() - started)
+
+    peak_mb = None
+    if memory:
+        tracemalloc.start()
+        try:
+            result = function()
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+    return result, seconds, peak_mb
+
+
+def run_stages(fixture: dict, stages=tuple(STAGES), repeat: int = 1, memory: bool = True) -> list:
+    """
+    Runs the pipeline stages over a fixture offline, each stage on the outputs of the one before.
+
+    Parameters
+    ----------
+    fixture : dict
+        Fixture as returned by `synthetic_fixture` or `recorded_fixture`.
+    stages : iterable of str, optional
+        Stages to report, see `STAGES`. Stages they depend on run untimed. Default is all stages.
+    repeat : int, optional
+        Timed runs per stage; the best is reported. Default is 1.
+    memory : bool, optional
+        Measure the peak memory of every stage in an extra run. Default is True.
+
+    Returns
+    -------
+    results : list of dict
+        One entry per stage with the keys fixture, stage, items, unit, seconds, throughput
+        (items per second) and peak_mb.
+    """
+
+    stages = set(stages)
+    games = [(season, game_id) for season, game_ids in fixture['games'].items() for game_id in game_ids]
+    results = []
+
+    def stage(name, items, function):
+        timed = name in stages
+        result, seconds, peak_mb = measure(function, repeat if timed else 1, memory and timed)
+        if timed:
+            results.append({
+                'fixture': fixture['name'],
+                'stage': name,
+                'items': items,
+                'unit': STAGES[name],
+                'seconds': seconds,
+                'throughput': items / seconds if seconds > 0 else None,
+                'peak_mb': peak_mb,
+            })
+        return result
+
+    install_cache(fixture['cache'], offline=True)
+    try:
+        lineups = stage('lineups', len(games), lambda: [get_lineups(game_id=game_id) for _, game_id in games])
+        plays = stage('labelling', len(games), lambda: [get_labelled_play_by_play(game_id=game_id) for _, game_id in games])
+    finally:
+        uninstall_cache()
+
+    prepared = stage('prepare', len(games), lambda: [
+        prepare_game(game_id, lineup, pbp) for (_, game_id), lineup, pbp in zip(games, lineups, plays)
+        if lineup is not None and lineup['Valid'].all() and isinstance(pbp, pd.DataFrame)
+    ])
+
+    # Seasons are aggregated separately, as in the lineup store
+    season_of = {game_id: season for season, game_id in games}
+
+    def aggregate():
+        seasons = {}
+        for lineup, pbp in prepared:
+            seasons.setdefault(season_of[lineup['GAME'].iloc[0]], []).append((lineup, pbp))
+        return pd.concat([add_ratings(aggregate_games(season_games), season) for season, season_games in seasons.items()], ignore_index=True)
+
+    df = stage('aggregation', len(prepared), aggregate)
+    design = stage('design', len(df), lambda: build_design(df))
+    stage('ridge_cv', design['X'].shape[0], lambda: fit_ridge(design['X'], design['y'], design['w'], alphas=np.logspace(-2, 4, 50), cv=5))
+    return results
+
+
+def environment() -> dict:
+    """
+    Describes the machine and library versions a benchmark ran with.
+    """
+
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare(results: list, baseline: dict, tolerance: float = 0.2) -> list:
+    """
+    Compares the throughput of every (fixture, stage) of `results` to a baseline report.
+
+    Parameters
+    ----------
+    results : list of dict
+        Results as returned by `run_stages`.
+    baseline : dict
+        Report as written by this script, see `--save-baseline`.
+    tolerance : float, optional
+        Relative slowdown tolerated before a stage counts as a regression. Default is 0.2.
+
+    Returns
+    -------
+    comparisons : list of dict
+        One entry per result found in the baseline, with the keys fixture, stage, throughput,
+        baseline, ratio (throughput / baseline) and regression (bool).
+    """
+
+    reference = {(entry['fixture'], entry['stage']): entry for entry in baseline['results']}
+    comparisons = []
+    for entry in results:
+        base = reference.get((entry['fixture'], entry['stage']))
+        if base is None or not base['throughput'] or not entry['throughput']:
+            continue
+        ratio = entry['throughput'] / base['throughput']
+        comparisons.append({
+            'fixture': entry['fixture'],
+            'stage': entry['stage'],
+            'throughput': entry['throughput'],
+            'baseline': base['throughput'],
+            'ratio': ratio,
+            'regression': ratio < 1 - tolerance,
+        })
+    return comparisons
+
+
+def scaling(results: list) -> pd.DataFrame:
+    """
+    Throughput of every stage by fixture size, the scaling curve of the benchmark. A stage that
+    scales linearly keeps the same throughput on larger fixtures.
+    """
+
+    return pd.DataFrame(results).pivot_table(index='stage', columns='fixture', values='throughput', sort=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the ingestion and regression stages offline on synthetic or recorded games.")
+    parser.add_argument('--scales', nargs='+', type=int, default=[1], help="Synthetic fixture sizes in seasons, e.g. 1 5 20 (default: 1)")
+    parser.add_argument('--games-per-season', type=int, default=1230, help="Games per synthetic season")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic league")
+    parser.add_argument('--fixtures', default='benchmark_fixtures', help="Directory of the synthetic fixtures, reused between runs")
+    parser.add_argument('--recorded', help="Also benchmark the recorded games of this raw response cache")
+    parser.add_argument('--recorded-seasons', nargs='+', default=['2022-23'], help="Seasons of the recorded games")
+    parser.add_argument('--max-games', type=int, help="Recorded games per season")
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=list(STAGES), help="Stages to report")
+    parser.add_argument('--repeat', type=int, default=1, help="Timed runs per stage, the best is reported")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the traced run measuring peak memory")
+    parser.add_argument('--output', default='benchmark_results.json', help="Report file")
+    parser.add_argument('--baseline', default='benchmark_baseline.json', help="Report to compare against")
+    parser.add_argument('--save-baseline', action='store_true', help="Write the report to --baseline instead of comparing")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    fixtures = [synthetic_fixture(args.fixtures, n, args.games_per_season, seed=args.seed) for n in sorted(set(args.scales))]
+    if args.recorded:
+        fixtures.append(recorded_fixture(args.recorded, args.recorded_seasons, args.max_games))
+
+    results = []
+    for fixture in fixtures:
+        print(f"Benchmarking {fixture['name']}")
+        for entry in run_stages(fixture, args.stages, repeat=args.repeat, memory=not args.no_memory):
+            peak = '' if entry['peak_mb'] is None else f", peak {entry['peak_mb']:.0f} MiB"
+            print(f"  {entry['stage']:<12} {entry['items']:>8} {entry['unit']:<8} {entry['seconds']:8.2f}s "
+                  f"{entry['throughput'] or 0:10.1f} {entry['unit']}/s{peak}")
+            results.append(entry)
+
+    report = {
+        'environment': environment(),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10,
+        'results': results,
+    }
+
+    print("\nThroughput by fixture")
+    print(scaling(results).to_string(float_format=lambda x: f'{x:.1f}'))
+
+    path = args.baseline if args.save_baseline else args.output
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1)
+    print(f"\nReport written to {path}")
+
+    if not args.save_baseline and os.path.isfile(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline['environment'] != report['environment']:
+            print(f"Warning: {args.baseline} was measured in a different environment: {baseline['environment']}")
+        comparisons = compare(results, baseline, args.tolerance)
+        for entry in comparisons:
+            flag = '  REGRESSION' if entry['regression'] else ''
+            print(f"  {entry['fixture']:<22} {entry['stage']:<12} {entry['ratio']:6.2f}x baseline{flag}")
+        if any(entry['regression'] for entry in comparisons):
+            raise SystemExit(1)
@@ -0,0 +1,209 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from incremental_rapm import stored_games, load_game_statistics
+from regression import coefficient_table
+import scipy.linalg
+import pandas as pd
+import numpy as np
+import os
+
+
+# Arrays of the game statistics attached by every worker, see `_attach`
+_shared = {}
+
+
+def game_arrays(directory: str, game_ids: list) -> dict:
+    """
+    Flattens the per-game statistics of the incremental_rapm store into arrays from which the
+    normal equations of any reweighting of the games are one weighted bincount away.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the statistics store.
+    game_ids : list of str
+        Games to include.
+
+    Returns
+    -------
+    arrays : dict
+        - players     : int array (p,), player IDs.
+        - G_index     : int array, position in the flattened p x p Gram matrix of every entry of every game.
+        - G_values    : float array, value of every entry.
+        - G_game      : int array, game (position in `game_ids`) of every entry.
+        - b_index, b_values, b_game : same for X^T W y, one entry per player of every game.
+        - possessions : int array (p,), possessions played over all games.
+    """
+
+    games = [load_game_statistics(directory, game_id) for game_id in game_ids]
+    players = pd.Index(pd.unique(np.concatenate([stats['players'] for stats in games])))
+    p = len(players)
+
+    G_index, G_values, G_game, b_index, b_values, b_game = [], [], [], [], [], []
+    possessions = np.zeros(p, dtype=np.int64)
+    for i, stats in enumerate(games):
+        positions = players.get_indexer(stats['players'])
+        G_index.append((positions[:, None] * p + positions[None, :]).ravel())
+        G_values.append(stats['G'].ravel())
+        G_game.append(np.full(positions.size ** 2, i, dtype=np.int32))
+        b_index.append(positions)
+        b_values.append(stats['b'])
+        b_game.append(np.full(positions.size, i, dtype=np.int32))
+        possessions[positions] += stats['possessions']
+
+    return {
+        'players': players.to_numpy(dtype=np.int64),
+        'G_index': np.concatenate(G_index).astype(np.int64),
+        'G_values': np.concatenate(G_values),
+        'G_game': np.concatenate(G_game),
+        'b_index': np.concatenate(b_index).astype(np.int64),
+        'b_values': np.concatenate(b_values),
+        'b_game': np.concatenate(b_game),
+        'possessions': possessions,
+    }
+
+
+def solve_weighted(arrays: dict, game_weights: np.ndarray, alpha: float) -> np.ndarray:
+    """
+    Ridge coefficients of the games reweighted by `game_weights` (e.g. bootstrap counts).
+    Players of no game with a positive weight get NaN.
+    """
+
+    p = len(arrays['players'])
+    G = np.bincount(arrays['G_index'], weights=arrays['G_values'] * game_weights[arrays['G_game']], minlength=p * p).reshape(p, p)
+    b = np.bincount(arrays['b_index'], weights=arrays['b_values'] * game_weights[arrays['b_game']], minlength=p)
+    present = np.bincount(arrays['b_index'], weights=game_weights[arrays['b_game']], minlength=p) > 0
+
+    G[np.diag_indices(p)] += alpha
+    coef = scipy.linalg.solve(G, b, assume_a='pos', overwrite_a=True, check_finite=False)
+    return np.where(present, coef, np.nan)
+
+
+def share_arrays(arrays: dict) -> tuple[list, dict]:
+    """
+    Copies arrays into shared memory blocks.
+
+    Returns
+    -------
+    blocks : list of multiprocessing.shared_memory.SharedMemory
+        To close and unlink once the workers are done.
+    specs : dict
+        {name: (block name, shape, dtype)}, to attach the arrays in other processes with `_attach`.
+    """
+
+    blocks, specs = [], {}
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+
+def _attach(specs: dict) -> None:
+    # Process pool initializer: maps the shared arrays without copying them
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _shared[name] = (block, np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf))
+
+
+def _replicates(seeds: list, alpha: float) -> np.ndarray:
+    # Runs in a worker: one row of coefficients per seed, resampling games with replacement
+    arrays = {name: array for name, (_, array) in _shared.items()}
+    n_games = int(arrays['G_game'].max()) + 1 if arrays['G_game'].size else 0
+    coefs = []
+    for seed in seeds:
+        counts = np.random.default_rng(seed).multinomial(n_games, np.full(n_games, 1 / n_games)).astype(float)
+        coefs.append(solve_weighted(arrays, counts, alpha))
+    return np.vstack(coefs)
+
+
+def bootstrap(directory: str = 'stats', seasons=None, alpha: float = 10000, replicates: int = 1000, workers: int = None,
+              seed: int = 0, batch_size: int = 25, levels=(0.025, 0.975)) -> pd.DataFrame:
+    """
+    Game-level bootstrap of the ridge coefficients: every replicate draws as many games as there
+    are, with replacement, and fits the ridge regression on the drawn games. A game drawn c times
+    contributes c times its statistics, so replicates only reweight the per-game normal equations
+    of the incremental_rapm store and never go back to the lineups.
+
+    The flattened statistics are put in shared memory once and attached by every worker; workers
+    get batches of seeds and return coefficients. Seeds are derived from `seed` per replicate, so
+    results do not depend on `workers` or `batch_size`.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Directory of the statistics store (see incremental_rapm). Default is 'stats'.
+    seasons : list of str, optional
+        Seasons of the games to include. Default is all stored games.
+    alpha : float, optional
+        Penalty, e.g. as chosen by regression.py. Kept fixed across replicates. Default is 10000.
+    replicates : int, optional
+        Number of bootstrap replicates. Default is 1000.
+    workers : int, optional
+        Worker processes; 0 runs the replicates in the calling process. Default is the number of CPUs.
+    seed : int, optional
+        Random seed. Default is 0.
+    batch_size : int, optional
+        Replicates per task sent to a worker. Default is 25.
+    levels : tuple of float, optional
+        Quantiles of the percentile interval. Default is (0.025, 0.975), a 95% interval.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Indexed by player ID: Coefficient (fit on all games), Std_Error (standard deviation over
+        replicates), Lower and Upper (percentile interval), Replicates (number of replicates the
+        player appears in) and Possessions.
+    """
+
+    games = stored_games(directory)
+    game_ids = sorted(game_id for game_id, entry in games.items() if seasons is None or entry['season'] in seasons)
+    if not game_ids:
+        raise ValueError(f"No games of {seasons} in {directory}")
+    arrays = game_arrays(directory, game_ids)
+    coef = solve_weighted(arrays, np.ones(len(game_ids)), alpha)
+
+    seeds = np.random.SeedSequence(seed).spawn(replicates)
+    batches = [seeds[start:start + batch_size] for start in range(0, replicates, batch_size)]
+    workers = os.cpu_count() if workers is None else workers
+
+    blocks, specs = share_arrays(arrays)
+    try:
+        if workers:
+            with ProcessPoolExecutor(workers, initializer=_attach, initargs=(specs,)) as executor:
+                samples = np.vstack(list(executor.map(_replicates, batches, [alpha] * len(batches))))
+        else:
+            _attach(specs)
+            samples = np.vstack([_replicates(batch, alpha) for batch in batches])
+    finally:
+        for name in list(_shared):
+            _shared.pop(name)[0].close()
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    lower, upper = np.nanquantile(samples, levels, axis=0)
+    return pd.DataFrame({
+        'Coefficient': coef,
+        'Std_Error': np.nanstd(samples, axis=0, ddof=1),
+        'Lower': lower,
+        'Upper': upper,
+        'Replicates': np.isfinite(samples).sum(axis=0),
+        'Possessions': arrays['possessions'],
+    }, index=pd.Index(arrays['players'], name='Player_ID'))
+
+
+if __name__ == "__main__":
+    directory = 'stats'  # Filled by incremental_rapm.py
+    seasons = ['2022-23', '2023-24', '2024-25']
+    alpha = 10000  # Penalty, e.g. as chosen by regression.py
+    replicates = 1000
+
+    intervals = bootstrap(directory, seasons=seasons, alpha=alpha, replicates=replicates)
+
+    output_df = coefficient_table(intervals[['Coefficient', 'Std_Error']], intervals['Possessions'])
+    output_df = output_df.merge(intervals[['Lower', 'Upper', 'Replicates']], left_on='Player_ID', right_index=True, how='left')
+
+    print("Exporting...")
+    output_df.to_csv('player_coefficients_bootstrap.csv', index=False)
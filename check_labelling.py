@@ -0,0 +1,273 @@
+from label_play_by_play import PERIOD_RE, find_next_play, determine_play_possession, get_other_value, get_game_teams, prepare_play_by_play, label_possessions, label_games
+from nba_api.stats.endpoints import PlayByPlayV3
+from api_cache import install_cache
+import pandas as pd
+import argparse
+import glob
+import json
+import os
+
+
+def label_possessions_reference(plays: pd.DataFrame, teams: list, loc_to_tricode_dict: dict) -> pd.DataFrame:
+    """
+    Reference implementation of `label_possessions`: the original row-by-row labeling loops
+    of get_labelled_play_by_play, kept to check the vectorized labeler against.
+
+    Parameters
+    ----------
+    plays : pandas.DataFrame
+        Prepared play-by-play as returned by `prepare_play_by_play`.
+    teams : list of str
+        Team abbreviations of the game, as returned by `get_game_teams`.
+    loc_to_tricode_dict : dict
+        Maps location ('h'/'v') to team tricode.
+
+    Returns
+    -------
+    plays : pandas.DataFrame
+        Same output as `label_possessions`.
+    """
+
+    tricode_to_loc_dict = {tricode: loc for loc, tricode in loc_to_tricode_dict.items()}
+    plays = plays.copy()
+    plays['newPossession'] = False
+    plays['possession'] = None
+    tipoff_ready = True
+
+    # Determine new possessions
+    for idx, row in plays.iterrows():
+        actionType = row['actionType']
+        subType = row['subType']
+        actionNumber = row['actionNumber']
+        location = row['location']
+        description = row['description']
+
+        # Made Shot
+        match actionType:
+            case 'Made Shot':
+
+                next_play, next_idx = find_next_play(idx, actionNumber, plays)
+                if next_play is None and next_idx is None:
+                    continue
+
+                # And 1 play
+                if (next_play['actionType'] == 'Foul') and (next_play['subType'] == 'Shooting') and (next_play['location'] != location):
+                    continue
+
+                # Regular basket made
+                plays.at[idx + 1, 'newPossession'] = True
+
+            # Turnover
+            case 'Turnover':
+                plays.at[idx + 1, 'newPossession'] = True
+
+            # Missed Shot
+            case 'Missed Shot':
+
+                next_play, next_idx = find_next_play(idx, actionNumber, plays)
+                if next_play is None and next_idx is None:
+                    continue
+
+                assert next_play['actionType'] == 'Rebound', f"Next play {next_play['actionType']} is not a rebound (row {idx})"
+                
+                if location != next_play['location']:
+                    plays.at[next_idx, 'newPossession'] = True
+
+            # Free Throw
+            case 'Free Throw':
+
+                next_play, next_idx = find_next_play(idx, actionNumber, plays)
+                if next_play is None and next_idx is None:
+                    continue
+
+                if next_play['actionType'] == 'period':
+                    continue
+
+                next_play_team_poss = determine_play_possession(next_play)
+                
+                if location != next_play_team_poss:
+                    plays.at[next_idx, 'newPossession'] = True
+
+            # Jump Ball
+            case 'Jump Ball':
+
+                last_play, last_idx = find_next_play(idx, actionNumber, plays, reverse = True)
+                if last_play is None and last_idx is None:
+                    continue
+
+                # Jump ball at new period
+                if last_play['actionType'] == 'period':
+
+                    # Who got the ball (NEW based on next play)
+                    next_play, next_idx = find_next_play(idx, actionNumber, plays)
+                    if next_play is None and next_idx is None:
+                        continue
+                    
+                    next_play_team_poss = determine_play_possession(next_play)
+                    team = loc_to_tricode_dict[next_play_team_poss]
+
+                    plays.at[idx, 'newPossession'] = True
+                    plays.at[idx, 'possession'] = team
+
+                    # Save tipoff winner
+                    if tipoff_ready:
+                        tipoff_ready = False
+                        initial_tip = team
+
+            # Period
+            case 'period':
+                if subType == 'start':
+                    m = PERIOD_RE.search(description)
+                    assert m, f"No period found in description: {description}"
+                    period = int(m.group(2))
+                    quarter_type = m.group(4)
+
+                    if quarter_type == 'Period':
+                        if tipoff_ready:
+                            initial_tip = loc_to_tricode_dict[plays.at[1, 'location']]
+                            plays.at[2, 'possession'] = initial_tip
+
+                        if period in (2, 3):
+                            plays.at[idx, 'newPossession'] = True
+                            plays.at[idx, 'possession'] = get_other_value(initial_tip, teams)
+
+                        if period == 4:
+                            plays.at[idx, 'newPossession'] = True
+                            plays.at[idx, 'possession'] = initial_tip 
+
+                    # Rewrites any newPossession = True that could be carried over from previous plays
+                    elif quarter_type == 'OT':
+                            plays.at[idx, 'newPossession'] = False
+
+
+    # Label possessions by team
+    for idx, row in plays.iterrows():
+        possession_end = row['newPossession']
+        actionType = row['actionType']
+        subType = row['subType']
+        description = row['description']
+        possession = row['possession']
+
+        if idx == 0:
+            continue
+
+        if possession is None:
+            last_possession = plays.at[idx - 1, 'possession']
+            if possession_end:
+                plays.at[idx, 'possession'] = get_other_value(last_possession, teams)
+            else:
+                plays.at[idx, 'possession'] = last_possession
+
+
+    # Label possession count
+    plays['possessionCount'] = plays['newPossession'].cumsum()
+    plays['possessionLoc'] = plays['possession'].map(tricode_to_loc_dict)
+    home_poss_mask = plays['possessionLoc'] == 'h'
+    plays['possessionH'] = plays['newPossession'].where(home_poss_mask, 0).cumsum()
+    plays['possessionV'] = plays['newPossession'].where(~home_poss_mask, 0).cumsum()
+
+    return plays
+
+
+def cached_game_ids(cache_directory: str) -> list:
+    """
+    Lists the IDs of all games whose PlayByPlayV3 response is in the raw response cache.
+    """
+
+    game_ids = []
+    for path in sorted(glob.glob(os.path.join(cache_directory, PlayByPlayV3.endpoint, '*', '*.json'))):
+        with open(path, 'r', encoding='utf-8') as f:
+            game_ids.append(json.load(f)['game']['gameId'])
+    return sorted(game_ids)
+
+
+def compare_labellers(game_ids: list, batch_size: int = 50) -> dict:
+    """
+    Labels every game with the reference implementation, with `label_possessions` and with
+    `label_games` (in batches of `batch_size` concatenated games) and compares the results.
+    A game counts as matching if all outputs are equal, or if all implementations raise.
+
+    Parameters
+    ----------
+    game_ids : list of str
+        Games to compare. Their responses are read through nba_api, so install the raw
+        response cache (offline) before calling this.
+    batch_size : int, optional
+        Number of games labeled at once by `label_games`. Default is 50.
+
+    Returns
+    -------
+    report : dict
+        'games', 'matching', 'failed' (games where all implementations raise) and 'mismatches'
+        (list of (game_id, message)).
+    """
+
+    report = {'games': 0, 'matching': 0, 'failed': 0, 'mismatches': []}
+    prepared = {}
+
+    for game_id in game_ids:
+        pbp = PlayByPlayV3(game_id=game_id).get_data_frames()[0]
+        if pbp.empty:
+            continue
+        player_teams, teams = get_game_teams(pbp)
+        if len(player_teams) == 0:
+            continue
+        plays, tricode_to_loc_dict, loc_to_tricode_dict = prepare_play_by_play(pbp)
+        report['games'] += 1
+
+        outputs = []
+        for labeller in (label_possessions_reference, label_possessions):
+            try:
+                outputs.append(labeller(plays, teams, loc_to_tricode_dict))
+            except Exception as e:
+                outputs.append(e)
+
+        reference, vectorized = outputs
+        if isinstance(reference, Exception) or isinstance(vectorized, Exception):
+            if isinstance(reference, Exception) and isinstance(vectorized, Exception):
+                report['failed'] += 1
+            else:
+                report['mismatches'].append((game_id, f"reference: {reference!r:.100}, vectorized: {vectorized!r:.100}"))
+            continue
+
+        try:
+            pd.testing.assert_frame_equal(vectorized, reference)
+        except AssertionError as e:
+            report['mismatches'].append((game_id, str(e)))
+            continue
+
+        prepared[game_id] = (plays, teams, loc_to_tricode_dict, reference)
+        report['matching'] += 1
+
+    # Batched labeling of the games that label without errors
+    ids = list(prepared)
+    for k in range(0, len(ids), batch_size):
+        batch = {game_id: prepared[game_id][:3] for game_id in ids[k:k + batch_size]}
+        labelled = label_games(batch)
+        for game_id, plays in labelled.groupby('gameId', sort=False):
+            reference = prepared[game_id][3]
+            try:
+                pd.testing.assert_frame_equal(plays.drop(columns='gameId').set_axis(reference.index), reference, check_dtype=False)
+            except AssertionError as e:
+                report['matching'] -= 1
+                report['mismatches'].append((game_id, f"batch: {e}"))
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the vectorized possession labeling against the reference implementation on cached games.")
+    parser.add_argument('game_ids', nargs='*', help="Games to check (default: every game in the cache)")
+    parser.add_argument('--cache', default='cache', help="Raw response cache directory")
+    args = parser.parse_args()
+
+    install_cache(args.cache, offline=True)
+    game_ids = args.game_ids or cached_game_ids(args.cache)
+    report = compare_labellers(game_ids)
+
+    for game_id, message in report['mismatches']:
+        print(f"[Mismatch] {game_id} → {message}")
+    print(f"Games compared: {report['games']}")
+    print(f"Matching: {report['matching']}")
+    print(f"Failing in both implementations: {report['failed']}")
+    print(f"Mismatches: {len(report['mismatches'])}")
@@ -0,0 +1,123 @@
+import pandas as pd
+import collections
+import shutil
+import json
+import os
+
+
+# Statuses of games that are not processed again when resuming
+DONE_STATUSES = ('labelled', 'aggregated', 'skipped')
+
+
+class Checkpoint:
+    """
+    Per-game status of the ingestion run of one part of a season, persisted after every change, with the
+    prepared stints and plays of every labelled game, so an interrupted run can resume without
+    redoing any game.
+
+    Statuses:
+    - labelled   : lineups and labelled plays are prepared and saved in the checkpoint.
+    - aggregated : the game is in a part of the lineup store.
+    - skipped    : the API data of the game cannot be used (e.g. 'Nobody played'); not retried.
+    - failed     : an error occurred at some stage; retried when resuming.
+
+    Parameters
+    ----------
+    directory : str
+        Root directory of the checkpoints.
+    name : str
+        Name of the run, e.g. '2022-23/part-001'. Its checkpoint is in {directory}/{name}.
+    """
+
+    def __init__(self, directory: str, name: str):
+        self.directory = os.path.join(directory, name)
+        self.path = os.path.join(self.directory, 'status.json')
+        self.games = {}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.games = json.load(f)
+
+    def status(self, game_id: str) -> str | None:
+        """
+        Returns the status of a game, or None if it was never processed.
+        """
+
+        return self.games.get(game_id, {}).get('status')
+
+    def mark(self, game_ids, status: str, stage: str = None, reason: str = None) -> None:
+        """
+        Sets the status of one or many games and saves the checkpoint.
+
+        Parameters
+        ----------
+        game_ids : str or list of str
+            Game(s) to update.
+        status : str
+            New status.
+        stage : str, optional
+            Stage a game was skipped or failed at: 'fetch', 'lineups', 'pbp' or 'prepare'.
+        reason : str, optional
+            Why a game was skipped or failed.
+        """
+
+        for game_id in [game_ids] if isinstance(game_ids, str) else game_ids:
+            entry = {'status': status}
+            if stage is not None:
+                entry['stage'] = stage
+            if reason is not None:
+                entry['reason'] = reason
+            self.games[game_id] = entry
+        self.save()
+
+    def save(self) -> None:
+        """
+        Writes the statuses to a temporary file and renames it over the previous one.
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.games, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def _frame_path(self, game_id: str, name: str) -> str:
+        return os.path.join(self.directory, 'games', f'{game_id}.{name}.parquet')
+
+    def save_game(self, game_id: str, lineup: pd.DataFrame, pbp: pd.DataFrame) -> None:
+        """
+        Saves the prepared stints and plays of a game (see aggregate_plus_minus_data.prepare_game)
+        and marks it as labelled.
+        """
+
+        os.makedirs(os.path.join(self.directory, 'games'), exist_ok=True)
+        for name, df in [('lineup', lineup), ('pbp', pbp)]:
+            path = self._frame_path(game_id, name)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            df.to_parquet(tmp_path)
+            os.replace(tmp_path, path)
+        self.mark(game_id, 'labelled')
+
+    def load_game(self, game_id: str) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Loads the prepared stints and plays of a labelled game.
+        """
+
+        return pd.read_parquet(self._frame_path(game_id, 'lineup')), pd.read_parquet(self._frame_path(game_id, 'pbp'))
+
+    def counts(self) -> collections.Counter:
+        """
+        Counts games per (status, reason); reasons are only counted for skipped games.
+        """
+
+        return collections.Counter(
+            (entry['status'], entry.get('reason') if entry['status'] == 'skipped' else None)
+            for entry in self.games.values()
+        )
+
+    def reset(self) -> None:
+        """
+        Deletes the checkpoint, to start the run over.
+        """
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.games = {}
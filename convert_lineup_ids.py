@@ -0,0 +1,89 @@
+from aggregate_plus_minus_data import columns, team_columns, add_ratings
+from lineup_keys import lineup_keys, lineup_table, canonical_lineups, home_slots, away_slots
+import pandas as pd
+import glob
+import os
+
+
+def convert_legacy_frame(df: pd.DataFrame, swap_sides: bool = True) -> pd.DataFrame:
+    """
+    Replaces the concatenated-digits lineup IDs of one file of aggregated lineup data by lineup keys.
+
+    The legacy ID is not used: about 3% of them split the ten players into sides of the wrong
+    size, so the same lineup could end up on two rows. Keys are computed from the player slots
+    instead, and rows sharing a key are summed and their ratings recomputed.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Aggregated lineup data of one season, read with the ID column as str.
+    swap_sides : bool, optional
+        Exchange the home and away players. Files written before get_lineups read the
+        GameRotation data sets by name have the away team in the home slots. The score and
+        possession columns were always from the home team's point of view. Default is True.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The converted data, with int64 lineup keys and int32 player slots sorted within each side.
+        Legacy files have no team IDs: they are set to 0.
+    """
+
+    home, away = df[home_slots], df[away_slots]
+    if swap_sides:
+        home, away = away, home
+    home, away = canonical_lineups(home, away)
+
+    df = df.copy()
+    df['ID'] = lineup_keys(home, away)
+    df[home_slots] = home
+    df[away_slots] = away
+    for col in team_columns:
+        if col not in df:
+            df[col] = 0
+
+    aggregations = {col: 'first' for col in home_slots + away_slots + team_columns}
+    aggregations.update({col: 'sum' for col in columns[columns.index('Plus_Off'):]})
+    merged = df.groupby('ID', sort=False).agg(aggregations).reset_index()
+    return add_ratings(merged[columns], df['Season'].iloc[0])
+
+
+def convert_legacy_data(directory: str = 'data', swap_sides: bool = True) -> list:
+    """
+    Converts every data_*.csv file of `directory` that still has legacy lineup IDs, in place.
+    Files are written to a temporary path first and then renamed; converted files are skipped,
+    so an interrupted conversion can simply be run again.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Directory of the aggregated lineup data. Default is 'data'.
+    swap_sides : bool, optional
+        See `convert_legacy_frame`. Default is True.
+
+    Returns
+    -------
+    converted : list of str
+        Paths of the converted files.
+    """
+
+    converted = []
+    for path in sorted(glob.glob(os.path.join(directory, 'data_*.csv'))):
+        df = pd.read_csv(path, dtype={'ID': str})
+        if df.empty or df['ID'].str.len().max() <= 20:
+            continue
+
+        df = convert_legacy_frame(df, swap_sides=swap_sides)
+        lineup_table(df)
+
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
+        converted.append(path)
+    return converted
+
+
+if __name__ == "__main__":
+    # One-time conversion of data/ from the concatenated-digits lineup IDs
+    for path in convert_legacy_data('data'):
+        print(f"Converted {path}")
@@ -0,0 +1,168 @@
+from nba_api.stats.static import players
+from lineup_keys import lineup_table
+from lineup_store import list_parts, load_lineups
+from regression import build_design, data_columns
+import scipy.sparse as sp
+import pandas as pd
+import numpy as np
+import hashlib
+import shutil
+import json
+import os
+
+
+# Bumped whenever build_design or the cache layout changes, so older entries are not reused
+DESIGN_VERSION = 1
+
+# Arrays of a cached design, each stored as {name}.npy
+ARRAYS = ['data', 'indices', 'indptr', 'players', 'mask', 'y', 'w', 'sample_size']
+
+
+def design_key(directory: str = 'data', seasons=None, season_types=None) -> str:
+    """
+    Computes the cache key of the design built from some parts of a lineup store: a hash of their
+    manifest entries and of the size and modification time of their files. Rewriting a part,
+    adding one or changing the selection gives a new key; the parts themselves are not read.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Directory of the lineup store. Default is 'data'.
+    seasons, season_types : list of str, optional
+        Parts to include, see lineup_store.list_parts. Default is all parts.
+
+    Returns
+    -------
+    key : str
+        SHA-256 hex digest.
+    """
+
+    inputs = []
+    for entry in list_parts(directory, seasons, season_types):
+        stat = os.stat(os.path.join(directory, entry['path']))
+        inputs.append([entry, stat.st_size, stat.st_mtime_ns])
+    canonical = json.dumps([DESIGN_VERSION, data_columns, inputs], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def save_design(path: str, design: dict, names: dict = None) -> str:
+    """
+    Writes a design (see regression.build_design) as uncompressed .npy files that can be memory-mapped,
+    with the player names. The files are written to a temporary directory that is then renamed.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the cache entry.
+    design : dict
+        Design as returned by regression.build_design.
+    names : dict, optional
+        Player ID to name. Default is looked up in nba_api's static player list.
+
+    Returns
+    -------
+    path : str
+    """
+
+    X = design['X']
+    if names is None:
+        names = {p['id']: p['full_name'] for p in players.get_players()}
+    arrays = {
+        'data': X.data,
+        'indices': X.indices,
+        'indptr': X.indptr,
+        'players': design['players'].to_numpy(dtype=np.int64),
+        'mask': design['mask'],
+        'y': design['y'],
+        'w': design['w'],
+        'sample_size': design['sample_size'].to_numpy(dtype=np.int64),
+    }
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, f'{name}.npy'), np.ascontiguousarray(array))
+    metadata = {
+        'version': DESIGN_VERSION,
+        'shape': list(X.shape),
+        'names': [names.get(player_id) for player_id in arrays['players'].tolist()],
+    }
+    with open(os.path.join(tmp_path, 'design.json'), 'w', encoding='utf-8') as f:
+        json.dump(metadata, f)
+
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Written concurrently by another run: both are the same design
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return path
+
+
+def load_design(path: str, mmap_mode: str = 'r') -> dict:
+    """
+    Loads a cached design without copying its arrays: X, y and w are backed by the memory-mapped files.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the cache entry.
+    mmap_mode : str or None, optional
+        Passed to numpy.load; None reads the arrays into memory. Default is 'r' (read-only).
+
+    Returns
+    -------
+    design : dict
+        The keys of regression.build_design, and names: pandas.Series of player names indexed
+        by player ID (None where unknown).
+    """
+
+    with open(os.path.join(path, 'design.json'), 'r', encoding='utf-8') as f:
+        metadata = json.load(f)
+    arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode) for name in ARRAYS}
+
+    X = sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(metadata['shape']), copy=False)
+    players_index = pd.Index(np.asarray(arrays['players']))
+    return {
+        'X': X,
+        'players': players_index,
+        'mask': arrays['mask'],
+        'y': arrays['y'],
+        'w': arrays['w'],
+        'sample_size': pd.Series(np.asarray(arrays['sample_size']), index=players_index),
+        'names': pd.Series(metadata['names'], index=players_index, dtype=object),
+    }
+
+
+def cached_design(directory: str = 'data', seasons=None, season_types=None, cache_directory: str = 'design_cache') -> dict:
+    """
+    Returns the design of some parts of the lineup store, built and cached on first use.
+    Later calls with unchanged parts load the cached arrays memory-mapped instead of reading
+    the lineup data, checking lineup keys and building the design again.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Directory of the lineup store. Default is 'data'.
+    seasons, season_types : list of str, optional
+        Parts to include, see lineup_store.list_parts. Default is all parts.
+    cache_directory : str, optional
+        Directory of the cached designs, one subdirectory per key (see `design_key`). Entries of
+        inputs that changed are not deleted. Default is 'design_cache'.
+
+    Returns
+    -------
+    design : dict
+        See `load_design`.
+    """
+
+    path = os.path.join(cache_directory, design_key(directory, seasons, season_types))
+    if not os.path.isfile(os.path.join(path, 'design.json')):
+        df = load_lineups(directory, columns=data_columns, seasons=seasons, season_types=season_types)
+
+        # Lookup table from lineup keys to players; fails on key collisions
+        lineup_table(df)
+
+        os.makedirs(cache_directory, exist_ok=True)
+        save_design(path, build_design(df))
+    return load_design(path)
@@ -0,0 +1,339 @@
+from nba_api.stats.endpoints import GameRotation, PlayByPlayV3
+from nba_api.stats.library.http import NBAStatsHTTP
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+from urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
+from api_cache import load_response
+from metrics import registry
+import requests
+import threading
+import heapq
+import random
+import time
+
+
+# Endpoints requested for every game; their responses end up in the raw response cache
+GAME_ENDPOINTS = (GameRotation, PlayByPlayV3)
+
+# Errors worth retrying later. Anything else (e.g. a CacheMiss in offline mode) fails the game at once.
+RETRYABLE_ERRORS = (requests.exceptions.RequestException, ConnectionError, ValueError)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+
+    Parameters
+    ----------
+    rate : float
+        Tokens added per second, i.e. the sustained request rate.
+    capacity : int, optional
+        Maximum number of tokens, i.e. the largest burst of back-to-back requests. Default is 1.
+    """
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Blocks until a token is available and consumes it.
+        """
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+class _CountingRetry(Retry):
+    """
+    urllib3 Retry counting every transport-level retry in metrics.registry, by status code or error.
+    """
+
+    def increment(self, method=None, url=None, response=None, error=None, *args, **kwargs):
+        reason = str(response.status) if response is not None and response.status else type(error).__name__
+        registry.increment('http_retries_total', reason=reason)
+        return super().increment(method, url, response, error, *args, **kwargs)
+
+
+class _TimeoutSession(requests.Session):
+    """
+    requests.Session injecting a default timeout into every request.
+    """
+
+    def __init__(self, timeout: tuple):
+        super().__init__()
+        self.default_timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.default_timeout
+        return super().request(method, url, **kwargs)
+
+
+def make_session(pool_size: int = 4, timeout: tuple = (5, 60)) -> requests.Session:
+    """
+    Creates a session with a keep-alive connection pool large enough for `pool_size`
+    concurrent requests and transient-error retries at the transport level.
+
+    Parameters
+    ----------
+    pool_size : int, optional
+        Number of pooled connections per host. Default is 4.
+    timeout : tuple, optional
+        Default (connect, read) timeout in seconds. Default is (5, 60).
+
+    Returns
+    -------
+    session : requests.Session
+    """
+
+    session = _TimeoutSession(timeout)
+    retry_strategy = _CountingRetry(
+        total=5,                       # up to 5 attempts
+        backoff_factor=1,              # 1s → 2s → 4s → 8s → 16s
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=False
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry_strategy)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def use_session(session: requests.Session, base_url: str | None = None) -> None:
+    """
+    Makes nba_api send all stats requests through `session`.
+
+    Parameters
+    ----------
+    session : requests.Session
+        Session to use, typically from `make_session`.
+    base_url : str, optional
+        Replaces the stats.nba.com URL template, e.g. with `ReplayServer.base_url`.
+    """
+
+    NBAStatsHTTP.set_session(session)
+    if base_url is not None:
+        NBAStatsHTTP.base_url = base_url
+
+
+def fetch_game(game_id: str) -> str:
+    """
+    Requests every endpoint in GAME_ENDPOINTS for one game. The responses are not returned:
+    with api_cache installed they are written to the raw response cache, from which
+    get_lineups and get_labelled_play_by_play read them afterwards.
+
+    Parameters
+    ----------
+    game_id : str
+        The unique identifier for the NBA game.
+
+    Returns
+    -------
+    game_id : str
+    """
+
+    for endpoint in GAME_ENDPOINTS:
+        endpoint(game_id=game_id)
+    return game_id
+
+
+class FetchScheduler:
+    """
+    Fetches games concurrently and yields them back in their original order.
+
+    Up to `max_in_flight` games are fetched at a time. A game failing with a retryable error
+    is rescheduled after an exponential backoff without blocking a worker, so the rest of the
+    season keeps downloading in the meantime.
+
+    Parameters
+    ----------
+    max_in_flight : int, optional
+        Number of games fetched concurrently. Default is 4.
+    retries : int, optional
+        Number of attempts per game. Default is 3.
+    backoff : float, optional
+        Seconds to wait before the first retry of a game. Default is 60.
+    backoff_factor : float, optional
+        Multiplier applied to the backoff after every failed attempt. Default is 2.
+    fetch : callable, optional
+        Function called with a game ID in a worker thread. Default is `fetch_game`.
+    """
+
+    def __init__(self, max_in_flight: int = 4, retries: int = 3, backoff: float = 60, backoff_factor: float = 2, fetch=fetch_game):
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_factor = backoff_factor
+        self.fetch_function = fetch
+
+    def _fetch_timed(self, game_id: str):
+        with registry.timed('fetch', game_id):
+            return self.fetch_function(game_id)
+
+    def fetch(self, game_ids):
+        """
+        Fetches `game_ids` and yields (game_id, error) tuples in input order, where error is
+        None for games fetched successfully and the last exception otherwise.
+
+        Parameters
+        ----------
+        game_ids : iterable of str
+            Game IDs to fetch.
+
+        Yields
+        ------
+        game_id : str
+        error : Exception or None
+        """
+
+        game_ids = list(game_ids)
+        pending = iter(game_ids)
+        delayed = []                   # heap of (due time, sequence, game_id, attempt)
+        in_flight = {}
+        results = {}
+        next_index = 0
+        sequence = 0
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            while next_index < len(game_ids):
+
+                # Start retries that are due, then new games
+                now = time.monotonic()
+                while delayed and delayed[0][0] <= now and len(in_flight) < self.max_in_flight:
+                    _, _, game_id, attempt = heapq.heappop(delayed)
+                    in_flight[executor.submit(self._fetch_timed, game_id)] = (game_id, attempt)
+                while len(in_flight) < self.max_in_flight:
+                    game_id = next(pending, None)
+                    if game_id is None:
+                        break
+                    in_flight[executor.submit(self._fetch_timed, game_id)] = (game_id, 1)
+
+                # Release finished games in order
+                while next_index < len(game_ids) and game_ids[next_index] in results:
+                    game_id = game_ids[next_index]
+                    yield game_id, results.pop(game_id)
+                    next_index += 1
+                if next_index == len(game_ids):
+                    break
+
+                timeout = max(0, delayed[0][0] - time.monotonic()) if delayed else None
+                if not in_flight:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    game_id, attempt = in_flight.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        results[game_id] = None
+                    elif attempt < self.retries and isinstance(error, RETRYABLE_ERRORS):
+                        delay = self.backoff * self.backoff_factor ** (attempt - 1)
+                        print(f"{type(error).__name__} for game {game_id} on attempt {attempt}/{self.retries}, retrying in {delay:.0f}s…")
+                        registry.increment('fetch_retries_total', reason=type(error).__name__)
+                        sequence += 1
+                        heapq.heappush(delayed, (time.monotonic() + delay, sequence, game_id, attempt + 1))
+                    else:
+                        if error is not None:
+                            registry.increment('fetch_failures_total', reason=type(error).__name__)
+                        results[game_id] = error
+
+
+class ReplayServer:
+    """
+    Local stand-in for stats.nba.com that replays responses from a raw response cache
+    (see api_cache). Requests for responses that are not recorded get a 404.
+
+    Parameters
+    ----------
+    cache_directory : str
+        Directory of recorded responses.
+    port : int, optional
+        Port to listen on. Default is 0 (any free port).
+    latency : float, optional
+        Seconds to wait before answering each request. Default is 0.
+    error_rate : float, optional
+        Fraction of requests answered with a 503, to exercise retries. Default is 0.
+    seed : int, optional
+        Seed for the error injection. Default is 0.
+
+    Examples
+    --------
+    >>> with ReplayServer('cache') as server:
+    ...     use_session(make_session(), base_url=server.base_url)
+    """
+
+    def __init__(self, cache_directory: str, port: int = 0, latency: float = 0, error_rate: float = 0, seed: int = 0):
+        self.cache_directory = cache_directory
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests_served = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        replay = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                endpoint = url.path.rstrip('/').rsplit('/', 1)[-1]
+                parameters = dict(parse_qsl(url.query, keep_blank_values=True))
+                with replay._lock:
+                    replay.requests_served += 1
+                    fail = replay._random.random() < replay.error_rate
+                if replay.latency:
+                    time.sleep(replay.latency)
+
+                contents = None if fail else load_response(replay.cache_directory, endpoint, parameters)
+                status = 503 if fail else (404 if contents is None else 200)
+                body = (contents or '').encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        """
+        URL template to pass to `use_session`.
+        """
+
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/stats/{{endpoint}}'
+
+    def start(self) -> 'ReplayServer':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
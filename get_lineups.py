@@ -1,9 +1,13 @@
 from nba_api.stats.endpoints import GameRotation
+from lineup_keys import lineup_keys
+from metrics import registry
 import pandas as pd
+import numpy as np
 
-def get_lineups(game_id: str, test: bool = False) -> pd.DataFrame:
+
+def get_rotation(game_id: str) -> pd.DataFrame:
     """
-    Extracts all player lineups for a specific NBA game and their starting and ending times.
+    Fetches the rotation (every stint of every player) of a game.
 
     Parameters
     ----------
@@ -13,92 +17,170 @@ def get_lineups(game_id: str, test: bool = False) -> pd.DataFrame:
     Returns
     -------
     DataFrame
-        A DataFrame containing lineup data for the specified game, including player IDs,
-        names, and timestamps indicating when each lineup was on the court.
+        GameRotation data of both teams, with a 'side' column ('Home' or 'Away').
     """
 
-    game_rotation = GameRotation(game_id=game_id).get_data_frames()
-    rotation_home, rotation_away = game_rotation[0], game_rotation[1].copy()
+    game_rotation = GameRotation(game_id=game_id)
+    rotation_home = game_rotation.home_team.get_data_frame()
+    rotation_away = game_rotation.away_team.get_data_frame()
     rotation_home['side'] = 'Home'
     rotation_away['side'] = 'Away'
-    rotation = pd.concat([rotation_home, rotation_away], ignore_index=True)
+    return pd.concat([rotation_home, rotation_away], ignore_index=True)
 
-    if test:
-        rotation.to_csv('lineups.csv')
 
-    rotation.sort_values(['IN_TIME_REAL', 'OUT_TIME_REAL'], kind='mergesort')
+def build_stints(rotation: pd.DataFrame) -> dict:
+    """
+    Reconstructs the on-court lineups of one or many games with a sweep over substitution events.
+
+    A new lineup starts at every time a player checks in; the last lineup of a game ends at the last
+    check-out. Events are sorted once, each player stint is mapped to the range of lineups it covers,
+    and the ten players of every lineup are written into preallocated arrays, in O(n log n) overall.
+
+    Instead of raising, inconsistent rotations are flagged per lineup:
+    - Complete is False if the lineup does not have five players per side.
+    - Sub_Mismatch is True if the numbers of players checking out and in at its start differ,
+      or if a player checks out during the lineup without being replaced.
+
+    Parameters
+    ----------
+    rotation : pandas.DataFrame
+        Rotation data as returned by `get_rotation`. Several games can be concatenated;
+        they are told apart by the GAME_ID column.
+
+    Returns
+    -------
+    stints : dict
+        - game_ids     : numpy.ndarray of game IDs, in order of first appearance.
+        - game         : int array (n,), index into game_ids of each lineup.
+        - Start_Time   : float array (n,).
+        - End_Time     : float array (n,).
+        - Home, Away   : int32 arrays (n, 5) of player IDs in ascending order, 0 where missing.
+        - Complete     : bool array (n,).
+        - Sub_Mismatch : bool array (n,).
+        - Valid        : bool array (n,), Complete and not Sub_Mismatch.
+    """
 
     rotation = rotation[rotation["IN_TIME_REAL"] != rotation["OUT_TIME_REAL"]]
 
-    columns = ["ID", "Start_Time", "End_Time"] + [
-        f"Player_{i}_{team}_{label}"
-        for team in ["Home", "Away"]
-        for i in range(1, 6)
-        for label in ["ID", "Name"]
-    ]
-
-    lineup = pd.DataFrame(columns=columns)
-
-    times = sorted(rotation["IN_TIME_REAL"].unique()) + [
-        rotation["OUT_TIME_REAL"].max()
-    ]
-
-    # Starting lineup
-    current_lineup = rotation[rotation["IN_TIME_REAL"] == times[0]]
-
-    # Changing lineups during game
-    for t in times:
-
-        next_time = times[times.index(t) + 1]
-
-        # Players in lineup
-        player_list = []
-        ids_home = []
-        ids_visiting = []
-        for idx, player in current_lineup.iterrows():
-            player_id = player["PERSON_ID"]
-            player_name = player["PLAYER_FIRST"] + " " + player["PLAYER_LAST"]
-            player_list.extend([player_id, player_name])
-            if player['side'] == 'Home':
-                ids_home.append(player_id)
-            else:
-                ids_visiting.append(player_id)
-
-        ids_home = sorted(ids_home)
-        ids_visiting = sorted(ids_visiting)
-        id_1 = ''.join(str(id) for id in ids_home)
-        id_2 = ''.join(str(id) for id in ids_visiting)
-        id = int(''.join([id_1, id_2]))
-
-        new_row = [id, t, next_time] + player_list
-        if len(new_row) != len(lineup.columns):
-            return None
-        df_row = pd.DataFrame([new_row], columns=lineup.columns)
-
-        if lineup.empty:
-            lineup = df_row
-        else:
-            lineup = pd.concat([lineup, df_row], ignore_index=True)
-
-        if t == times[-2]:
-            break
-
-        # Subbing out
-        subbing_out_mask = current_lineup["OUT_TIME_REAL"] == next_time
-        subbing_out_ids = current_lineup.loc[subbing_out_mask, "PERSON_ID"].tolist()
-
-        # Subbing in
-        subbing_in = rotation[rotation["IN_TIME_REAL"] == next_time]
-        assert len(subbing_out_ids) == len(
-            subbing_in
-        ), f"Sub out/in mismatch at t={next_time}, game_id='{game_id}'"
-
-        # Perform subs
-        current_lineup = current_lineup[
-            ~current_lineup["PERSON_ID"].isin(subbing_out_ids)
-        ]
-        current_lineup = pd.concat([current_lineup, subbing_in], ignore_index=True)
-        assert len(current_lineup) == 10, f"Lineup not complete at t={next_time}"
+    game, game_ids = pd.factorize(rotation["GAME_ID"])
+    time_in = rotation["IN_TIME_REAL"].to_numpy(dtype=float)
+    time_out = rotation["OUT_TIME_REAL"].to_numpy(dtype=float)
+    player = rotation["PERSON_ID"].to_numpy(dtype=np.int32)
+    away = (rotation["side"] != 'Home').to_numpy()
+
+    # Lineup boundaries: every check-in time, plus the last check-out of each game.
+    # Times are made unique across games by offsetting them with the game index.
+    span = max(time_out.max(initial=0), time_in.max(initial=0)) + 1
+    key_in = game * span + time_in
+    key_out = game * span + time_out
+    last_out = pd.Series(key_out).groupby(game).max().to_numpy()
+    boundaries = np.unique(np.concatenate((key_in, last_out)))
+    boundary_game = (boundaries // span).astype(int)
+    is_game_end = np.isin(boundaries, last_out)
+
+    # Each boundary that is not the end of its game starts a lineup
+    lineup_of_boundary = np.cumsum(~is_game_end) - 1
+    n = int((~is_game_end).sum())
+    starts = np.flatnonzero(~is_game_end)
+
+    # Range of lineups covered by every stint: from its check-in up to the first boundary at or after its check-out
+    first = np.searchsorted(boundaries, key_in)
+    last = np.searchsorted(boundaries, key_out, side='left')
+    exact_out = boundaries[np.minimum(last, len(boundaries) - 1)] == key_out
+    first_lineup = lineup_of_boundary[first]
+    covered = last - first
+
+    # Substitution consistency: players out and in at every boundary, and check-outs between boundaries
+    checked_in = np.bincount(first, minlength=len(boundaries))
+    checked_out = np.bincount(last[exact_out], minlength=len(boundaries))
+    first_of_game = np.r_[True, boundary_game[1:] != boundary_game[:-1]]
+    sub_mismatch = (checked_in != checked_out) & ~first_of_game
+    sub_mismatch = sub_mismatch[starts]
+    dangling = lineup_of_boundary[last[~exact_out] - 1]
+    sub_mismatch[dangling] = True
+
+    # Expand stints into (lineup, side, player) entries and sort them
+    entry_lineup = np.repeat(first_lineup - np.cumsum(covered) + covered, covered) + np.arange(covered.sum())
+    entry_away = np.repeat(away, covered)
+    entry_player = np.repeat(player, covered)
+    order = np.lexsort((entry_player, entry_away, entry_lineup))
+    entry_lineup, entry_away, entry_player = entry_lineup[order], entry_away[order], entry_player[order]
+
+    # Slot of every entry within its lineup side
+    group = entry_lineup * 2 + entry_away
+    group_start = np.r_[0, np.flatnonzero(np.diff(group)) + 1]
+    slot = np.arange(len(group)) - np.repeat(group_start, np.diff(np.r_[group_start, len(group)]))
+    counts = np.bincount(group, minlength=2 * n).reshape(n, 2)
+
+    home_ids = np.zeros((n, 5), dtype=np.int32)
+    away_ids = np.zeros((n, 5), dtype=np.int32)
+    fits = slot < 5
+    home_entries = fits & ~entry_away
+    away_entries = fits & entry_away
+    home_ids[entry_lineup[home_entries], slot[home_entries]] = entry_player[home_entries]
+    away_ids[entry_lineup[away_entries], slot[away_entries]] = entry_player[away_entries]
+
+    complete = (counts == 5).all(axis=1)
+    end_index = starts + 1
+
+    return {
+        'game_ids': np.asarray(game_ids),
+        'game': boundary_game[starts],
+        'Start_Time': boundaries[starts] - boundary_game[starts] * span,
+        'End_Time': boundaries[end_index] - boundary_game[starts] * span,
+        'Home': home_ids,
+        'Away': away_ids,
+        'Complete': complete,
+        'Sub_Mismatch': sub_mismatch,
+        'Valid': complete & ~sub_mismatch,
+    }
+
+
+def get_lineups(game_id: str, test: bool = False) -> pd.DataFrame:
+    """
+    Extracts all player lineups for a specific NBA game and their starting and ending times.
+
+    Parameters
+    ----------
+    game_id : str
+        The unique identifier for the NBA game.
+
+    Returns
+    -------
+    DataFrame
+        A DataFrame containing lineup data for the specified game, including player IDs,
+        names, team IDs and timestamps indicating when each lineup was on the court. The ID column
+        is the int64 lineup key (see lineup_keys). The Valid column is False for lineups
+        reconstructed from an inconsistent rotation (see `build_stints`).
+        None if the API returned no rotation.
+    """
+
+    with registry.timed('rotation', game_id):
+        rotation = get_rotation(game_id)
+
+    if test:
+        rotation.to_csv('lineups.csv')
+
+    if rotation.empty:
+        return None
+
+    with registry.timed('stints', game_id):
+        stints = build_stints(rotation)
+        names = dict(zip(rotation["PERSON_ID"], rotation["PLAYER_FIRST"] + " " + rotation["PLAYER_LAST"]))
+        team_ids = rotation.groupby("side")["TEAM_ID"].first()
+
+        lineup = pd.DataFrame({
+            "ID": lineup_keys(stints['Home'], stints['Away']),
+            "Start_Time": stints['Start_Time'],
+            "End_Time": stints['End_Time'],
+        })
+        for team in ["Home", "Away"]:
+            for i in range(1, 6):
+                lineup[f"Player_{i}_{team}_ID"] = stints[team][:, i - 1]
+                lineup[f"Player_{i}_{team}_Name"] = lineup[f"Player_{i}_{team}_ID"].map(names)
+            lineup[f"{team}_Team_ID"] = int(team_ids.get(team, 0))
+        lineup["Valid"] = stints['Valid']
+    registry.increment('rows_total', len(lineup), stage='stints')
 
     return lineup
 
@@ -106,4 +188,3 @@ def get_lineups(game_id: str, test: bool = False) -> pd.DataFrame:
 if __name__ == "__main__":
     lineup = get_lineups(game_id="0022400236", test = True)
     print(lineup)
-
@@ -0,0 +1,371 @@
+from nba_api.stats.endpoints import LeagueGameLog
+from api_cache import install_cache
+from aggregate_plus_minus_data import prepare_game, aggregate_games, add_ratings
+from get_lineups import get_lineups
+from label_play_by_play import get_labelled_play_by_play
+from regression import build_design
+from ridge import weighted_gram, ridge_path
+from lineup_keys import all_slots
+import pandas as pd
+import numpy as np
+import datetime
+import json
+import os
+
+
+def game_statistics(df: pd.DataFrame) -> dict:
+    """
+    Computes the sufficient statistics of one game for the ridge regression.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Lineups of the game aggregated with `aggregate_games` and `add_ratings`.
+
+    Returns
+    -------
+    stats : dict
+        - players     : int array (k,) of the players of the game.
+        - G           : float array (k, k), contribution to X^T W X.
+        - b           : float array (k,), contribution to X^T W y.
+        - yWy         : float, contribution to y^T W y.
+        - n           : int, number of regression rows.
+        - possessions : int array (k,), possessions played per player.
+        - appearances : int array (k,), number of regression rows of every player.
+        - slots, y, w : regression rows (players in `all_slots` order, net rating, weight),
+                        kept to check the running totals against a full refit.
+    """
+
+    design = build_design(df)
+    mask = design['mask']
+    G, b = weighted_gram(design['X'], design['y'], design['w'])
+    return {
+        'players': design['players'].to_numpy(dtype=np.int64),
+        'G': G,
+        'b': b,
+        'yWy': float(design['w'] @ design['y'] ** 2),
+        'n': int(mask.sum()),
+        'possessions': design['sample_size'].to_numpy(dtype=np.int64),
+        'appearances': np.asarray((design['X'] != 0).sum(axis=0), dtype=np.int64).ravel(),
+        'slots': df.loc[mask, all_slots].to_numpy(dtype=np.int32),
+        'y': design['y'],
+        'w': design['w'],
+    }
+
+
+def _save_npz(path: str, **arrays) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def _save_json(path: str, contents) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(contents, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def _load_json(path: str, default):
+    if not os.path.isfile(path):
+        return default
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_game_statistics(directory: str, game_id: str, date: str, season: str, stats: dict) -> None:
+    """
+    Persists the statistics of one game as {directory}/games/{game_id}.npz and records its
+    date and season in {directory}/games.json. Both files are replaced atomically.
+    """
+
+    _save_npz(os.path.join(directory, 'games', f'{game_id}.npz'), **stats)
+    index = _load_json(os.path.join(directory, 'games.json'), {})
+    index[game_id] = {'date': date, 'season': season}
+    _save_json(os.path.join(directory, 'games.json'), index)
+
+
+def load_game_statistics(directory: str, game_id: str) -> dict:
+    """
+    Loads the statistics of one game saved by `save_game_statistics`.
+    """
+
+    with np.load(os.path.join(directory, 'games', f'{game_id}.npz')) as f:
+        stats = {key: f[key] for key in f.files}
+    for key in ['yWy', 'n']:
+        stats[key] = stats[key].item()
+    return stats
+
+
+def stored_games(directory: str) -> dict:
+    """
+    Returns {game_id: {'date': ..., 'season': ...}} for every game in the store.
+    """
+
+    return _load_json(os.path.join(directory, 'games.json'), {})
+
+
+class RunningStatistics:
+    """
+    Running sums of the sufficient statistics of a set of games, over a growing player index.
+
+    Adding a game adds its Gram contribution into the rows and columns of its players;
+    removing it subtracts the same contribution, so the window can slide one game at a time.
+    """
+
+    def __init__(self):
+        self.players = pd.Index([], dtype=np.int64)
+        self.G = np.zeros((0, 0))
+        self.b = np.zeros(0)
+        self.yWy = 0.0
+        self.n = 0
+        self.possessions = np.zeros(0, dtype=np.int64)
+        self.appearances = np.zeros(0, dtype=np.int64)
+        self.game_ids = []
+
+    def _positions(self, players: np.ndarray) -> np.ndarray:
+        new = pd.Index(players).difference(self.players)
+        if len(new):
+            p = len(self.players)
+            self.players = self.players.append(new)
+            G = np.zeros((len(self.players), len(self.players)))
+            G[:p, :p] = self.G
+            self.G = G
+            self.b = np.r_[self.b, np.zeros(len(new))]
+            self.possessions = np.r_[self.possessions, np.zeros(len(new), dtype=np.int64)]
+            self.appearances = np.r_[self.appearances, np.zeros(len(new), dtype=np.int64)]
+        return self.players.get_indexer(players)
+
+    def _apply(self, stats: dict, sign: int) -> None:
+        positions = self._positions(stats['players'])
+        self.G[np.ix_(positions, positions)] += sign * stats['G']
+        self.b[positions] += sign * stats['b']
+        self.yWy += sign * stats['yWy']
+        self.n += sign * stats['n']
+        self.possessions[positions] += sign * stats['possessions']
+        self.appearances[positions] += sign * stats['appearances']
+
+    def add(self, game_id: str, stats: dict) -> None:
+        """
+        Adds the statistics of a game.
+        """
+
+        self._apply(stats, +1)
+        self.game_ids.append(game_id)
+
+    def remove(self, game_id: str, stats: dict) -> None:
+        """
+        Removes the statistics of a game added before.
+        """
+
+        self._apply(stats, -1)
+        self.game_ids.remove(game_id)
+
+    def solve(self, alpha: float) -> pd.Series:
+        """
+        Ridge coefficients of the players who played in the window.
+
+        Parameters
+        ----------
+        alpha : float
+            Penalty.
+
+        Returns
+        -------
+        pandas.Series
+            Coefficient of every player in the regression rows of the window, indexed by player ID.
+        """
+
+        active = self.appearances > 0
+        coef = ridge_path(self.G[np.ix_(active, active)], self.b[active], [alpha])[0]
+        return pd.Series(coef, index=self.players[active])
+
+    def save(self, directory: str) -> None:
+        """
+        Persists the running sums as {directory}/window.npz, atomically.
+        """
+
+        _save_npz(os.path.join(directory, 'window.npz'), players=self.players.to_numpy(dtype=np.int64), G=self.G, b=self.b,
+                  yWy=self.yWy, n=self.n, possessions=self.possessions, appearances=self.appearances, game_ids=np.array(self.game_ids, dtype=str))
+
+    @classmethod
+    def load(cls, directory: str) -> 'RunningStatistics':
+        """
+        Loads the running sums saved by `save`, or returns empty sums if there are none.
+        """
+
+        running = cls()
+        path = os.path.join(directory, 'window.npz')
+        if os.path.isfile(path):
+            with np.load(path) as f:
+                running.players = pd.Index(f['players'])
+                running.G, running.b = f['G'], f['b']
+                running.possessions, running.appearances = f['possessions'], f['appearances']
+                running.yWy, running.n = f['yWy'].item(), f['n'].item()
+                running.game_ids = f['game_ids'].tolist()
+        return running
+
+
+def window_games(games: dict, max_games: int = None, max_days: int = None) -> list:
+    """
+    Selects the games of a rolling window.
+
+    Parameters
+    ----------
+    games : dict
+        {game_id: {'date': 'YYYY-MM-DD', ...}}, see `stored_games`.
+    max_games : int, optional
+        Keep the most recent `max_games` games.
+    max_days : int, optional
+        Keep the games played in the `max_days` days up to the last game.
+
+    Returns
+    -------
+    game_ids : list of str
+        In order of date.
+    """
+
+    ordered = sorted(games, key=lambda game_id: (games[game_id]['date'], game_id))
+    if max_days is not None and ordered:
+        last = datetime.date.fromisoformat(games[ordered[-1]]['date'])
+        first = (last - datetime.timedelta(days=max_days - 1)).isoformat()
+        ordered = [game_id for game_id in ordered if games[game_id]['date'] >= first]
+    if max_games is not None:
+        ordered = ordered[-max_games:] if max_games > 0 else []
+    return ordered
+
+
+def update_window(directory: str, max_games: int = None, max_days: int = None) -> tuple[RunningStatistics, list, list]:
+    """
+    Moves the persisted running sums to the current window: adds the games that entered it and
+    removes those that left it, without touching the games that stay.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the statistics store.
+    max_games, max_days : int, optional
+        Window, see `window_games`. Default is all stored games.
+
+    Returns
+    -------
+    running : RunningStatistics
+        Sums over the window, also saved to the store.
+    added, removed : list of str
+        Games added to and removed from the sums.
+    """
+
+    running = RunningStatistics.load(directory)
+    window = window_games(stored_games(directory), max_games=max_games, max_days=max_days)
+
+    current = set(running.game_ids)
+    removed = [game_id for game_id in running.game_ids if game_id not in set(window)]
+    added = [game_id for game_id in window if game_id not in current]
+    for game_id in removed:
+        running.remove(game_id, load_game_statistics(directory, game_id))
+    for game_id in added:
+        running.add(game_id, load_game_statistics(directory, game_id))
+
+    running.save(directory)
+    return running, added, removed
+
+
+def check_against_refit(directory: str, running: RunningStatistics, alpha: float) -> dict:
+    """
+    Refits the window from the regression rows of its games and compares with the running sums.
+
+    Returns
+    -------
+    report : dict
+        Largest absolute differences of the Gram matrix, of X^T W y and of the coefficients.
+    """
+
+    games = [load_game_statistics(directory, game_id) for game_id in running.game_ids]
+    df = pd.DataFrame(np.vstack([stats['slots'] for stats in games]), columns=all_slots)
+    df['Net_Rating'] = np.concatenate([stats['y'] for stats in games])
+    df['h'] = 1 / np.concatenate([stats['w'] for stats in games])
+    df['Poss_Tot'] = 0
+
+    design = build_design(df)
+    G, b = weighted_gram(design['X'], design['y'], design['w'])
+    refit = pd.Series(ridge_path(G, b, [alpha])[0], index=design['players'])
+
+    positions = running.players.get_indexer(design['players'])
+    incremental = running.solve(alpha)
+    return {
+        'games': len(games),
+        'rows': len(df),
+        'gram': float(np.abs(running.G[np.ix_(positions, positions)] - G).max(initial=0)),
+        'xwy': float(np.abs(running.b[positions] - b).max(initial=0)),
+        'coef': float((incremental.reindex(refit.index) - refit).abs().max()) if len(refit) else 0.0,
+    }
+
+
+def ingest_games(directory: str, season: str, game_log: pd.DataFrame) -> list:
+    """
+    Fetches and stores the statistics of the games of `game_log` that are not in the store yet.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the statistics store.
+    season : str
+        Season of the games.
+    game_log : pandas.DataFrame
+        LeagueGameLog data, with GAME_ID and GAME_DATE columns.
+
+    Returns
+    -------
+    added : list of str
+        Games stored.
+    """
+
+    known = stored_games(directory)
+    dates = game_log.groupby('GAME_ID')['GAME_DATE'].first()
+
+    added = []
+    for game_id, date in dates.items():
+        if game_id in known:
+            continue
+        try:
+            lineup = get_lineups(game_id=game_id)
+            pbp = get_labelled_play_by_play(game_id=game_id)
+            if lineup is None or not lineup['Valid'].all() or pbp is None or isinstance(pbp, str):
+                continue
+            df = add_ratings(aggregate_games([prepare_game(game_id, lineup, pbp)]), season)
+        except Exception as e:
+            print(f"[Stats] {game_id} → {e}")
+            continue
+
+        save_game_statistics(directory, game_id, str(date)[:10], season, game_statistics(df))
+        added.append(game_id)
+    return added
+
+
+if __name__ == "__main__":
+    seasons = ['2024-25']
+    directory = 'stats'
+    cache_directory = 'cache'
+    offline = False  # Replay everything from cache_directory without network access
+    max_games = None  # Rolling window: most recent games…
+    max_days = 365  # …and/or days up to the last game
+    alpha = 10000  # Penalty, e.g. as chosen by regression.py
+
+    install_cache(cache_directory, offline=offline, refresh_endpoints=('leaguegamelog',))
+
+    for season in seasons:
+        game_log = LeagueGameLog(season=season).get_data_frames()[0]
+        added = ingest_games(directory, season, game_log)
+        print(f"{season}: {len(added)} new games")
+
+    running, added, removed = update_window(directory, max_games=max_games, max_days=max_days)
+    print(f"Window: {len(running.game_ids)} games, {len(added)} added, {len(removed)} removed")
+
+    coefficients = running.solve(alpha).sort_values(ascending=False)
+    print(coefficients.head(10))
+
+    report = check_against_refit(directory, running, alpha)
+    print(f"Largest difference with a full refit: {report}")
@@ -0,0 +1,193 @@
+from nba_api.stats.static import players
+from lineup_keys import home_slots, away_slots
+from lineup_store import load_lineups
+from regression import build_design, data_columns
+from ridge import cg_ridge_path, fold_labels
+import scipy.sparse as sp
+import pandas as pd
+import numpy as np
+import itertools
+import os
+
+
+# Positions within a side of the ten pairs of five players
+side_pairs = np.array(list(itertools.combinations(range(5), 2)))
+
+
+def pair_keys(first, second) -> np.ndarray:
+    """
+    Key of unordered pairs of player IDs: the smaller ID in the high 32 bits, the larger in the low ones.
+    """
+
+    first, second = np.asarray(first, dtype=np.int64), np.asarray(second, dtype=np.int64)
+    return np.minimum(first, second) << 32 | np.maximum(first, second)
+
+
+def build_pair_design(df: pd.DataFrame, min_possessions: int = 1000) -> dict:
+    """
+    Builds the APM design of `regression.build_design` extended with same-team pair interactions:
+    every pair of teammates on the floor together for at least `min_possessions` possessions is
+    a column, +1 in the rows where they play at home and -1 where they play away.
+
+    Only observed pairs are indexed, so memory grows with the number of rows and of pairs
+    above the threshold, not with p^2.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Aggregated lineup data with the columns in `regression.data_columns`.
+    min_possessions : int, optional
+        Possessions a pair must have played together (over the lineups with a net rating) to get a
+        column. Default is 1000.
+
+    Returns
+    -------
+    design : dict
+        The keys of `regression.build_design`, with X of shape (n, p + q) (main effects, then pairs), and
+        - pairs : pandas.DataFrame of the q pairs, indexed by `pair_keys`, with Player_1, Player_2
+                  (Player_1 < Player_2) and Possessions.
+    """
+
+    design = build_design(df)
+    mask = design['mask']
+    rated = df['Net_Rating'].notna().to_numpy()
+
+    # (lineups, 20) pair keys: ten home pairs then ten away pairs
+    keys = np.hstack([
+        pair_keys(df[slots].to_numpy()[:, side_pairs[:, 0]], df[slots].to_numpy()[:, side_pairs[:, 1]])
+        for slots in [home_slots, away_slots]
+    ])
+    possessions = pd.Series(np.repeat(df['Poss_Tot'].to_numpy(dtype=np.int64)[rated], keys.shape[1])).groupby(keys[rated].ravel()).sum()
+    kept = possessions[possessions >= min_possessions]
+    pairs = pd.DataFrame({
+        'Player_1': (kept.index.to_numpy() >> 32).astype(np.int64),
+        'Player_2': (kept.index.to_numpy() & 0xFFFFFFFF).astype(np.int64),
+        'Possessions': kept.to_numpy(),
+    }, index=kept.index)
+
+    columns = pairs.index.get_indexer(keys[mask].ravel()).reshape(-1, keys.shape[1])
+    signs = np.tile(np.repeat([1.0, -1.0], len(side_pairs)), (len(columns), 1))
+    rows = np.repeat(np.arange(len(columns)), keys.shape[1]).reshape(columns.shape)
+    observed = columns >= 0
+    X_pairs = sp.csr_matrix((signs[observed], (rows[observed], columns[observed])), shape=(len(columns), len(pairs)))
+
+    design['X'] = sp.hstack([design['X'], X_pairs], format='csr')
+    design['X'].sort_indices()
+    design['pairs'] = pairs
+    return design
+
+
+def fit_interactions(design: dict, alpha: float, pair_alphas=np.logspace(2, 6, 9), cv=5, tol: float = 1e-6) -> dict:
+    """
+    Fits main effects and pair interactions with separate penalties: `alpha` on the players,
+    chosen by cross-validation among `pair_alphas` on the pairs.
+
+    Every training set is solved for the pair penalties from the largest down with the conjugate
+    gradient solver, each solve starting from the previous solution.
+
+    Parameters
+    ----------
+    design : dict
+        Design as returned by `build_pair_design`.
+    alpha : float
+        Penalty of the main effects, e.g. as chosen by regression.py.
+    pair_alphas : array-like, optional
+        Penalties of the pairs to choose from. Default is 9 values from 1e2 to 1e6.
+    cv : int or array-like, optional
+        Number of contiguous folds or fold label of every row. Default is 5.
+    tol : float, optional
+        Tolerance of the solver. Default is 1e-6.
+
+    Returns
+    -------
+    fit : dict
+        - coef       : numpy.ndarray (p + q,), at the chosen pair penalty.
+        - pair_alpha : float, chosen pair penalty.
+        - pair_alphas, scores : penalties and their negative mean squared error.
+    """
+
+    X, y, w = design['X'], design['y'], design['w']
+    p, q = len(design['players']), len(design['pairs'])
+    pair_alphas = np.asarray(pair_alphas, dtype=float)
+    folds = fold_labels(X.shape[0], cv) if np.isscalar(cv) else np.asarray(cv)
+
+    def path(rows):
+        coef, coefs = None, np.zeros((len(pair_alphas), p + q))
+        for i in np.argsort(-pair_alphas, kind='stable'):
+            penalty = np.r_[np.full(p, alpha), np.full(q, pair_alphas[i])]
+            coef = cg_ridge_path(X[rows], y[rows], w[rows], [1.0], penalized=penalty, tol=tol, x0=coef)[0]
+            coefs[i] = coef
+        return coefs
+
+    scores = []
+    for fold in np.unique(folds):
+        test = folds == fold
+        residuals = y[test][:, None] - X[test] @ path(~test).T
+        scores.append(-np.mean(residuals ** 2, axis=0))
+    scores = np.mean(scores, axis=0)
+
+    best = int(np.argmax(scores))
+    penalty = np.r_[np.full(p, alpha), np.full(q, pair_alphas[best])]
+    return {
+        'coef': cg_ridge_path(X, y, w, [1.0], penalized=penalty, tol=tol)[0],
+        'pair_alpha': pair_alphas[best],
+        'pair_alphas': pair_alphas,
+        'scores': scores,
+    }
+
+
+def pair_table(design: dict, fit: dict, names: dict = None) -> pd.DataFrame:
+    """
+    Pair interactions, most synergistic first and most antagonistic last.
+
+    Parameters
+    ----------
+    design : dict
+        Design as returned by `build_pair_design`.
+    fit : dict
+        Fit as returned by `fit_interactions`.
+    names : dict, optional
+        Player ID to name. Default is looked up in nba_api's static player list.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Player_1, Player_2, their names, Synergy (points per 100 possessions the pair adds beyond
+        both players' own coefficients), their Coefficient_1 and Coefficient_2 and Possessions.
+    """
+
+    if names is None:
+        names = {p['id']: p['full_name'] for p in players.get_players()}
+    p = len(design['players'])
+    main = pd.Series(fit['coef'][:p], index=design['players'])
+    table = design['pairs'].reset_index(drop=True)
+    table.insert(2, 'Player_Name_1', [names.get(pid, pid) for pid in table['Player_1']])
+    table.insert(3, 'Player_Name_2', [names.get(pid, pid) for pid in table['Player_2']])
+    table.insert(4, 'Synergy', fit['coef'][p:])
+    table.insert(5, 'Coefficient_1', main.reindex(table['Player_1']).to_numpy())
+    table.insert(6, 'Coefficient_2', main.reindex(table['Player_2']).to_numpy())
+    return table.sort_values('Synergy', ascending=False, ignore_index=True)
+
+
+if __name__ == "__main__":
+    directory = 'data'
+    seasons = ['2022-23', '2023-24', '2024-25']
+    alpha = 10000  # Penalty of the main effects, e.g. as chosen by regression.py
+    min_possessions = 1000  # Possessions a pair must have played together
+
+    df = load_lineups(directory, columns=data_columns, seasons=seasons)
+    design = build_pair_design(df, min_possessions=min_possessions)
+    print(f"{len(design['players'])} players, {len(design['pairs'])} pairs, {design['X'].shape[0]} lineups")
+
+    fit = fit_interactions(design, alpha)
+    print(f"Pair alpha: {fit['pair_alpha']:g}")
+
+    table = pair_table(design, fit)
+    print(table.head(10))
+    print(table.tail(10))
+
+    print("Exporting...")
+    output_path = 'pair_coefficients.csv'
+    tmp_path = f'{output_path}.{os.getpid()}.tmp'
+    table.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, output_path)
@@ -1,51 +1,32 @@
 from nba_api.stats.endpoints import PlayByPlayV3
-from nba_api.stats.endpoints import boxscoretraditionalv2
+from metrics import registry
 import pandas as pd
 import numpy as np
 import re
 
 
-def get_team_player_dict(game_id: str) -> tuple[dict, list]:
+def get_game_teams(pbp: pd.DataFrame) -> tuple[dict, list]:
     """
-    Builds a mapping of player last names to their team abbreviations and returns the list of teams in the game.
+    Maps the players of a game to their team and lists its teams, from the PlayByPlayV3 data itself.
 
     Parameters
     ----------
-    game_id : str
-        The unique identifier for the NBA game.
+    pbp : pandas.DataFrame
+        Play-by-play data as returned by PlayByPlayV3.
 
     Returns
     -------
-    team_player_dict : dict
-        Keys are player last names (str), values are team abbreviations (str).
+    player_teams : dict
+        Keys are the IDs (int) of the players with at least one action, values their team abbreviation (str).
     teams : list of str
-        List of unique team abbreviations participating in the game.
+        Team abbreviations appearing in the plays, in order of first appearance.
     """
 
-    boxscore = boxscoretraditionalv2.BoxScoreTraditionalV2(game_id=game_id).get_data_frames()[0]
-    if boxscore.empty:
-        return None, None
-    boxscore['LAST_NAME'] = [
-        full_name.replace(nickname, '').strip()
-        for full_name, nickname in zip(
-            boxscore['PLAYER_NAME'],
-            boxscore['NICKNAME']
-        )
-    ]
-    team_player_dict = {}
-    teams = []
-    for idx, player in boxscore.iterrows():
-        if player['MIN'] == None:
-            continue
-
-        last_name = player['LAST_NAME']
-        team = player['TEAM_ABBREVIATION']
-        team_player_dict[last_name] = team
-
-        if team not in teams:
-            teams.append(team)
-
-    return team_player_dict, teams
+    team_plays = pbp[pbp['teamTricode'].fillna('') != '']
+    player_plays = team_plays[team_plays['personId'] != 0]
+    player_teams = dict(zip(player_plays['personId'], player_plays['teamTricode']))
+    teams = list(pd.unique(team_plays['teamTricode']))
+    return player_teams, teams
 
 
 def find_next_play(idx: int, actionNumber: int, plays: pd.DataFrame, reverse: bool = False) -> tuple[pd.Series, int]:
@@ -145,43 +126,33 @@ def get_other_value(value: str, list: list) -> str:
     return list[0] if value == list[1] else list[1]
 
 
-def get_labelled_play_by_play(game_id: str, test: bool=False) -> pd.DataFrame:
+PERIOD_RE = re.compile(r"(Start|End) of (\d)(st|nd|rd|th) (Period|OT).*")
+
+# Plays passed over when looking for the next/previous valid play (see find_next_play)
+SKIPPED_ACTIONS = ('Substitution', 'Timeout', 'Violation')
+SKIPPED_FOULS = ('Double Personal', 'Technical', 'Too Many Players Technical', 'Double Technical')
+OFFENSIVE_FOULS = ('Offensive Charge', 'Offensive')
+
+
+def prepare_play_by_play(pbp: pd.DataFrame) -> tuple[pd.DataFrame, dict, dict]:
     """
-    Fetches play-by-play data for a game, annotates new possessions, and labels each play with possession information.
+    Adds game time and forward-filled scores to raw PlayByPlayV3 data and selects the columns used for labeling.
 
     Parameters
     ----------
-    game_id : str
-        The unique identifier for the NBA game.
+    pbp : pandas.DataFrame
+        Play-by-play data as returned by PlayByPlayV3.
 
     Returns
     -------
     plays : pandas.DataFrame
-        Original play-by-play data with additional columns:
-        - newPossession  : bool
-            True if the play starts a new possession.
-        - possession     : str
-            Team tricode of the team in possession.
-        - possessionCount: int
-            Cumulative count of possessions up to each play.
+        Play-by-play data with the columns needed by `label_possessions`.
+    tricode_to_loc_dict : dict
+        Maps team tricode to location ('h'/'v').
+    loc_to_tricode_dict : dict
+        Maps location ('h'/'v') to team tricode.
     """
 
-
-    PERIOD_RE = re.compile(r"(Start|End) of (\d)(st|nd|rd|th) (Period|OT).*")
-
-    team_player_dict, teams = get_team_player_dict(game_id=game_id)
-
-    if teams is None or len(teams) == 0:
-        return 'Nobody played'
-
-    if team_player_dict is None and teams is None:
-        return None
-
-    # Call Play by Play
-    pbp = PlayByPlayV3(game_id=game_id).get_data_frames()[0]
-    if test:
-        pbp.to_csv("play_by_play.csv", index=False)
-
     # Get team tricode dictionary and team_location_dictionary
     team_tricodes = pbp['teamTricode'].unique()[1:]
     loc_0 = pbp[pbp['teamTricode'] == team_tricodes[0]]['location'].unique()[0]
@@ -206,143 +177,322 @@ def get_labelled_play_by_play(game_id: str, test: bool=False) -> pd.DataFrame:
 
     # Create new dataframe with needed columns
     plays = pbp[['actionNumber', 'teamId', 'scoreHome', 'scoreAway', 'description', 'actionType', 'subType', 'time', 'location']].copy()
-    plays['newPossession'] = False
-    plays['possession'] = None
-    tipoff_ready = True
-
-    # Determine new possessions
-    for idx, row in plays.iterrows():
-        actionType = row['actionType']
-        subType = row['subType']
-        actionNumber = row['actionNumber']
-        location = row['location']
-        description = row['description']
-
-        # Made Shot
-        match actionType:
-            case 'Made Shot':
-
-                next_play, next_idx = find_next_play(idx, actionNumber, plays)
-                if next_play is None and next_idx is None:
-                    continue
-
-                # And 1 play
-                if (next_play['actionType'] == 'Foul') and (next_play['subType'] == 'Shooting') and (next_play['location'] != location):
-                    continue
-
-                # Regular basket made
-                plays.at[idx + 1, 'newPossession'] = True
-
-            # Turnover
-            case 'Turnover':
-                plays.at[idx + 1, 'newPossession'] = True
-
-            # Missed Shot
-            case 'Missed Shot':
-
-                next_play, next_idx = find_next_play(idx, actionNumber, plays)
-                if next_play is None and next_idx is None:
-                    continue
-
-                assert next_play['actionType'] == 'Rebound', f"Next play {next_play['actionType']} is not a rebound (row {idx})"
-                
-                if location != next_play['location']:
-                    plays.at[next_idx, 'newPossession'] = True
-
-            # Free Throw
-            case 'Free Throw':
-
-                next_play, next_idx = find_next_play(idx, actionNumber, plays)
-                if next_play is None and next_idx is None:
-                    continue
-
-                if next_play['actionType'] == 'period':
-                    continue
-
-                next_play_team_poss = determine_play_possession(next_play)
-                
-                if location != next_play_team_poss:
-                    plays.at[next_idx, 'newPossession'] = True
-
-            # Jump Ball
-            case 'Jump Ball':
-
-                last_play, last_idx = find_next_play(idx, actionNumber, plays, reverse = True)
-                if last_play is None and last_idx is None:
-                    continue
-
-                # Jump ball at new period
-                if last_play['actionType'] == 'period':
-
-                    # Who got the ball (NEW based on next play)
-                    next_play, next_idx = find_next_play(idx, actionNumber, plays)
-                    if next_play is None and next_idx is None:
-                        continue
-                    
-                    next_play_team_poss = determine_play_possession(next_play)
-                    team = loc_to_tricode_dict[next_play_team_poss]
-
-                    plays.at[idx, 'newPossession'] = True
-                    plays.at[idx, 'possession'] = team
-
-                    # Save tipoff winner
-                    if tipoff_ready:
-                        tipoff_ready = False
-                        initial_tip = team
-
-            # Period
-            case 'period':
-                if subType == 'start':
-                    m = PERIOD_RE.search(description)
-                    assert m, f"No period found in description: {description}"
-                    period = int(m.group(2))
-                    quarter_type = m.group(4)
-
-                    if quarter_type == 'Period':
-                        if tipoff_ready:
-                            initial_tip = loc_to_tricode_dict[plays.at[1, 'location']]
-                            plays.at[2, 'possession'] = initial_tip
-
-                        if period in (2, 3):
-                            plays.at[idx, 'newPossession'] = True
-                            plays.at[idx, 'possession'] = get_other_value(initial_tip, teams)
-
-                        if period == 4:
-                            plays.at[idx, 'newPossession'] = True
-                            plays.at[idx, 'possession'] = initial_tip 
-
-                    # Rewrites any newPossession = True that could be carried over from previous plays
-                    elif quarter_type == 'OT':
-                            plays.at[idx, 'newPossession'] = False
-
-
-    # Label possessions by team
-    for idx, row in plays.iterrows():
-        possession_end = row['newPossession']
-        actionType = row['actionType']
-        subType = row['subType']
-        description = row['description']
-        possession = row['possession']
-
-        if idx == 0:
-            continue
-
-        if possession is None:
-            last_possession = plays.at[idx - 1, 'possession']
-            if possession_end:
-                plays.at[idx, 'possession'] = get_other_value(last_possession, teams)
-            else:
-                plays.at[idx, 'possession'] = last_possession
 
+    return plays, tricode_to_loc_dict, loc_to_tricode_dict
+
+
+def find_valid_plays(rows: np.ndarray, valid: np.ndarray, action_numbers: np.ndarray, first: np.ndarray, last: np.ndarray, reverse: bool = False) -> np.ndarray:
+    """
+    Vectorized `find_next_play`: finds the next (or previous) valid play for many rows at once.
+
+    Parameters
+    ----------
+    rows : numpy.ndarray
+        Positions of the current plays.
+    valid : numpy.ndarray
+        Sorted positions of all plays that are not skipped by action type.
+    action_numbers : numpy.ndarray
+        Action number of every play; plays sharing the current action number are skipped too.
+    first, last : numpy.ndarray
+        First and one-past-last position of the game of each row in `rows`.
+    reverse : bool, optional
+        If True, search backward; otherwise, search forward. Default is False.
+
+    Returns
+    -------
+    found : numpy.ndarray
+        Positions of the next (previous) valid plays.
+
+    Raises
+    ------
+    KeyError
+        If the search runs past the start or end of a game.
+    """
+
+    if reverse:
+        padded = np.concatenate(([-1], valid))
+        step = lambda r: padded[np.searchsorted(valid, r, side='left')]
+    else:
+        padded = np.concatenate((valid, [len(action_numbers)]))
+        step = lambda r: padded[np.searchsorted(valid, r, side='right')]
+
+    found = step(rows)
+    while True:
+        inside = (found >= first) & (found < last)
+        duplicate = np.zeros(len(rows), dtype=bool)
+        duplicate[inside] = action_numbers[found[inside]] == action_numbers[rows[inside]]
+        if not duplicate.any():
+            break
+        found[duplicate] = step(found[duplicate])
+
+    if not inside.all():
+        row = rows[~inside][0]
+        raise KeyError(f"No {'previous' if reverse else 'next'} valid play for row {row - first[~inside][0]}")
+
+    return found
+
+
+def label_games(games: dict) -> pd.DataFrame:
+    """
+    Labels the possessions of many games at once, on NumPy arrays over all of their plays concatenated.
+
+    Produces the same labels as the original row-by-row implementation (see check_labelling.py):
+    "next valid play" and "previous valid play" positions are looked up for all relevant plays in one
+    pass, possession changes are set from those, and possessions are propagated between the plays
+    that set them explicitly with a cumulative count of possession changes.
+
+    Parameters
+    ----------
+    games : dict
+        Maps game ID to a tuple (plays, teams, loc_to_tricode_dict), where plays is returned by
+        `prepare_play_by_play` and teams by `get_game_teams`.
+
+    Returns
+    -------
+    plays : pandas.DataFrame
+        All plays, with a leading 'gameId' column and the columns added by `label_possessions`.
+
+    Raises
+    ------
+    AssertionError, KeyError
+        In the cases where the row-by-row implementation fails (e.g. a missed shot not followed by a rebound).
+    """
+
+    game_ids = list(games)
+    frames = [games[game_id][0] for game_id in game_ids]
+    lengths = np.array([len(frame) for frame in frames])
+    last = np.cumsum(lengths)
+    first = last - lengths
+    plays = pd.concat(frames, ignore_index=True)
+    n = len(plays)
+    game = np.repeat(np.arange(len(game_ids)), lengths)
+
+    action = plays['actionType'].to_numpy(dtype=object)
+    sub = plays['subType'].to_numpy(dtype=object)
+    action_numbers = plays['actionNumber'].to_numpy()
+    locations, location_names = pd.factorize(plays['location'])
+    location_names = list(location_names)
+    loc_h = location_names.index('h') if 'h' in location_names else -2
+    loc_v = location_names.index('v') if 'v' in location_names else -2
+
+    # Team codes: 0 and 1 stand for teams[0] and teams[1] of each game
+    team_names = np.empty((len(game_ids), 2), dtype=object)
+    team_locations = np.full((len(game_ids), 2), np.nan, dtype=object)
+    team_of_location = np.full((len(game_ids), len(location_names) + 1), -1)
+    for g, game_id in enumerate(game_ids):
+        _, teams, loc_to_tricode_dict = games[game_id]
+        assert len(teams) == 2, f"List must contain exactly two values (contains {len(teams)} values)"
+        team_names[g] = teams
+        for loc, tricode in loc_to_tricode_dict.items():
+            assert tricode in teams, f"Value ({tricode}) must be present in list ({teams})"
+            team_locations[g, teams.index(tricode)] = loc
+            if loc in location_names:
+                team_of_location[g, location_names.index(loc)] = teams.index(tricode)
+
+    def possession_after(rows):
+        # Vectorized determine_play_possession, as a location code
+        loc = locations[rows]
+        other = ((action[rows] == 'Foul') & ~np.isin(sub[rows], OFFENSIVE_FOULS)) | (action[rows] == 'Violation')
+        assert not (other & (loc != loc_h) & (loc != loc_v)).any(), "Value must be present in list (['h', 'v'])"
+        return np.where(other, np.where(loc == loc_h, loc_v, loc_h), loc)
+
+    def team_at(rows, loc):
+        team = team_of_location[game[rows], loc]
+        if (team < 0).any():
+            raise KeyError(location_names[loc[team < 0][0]] if loc[team < 0][0] >= 0 else '')
+        return team
+
+    skipped = np.isin(action, SKIPPED_ACTIONS) | ((action == 'Foul') & np.isin(sub, SKIPPED_FOULS))
+    valid = np.flatnonzero(~skipped)
+
+    def next_play(rows, reverse=False):
+        return find_valid_plays(rows, valid, action_numbers, first[game[rows]], last[game[rows]], reverse=reverse)
+
+    new_possession = np.zeros(n, dtype=bool)
+    possession = np.full(n, -1)
+
+    # Made Shot: new possession on the following row, unless the shooter was fouled (and 1)
+    rows = np.flatnonzero(action == 'Made Shot')
+    following = next_play(rows)
+    and_one = (action[following] == 'Foul') & (sub[following] == 'Shooting') & (locations[following] != locations[rows])
+    targets = rows[~and_one] + 1
+    new_possession[targets[targets < last[game[targets - 1]]]] = True
+
+    # Turnover
+    targets = np.flatnonzero(action == 'Turnover') + 1
+    new_possession[targets[targets < last[game[targets - 1]]]] = True
+
+    # Missed Shot: new possession on a defensive rebound
+    rows = np.flatnonzero(action == 'Missed Shot')
+    following = next_play(rows)
+    not_rebound = np.flatnonzero(action[following] != 'Rebound')
+    assert len(not_rebound) == 0, f"Next play {action[following[not_rebound[0]]]} is not a rebound (row {rows[not_rebound[0]] - first[game[rows[not_rebound[0]]]]})"
+    new_possession[following[locations[rows] != locations[following]]] = True
+
+    # Free Throw: new possession if the other team has the ball on the next play
+    rows = np.flatnonzero(action == 'Free Throw')
+    following = next_play(rows)
+    keep = action[following] != 'period'
+    rows, following = rows[keep], following[keep]
+    new_possession[following[locations[rows] != possession_after(following)]] = True
+
+    # Jump Ball at the start of a period
+    rows = np.flatnonzero(action == 'Jump Ball')
+    previous = next_play(rows, reverse=True)
+    jump_balls = rows[action[previous] == 'period']
+    jump_teams = team_at(jump_balls, possession_after(next_play(jump_balls)))
+    new_possession[jump_balls] = True
+    possession[jump_balls] = jump_teams
+
+    # Tipoff winner: set by the first jump ball at a period start of each game
+    tipoff = np.full(len(game_ids), n)
+    tipoff_team = np.full(len(game_ids), -1)
+    jump_games = game[jump_balls]
+    is_first = np.r_[True, jump_games[1:] != jump_games[:-1]] if len(jump_balls) else np.zeros(0, dtype=bool)
+    tipoff[jump_games[is_first]] = jump_balls[is_first]
+    tipoff_team[jump_games[is_first]] = jump_teams[is_first]
+
+    # Period
+    rows = np.flatnonzero((action == 'period') & (sub == 'start'))
+    period_info = plays['description'].iloc[rows].str.extract(PERIOD_RE)
+    no_period = np.flatnonzero(period_info[1].isna())
+    assert len(no_period) == 0, f"No period found in description: {plays['description'].iat[rows[no_period[0]]]}"
+    period = period_info[1].astype(int).to_numpy()
+    quarter_type = period_info[3].to_numpy(dtype=object)
+
+    # Before the tipoff jump ball, the tipoff winner is taken from the location of the second row
+    regular = rows[quarter_type == 'Period']
+    regular_period = period[quarter_type == 'Period']
+    before_tipoff = regular < tipoff[game[regular]]
+    initial_tip = np.where(before_tipoff, -1, tipoff_team[game[regular]])
+    if before_tipoff.any():
+        row_1 = first[game[regular[before_tipoff]]] + 1
+        if (row_1 >= last[game[regular[before_tipoff]]]).any():
+            raise KeyError(1)
+        initial_tip[before_tipoff] = team_at(row_1, locations[row_1])
+
+    starts = np.isin(regular_period, (2, 3, 4))
+    new_possession[regular[starts]] = True
+    possession[regular[starts]] = np.where(regular_period[starts] == 4, initial_tip[starts], 1 - initial_tip[starts])
+
+    # Possession of the third row of each game, overwritten at every period start before the tipoff
+    ready = regular[before_tipoff]
+    if len(ready):
+        ready_games, last_ready = np.unique(game[ready][::-1], return_index=True)
+        last_ready = ready[::-1][last_ready]
+        row_2 = first[ready_games] + 2
+        keep = row_2 < last[ready_games]
+        row_2, last_ready, ready_games = row_2[keep], last_ready[keep], ready_games[keep]
+        overwrite = (last_ready > row_2) | (possession[row_2] == -1)
+        possession[row_2[overwrite]] = initial_tip[np.searchsorted(regular, last_ready[overwrite])]
+
+    # Overtime starts never start a new possession
+    new_possession[rows[quarter_type == 'OT']] = False
+
+    # Label possessions by team: carry the last explicit possession forward, switching at every new possession
+    anchor = possession != -1
+    anchor[first[lengths > 0]] = True
+    switches = np.cumsum(new_possession & ~anchor)
+    anchor_row = np.maximum.accumulate(np.where(anchor, np.arange(n), 0))
+    switched = switches - switches[anchor_row]
+    anchor_team = possession[anchor_row]
+    assert not ((anchor_team == -1) & (switched > 0)).any(), "Value (None) must be present in list"
+    team = np.where(anchor, possession, np.where(switched % 2 == 1, 1 - anchor_team, anchor_team))
+
+    labelled = np.full(n, None, dtype=object)
+    labelled_loc = np.full(n, np.nan, dtype=object)
+    has_team = team != -1
+    labelled[has_team] = team_names[game[has_team], team[has_team]]
+    labelled_loc[has_team] = team_locations[game[has_team], team[has_team]]
+
+    plays.insert(0, 'gameId', np.repeat(np.array(game_ids, dtype=object), lengths))
+    plays['newPossession'] = new_possession
+    plays['possession'] = labelled
 
     # Label possession count
-    plays['possessionCount'] = plays['newPossession'].cumsum()
-    plays['possessionLoc'] = plays['possession'].map(tricode_to_loc_dict)
-    home_poss_mask = plays['possessionLoc'] == 'h'
-    plays['possessionH'] = plays['newPossession'].where(home_poss_mask, 0).cumsum()
-    plays['possessionV'] = plays['newPossession'].where(~home_poss_mask, 0).cumsum()
+    plays['possessionLoc'] = labelled_loc
+    home_poss_mask = labelled_loc == 'h'
+    plays['possessionCount'] = pd.Series(new_possession).groupby(game).cumsum().to_numpy()
+    plays['possessionH'] = pd.Series(new_possession & home_poss_mask).groupby(game).cumsum().to_numpy()
+    plays['possessionV'] = pd.Series(new_possession & ~home_poss_mask).groupby(game).cumsum().to_numpy()
+
+    return plays[['gameId'] + list(frames[0].columns) + ['newPossession', 'possession', 'possessionCount', 'possessionLoc', 'possessionH', 'possessionV']]
+
+
+def label_possessions(plays: pd.DataFrame, teams: list, loc_to_tricode_dict: dict) -> pd.DataFrame:
+    """
+    Labels each play of a single game with possession information (see `label_games`).
+
+    Parameters
+    ----------
+    plays : pandas.DataFrame
+        Play-by-play data as returned by `prepare_play_by_play`.
+    teams : list of str
+        List of unique team abbreviations participating in the game.
+    loc_to_tricode_dict : dict
+        Maps location ('h'/'v') to team tricode.
+
+    Returns
+    -------
+    plays : pandas.DataFrame
+        `plays` with additional columns newPossession, possession, possessionCount, possessionLoc,
+        possessionH and possessionV.
+    """
+
+    labelled = label_games({None: (plays, teams, loc_to_tricode_dict)}).drop(columns='gameId')
+    labelled.index = plays.index
+
+    # Same dtypes as the cumulative sums in the row-by-row implementation
+    home_poss_mask = labelled['possessionLoc'] == 'h'
+    labelled['possessionCount'] = labelled['newPossession'].cumsum()
+    labelled['possessionH'] = labelled['newPossession'].where(home_poss_mask, 0).cumsum()
+    labelled['possessionV'] = labelled['newPossession'].where(~home_poss_mask, 0).cumsum()
+
+    return labelled
+
+
+def get_labelled_play_by_play(game_id: str, test: bool=False) -> pd.DataFrame:
+    """
+    Fetches play-by-play data for a game, annotates new possessions, and labels each play with possession information.
+
+    Parameters
+    ----------
+    game_id : str
+        The unique identifier for the NBA game.
+
+    Returns
+    -------
+    plays : pandas.DataFrame
+        Original play-by-play data with additional columns:
+        - newPossession  : bool
+            True if the play starts a new possession.
+        - possession     : str
+            Team tricode of the team in possession.
+        - possessionCount: int
+            Cumulative count of possessions up to each play.
+        None if the API returned no plays, 'Nobody played' if no player has a play.
+    """
+
+    # Call Play by Play
+    with registry.timed('pbp', game_id):
+        pbp = PlayByPlayV3(game_id=game_id).get_data_frames()[0]
+    if test:
+        pbp.to_csv("play_by_play.csv", index=False)
+
+    if pbp.empty:
+        return None
+
+    # Teams and players are taken from the plays, so no box score is needed
+    player_teams, teams = get_game_teams(pbp)
+    if len(player_teams) == 0:
+        return 'Nobody played'
+
+    with registry.timed('labelling', game_id):
+        plays, tricode_to_loc_dict, loc_to_tricode_dict = prepare_play_by_play(pbp)
+        labelled = label_possessions(plays, teams, loc_to_tricode_dict)
+    registry.increment('rows_total', len(labelled), stage='labelling')
 
-    return plays
+    return labelled
 
 if __name__ == "__main__":
     one = get_labelled_play_by_play(game_id="0022300062", test=False)
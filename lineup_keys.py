@@ -0,0 +1,122 @@
+import pandas as pd
+import numpy as np
+
+
+# Player slots of the aggregated lineup data, home side first
+home_slots = [f'P{i}H' for i in range(1, 6)]
+away_slots = [f'P{i}V' for i in range(1, 6)]
+all_slots = home_slots + away_slots
+
+_SEED = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    """
+    splitmix64 finalizer: scrambles every bit of a uint64 array into every other bit.
+    """
+
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def canonical_lineups(home, away) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Sorts the players of each side of many lineups.
+
+    Parameters
+    ----------
+    home, away : array-like (n, 5)
+        Player IDs of the home and away side of every lineup, in any order.
+
+    Returns
+    -------
+    home, away : numpy.ndarray
+        int32 arrays (n, 5), with the players of every side in ascending order.
+    """
+
+    home = np.sort(np.asarray(home, dtype=np.int32), axis=1)
+    away = np.sort(np.asarray(away, dtype=np.int32), axis=1)
+    return home, away
+
+
+def lineup_keys(home, away) -> np.ndarray:
+    """
+    Computes the lineup key of many lineups: a 64-bit hash of the sorted player IDs of both sides.
+
+    The key does not depend on the order of the players within a side, but does depend on
+    the side they are on. With about a million distinct lineups the probability of a collision
+    is below 1e-7; `lineup_table` checks for them anyway.
+
+    Parameters
+    ----------
+    home, away : array-like (n, 5)
+        Player IDs of the home and away side of every lineup, in any order.
+
+    Returns
+    -------
+    keys : numpy.ndarray
+        int64 array (n,).
+    """
+
+    home, away = canonical_lineups(home, away)
+    keys = np.full(len(home), _SEED, dtype=np.uint64)
+    for column in np.hstack((home, away)).T:
+        keys = _mix(keys ^ column.astype(np.uint64))
+    return keys.view(np.int64)
+
+
+def lineup_table(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Builds the lookup table from lineup keys back to the ten players.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Aggregated lineup data, with the ID column and the player slots in `all_slots`.
+        Several seasons can be concatenated.
+
+    Returns
+    -------
+    table : pandas.DataFrame
+        One row per lineup key, indexed by ID, with the player slots as int32 columns
+        in ascending order within each side.
+
+    Raises
+    ------
+    ValueError
+        If two different lineups share a key, or a key does not match its players.
+    """
+
+    home, away = canonical_lineups(df[home_slots], df[away_slots])
+    table = pd.DataFrame(np.hstack((home, away)), columns=all_slots)
+    table.insert(0, 'ID', df['ID'].to_numpy(dtype=np.int64))
+    table = table.drop_duplicates()
+    if table['ID'].duplicated().any():
+        raise ValueError(f"Lineup key collision for IDs {table.loc[table['ID'].duplicated(), 'ID'].unique().tolist()}")
+    if (lineup_keys(table[home_slots], table[away_slots]) != table['ID'].to_numpy()).any():
+        raise ValueError("Lineup keys do not match their players, convert the data with convert_lineup_ids.py")
+    return table.set_index('ID')
+
+
+def lineup_players(keys, table: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Looks up the players of many lineup keys.
+
+    Parameters
+    ----------
+    keys : array-like (n,)
+        Lineup keys.
+    table : pandas.DataFrame
+        Lookup table as returned by `lineup_table`.
+
+    Returns
+    -------
+    home, away : numpy.ndarray
+        int32 arrays (n, 5) of player IDs.
+    """
+
+    players = table.loc[np.asarray(keys, dtype=np.int64), all_slots].to_numpy(dtype=np.int32)
+    return players[:, :5], players[:, 5:]
@@ -0,0 +1,381 @@
+from nba_api.stats.static import teams
+from lineup_keys import all_slots
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pandas as pd
+import numpy as np
+import hashlib
+import json
+import glob
+import re
+import os
+
+
+MANIFEST = 'manifest.json'
+
+REGULAR_SEASON = 'Regular Season'
+
+# Schema of every part of the lineup store
+schema = pa.schema(
+    [('ID', pa.int64())]
+    + [(slot, pa.int32()) for slot in all_slots]
+    + [('Home_Team_ID', pa.int64()), ('Away_Team_ID', pa.int64())]
+    + [(col, pa.int32()) for col in ['Plus_Off', 'Minus_Def', 'Plus/Minus', 'Home_Poss_Off', 'Home_Poss_Def', 'Poss_Tot']]
+    + [('Time', pa.float64())]
+    + [(col, pa.float64()) for col in ['Off_Rating', 'Def_Rating', 'Net_Rating', 'h']]
+    + [('Season', pa.string())]
+)
+
+
+def part_name(part: int, season_type: str = REGULAR_SEASON) -> str:
+    """
+    Returns the name of a part: part-{part:03d} for the regular season, prefixed with the season
+    type otherwise, e.g. playoffs-part-001.
+    """
+
+    name = f'part-{part:03d}'
+    if season_type != REGULAR_SEASON:
+        name = f"{season_type.lower().replace(' ', '')}-{name}"
+    return name
+
+
+def part_path(season: str, part: int, season_type: str = REGULAR_SEASON) -> str:
+    """
+    Returns the path of a part relative to the store directory: season={season}/{part_name}.parquet
+    """
+
+    return os.path.join(f'season={season}', f'{part_name(part, season_type)}.parquet')
+
+
+def _part_key(entry: dict) -> tuple:
+    # Parts written before season types were stored are regular-season parts
+    return entry['season'], entry.get('season_type', REGULAR_SEASON), entry['part']
+
+
+def read_manifest(directory: str) -> dict:
+    """
+    Reads the manifest of a lineup store.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the lineup store.
+
+    Returns
+    -------
+    manifest : dict
+        {'parts': [...]} with one entry per part, sorted by season, season type and part. Each
+        entry has the keys season, season_type, part, path (relative to `directory`), rows and
+        game_ids (None if unknown).
+        An empty manifest if the store does not exist yet.
+    """
+
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.isfile(path):
+        return {'parts': []}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_manifest(directory: str, manifest: dict) -> None:
+    manifest['parts'].sort(key=_part_key)
+    path = os.path.join(directory, MANIFEST)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def write_part(directory: str, season: str, part: int, df: pd.DataFrame, game_ids=None, season_type: str = REGULAR_SEASON) -> str:
+    """
+    Writes one part of aggregated lineup data to the store and records it in the manifest.
+    An existing part with the same season, season type and number is replaced.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the lineup store.
+    season : str
+        Season of the part, e.g. '2022-23'.
+    part : int
+        Number of the part within the season.
+    df : pandas.DataFrame
+        Aggregated lineup data with the columns of `schema`.
+    game_ids : list of str, optional
+        Games aggregated into the part.
+    season_type : str, optional
+        'Regular Season', 'Playoffs', 'PlayIn'... Default is 'Regular Season'.
+
+    Returns
+    -------
+    path : str
+        Path of the written part.
+
+    Raises
+    ------
+    pyarrow.ArrowInvalid
+        If a column cannot be converted to its type in `schema` without loss.
+    """
+
+    table = pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+
+    relative_path = part_path(season, part, season_type)
+    path = os.path.join(directory, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    pq.write_table(table, tmp_path, compression='zstd')
+    os.replace(tmp_path, path)
+
+    _record_parts(directory, [{
+        'season': season,
+        'season_type': season_type,
+        'part': part,
+        'path': relative_path.replace(os.sep, '/'),
+        'rows': table.num_rows,
+        'game_ids': None if game_ids is None else [str(game_id) for game_id in game_ids],
+    }])
+    return path
+
+
+def _record_parts(directory: str, entries: list) -> None:
+    # Adds entries to the manifest, replacing those of the same parts
+    keys = {_part_key(entry) for entry in entries}
+    manifest = read_manifest(directory)
+    manifest['parts'] = [entry for entry in manifest['parts'] if _part_key(entry) not in keys] + entries
+    _write_manifest(directory, manifest)
+
+
+def merge_store(source: str, directory: str) -> list:
+    """
+    Moves every part of the store in `source` into the store in `directory`, replacing parts with
+    the same season, season type and number, and deletes the manifest of `source`.
+
+    Parts are moved first and recorded in the manifest of `directory` afterwards, so a merge that
+    was interrupted can simply be run again.
+
+    Parameters
+    ----------
+    source : str
+        Directory of the store to merge, e.g. written by one shard of a backfill.
+    directory : str
+        Directory of the destination store.
+
+    Returns
+    -------
+    merged : list of dict
+        Manifest entries of the merged parts.
+    """
+
+    entries = read_manifest(source)['parts']
+    for entry in entries:
+        source_path = os.path.join(source, entry['path'])
+        path = os.path.join(directory, entry['path'])
+        if os.path.isfile(source_path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(source_path, path)
+        elif not os.path.isfile(path):
+            raise FileNotFoundError(f"Part {entry['path']} is in the manifest of {source} but in neither store")
+
+    if entries:
+        _record_parts(directory, entries)
+    if os.path.isfile(os.path.join(source, MANIFEST)):
+        os.remove(os.path.join(source, MANIFEST))
+    return entries
+
+
+def list_parts(directory: str, seasons=None, season_types=None) -> list:
+    """
+    Lists the parts of the store, optionally for some seasons or season types only.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the lineup store.
+    seasons : list of str, optional
+        Seasons to keep. Default is all seasons.
+    season_types : list of str, optional
+        Season types to keep, e.g. ['Regular Season']. Default is all season types.
+
+    Returns
+    -------
+    parts : list of dict
+        Manifest entries, see `read_manifest`.
+
+    Raises
+    ------
+    FileNotFoundError
+        If a part listed in the manifest is missing.
+    """
+
+    parts = read_manifest(directory)['parts']
+    if seasons is not None:
+        parts = [entry for entry in parts if entry['season'] in set(seasons)]
+    if season_types is not None:
+        parts = [entry for entry in parts if entry.get('season_type', REGULAR_SEASON) in set(season_types)]
+    for entry in parts:
+        if not os.path.isfile(os.path.join(directory, entry['path'])):
+            raise FileNotFoundError(f"Part {entry['part']} of season {entry['season']} is in the manifest but not in {directory}")
+    return parts
+
+
+def team_id(team) -> int:
+    """
+    Resolves a team abbreviation (e.g. 'BOS') to its team ID. Team IDs are returned unchanged.
+    """
+
+    if isinstance(team, str) and not team.isdigit():
+        found = teams.find_team_by_abbreviation(team)
+        if found is None:
+            raise ValueError(f"Unknown team {team}")
+        return found['id']
+    return int(team)
+
+
+def load_lineups(directory: str = 'data', columns=None, seasons=None, min_possessions=None, team=None, season_types=None) -> pd.DataFrame:
+    """
+    Loads aggregated lineup data from the store.
+
+    Only the parts of the requested seasons are opened and only the requested columns are read.
+    The possession and team filters are pushed down to the Parquet reader, which skips row
+    groups whose statistics rule them out.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Directory of the lineup store. Default is 'data'.
+    columns : list of str, optional
+        Columns to read. Default is all columns.
+    seasons : list of str, optional
+        Seasons to read, e.g. ['2022-23', '2023-24']. Default is all seasons.
+    min_possessions : int, optional
+        Keep only lineups with at least this many possessions (Poss_Tot).
+    team : int or str, optional
+        Keep only lineups of this team, at home or away, given by team ID or abbreviation.
+        Parts converted from files without team IDs have none and are filtered out.
+    season_types : list of str, optional
+        Season types to read, e.g. ['Regular Season', 'Playoffs']. Default is all season types.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Lineup data with the dtypes of `schema`, in manifest order.
+    """
+
+    dataset, condition = _scan(directory, seasons, season_types, min_possessions, team)
+    if dataset is None:
+        return schema.empty_table().select(columns or schema.names).to_pandas()
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+
+def _scan(directory: str, seasons=None, season_types=None, min_possessions=None, team=None) -> tuple:
+    # Dataset of the selected parts and filter expression, or (None, None) without parts
+    parts = list_parts(directory, seasons, season_types)
+    if not parts:
+        return None, None
+
+    dataset = ds.dataset([os.path.join(directory, entry['path']) for entry in parts], schema=schema, format='parquet')
+
+    conditions = []
+    if min_possessions is not None:
+        conditions.append(ds.field('Poss_Tot') >= min_possessions)
+    if team is not None:
+        team = team_id(team)
+        conditions.append((ds.field('Home_Team_ID') == team) | (ds.field('Away_Team_ID') == team))
+    condition = None
+    for c in conditions:
+        condition = c if condition is None else condition & c
+    return dataset, condition
+
+
+def iter_lineups(directory: str = 'data', columns=None, seasons=None, season_types=None, batch_size: int = 100_000,
+                 float_dtype=np.float32, min_possessions=None, team=None):
+    """
+    Reads aggregated lineup data from the store in chunks of at most `batch_size` rows, so that
+    memory does not grow with the number of parts read.
+
+    Player IDs are int32 in the store; floating-point columns (ratings, h, time) are downcast to
+    `float_dtype`.
+
+    Parameters
+    ----------
+    directory, columns, seasons, season_types, min_possessions, team
+        See `load_lineups`.
+    batch_size : int, optional
+        Maximum number of rows per chunk. Default is 100000.
+    float_dtype : numpy dtype, optional
+        Type of the floating-point columns. Default is float32.
+
+    Yields
+    ------
+    pandas.DataFrame
+        Chunks in manifest order.
+    """
+
+    dataset, condition = _scan(directory, seasons, season_types, min_possessions, team)
+    if dataset is None:
+        return
+    for batch in dataset.to_batches(columns=columns, filter=condition, batch_size=batch_size):
+        if batch.num_rows == 0:
+            continue
+        df = batch.to_pandas()
+        floats = df.select_dtypes('float').columns
+        if len(floats):
+            df = df.astype({col: float_dtype for col in floats})
+        yield df
+
+
+def import_csv_data(directory: str = 'data') -> list:
+    """
+    Imports the data_{season}_{part}.csv files of aggregated lineup data into the store in `directory`.
+    Files still holding concatenated-digits lineup IDs must be converted with convert_lineup_ids.py first.
+    A file identical to a later part of the same season is skipped: in some seasons the last
+    part was also written under the number of the part before it.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Directory of the CSV files and of the store. Default is 'data'.
+
+    Returns
+    -------
+    imported : list of str
+        Paths of the imported CSV files.
+    """
+
+    files = []
+    for path in glob.glob(os.path.join(directory, 'data_*.csv')):
+        match = re.fullmatch(r'data_(.+)_(\d+)\.csv', os.path.basename(path))
+        if match:
+            files.append((match.group(1), int(match.group(2)), path))
+
+    imported = []
+    digests = {}
+    for season, part, path in sorted(files, reverse=True):
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        if (season, digest) in digests:
+            print(f"Skipping {path}: identical to {digests[season, digest]}")
+            continue
+        digests[season, digest] = path
+
+        df = pd.read_csv(path, dtype={'ID': str}, float_precision='round_trip')
+        if df['ID'].str.len().max() > 20:
+            raise ValueError(f"{path} has legacy lineup IDs, convert it with convert_lineup_ids.py first")
+        df['ID'] = df['ID'].astype('int64')
+        for col in ['Home_Team_ID', 'Away_Team_ID']:
+            if col not in df:
+                df[col] = 0
+
+        write_part(directory, season, part, df)
+        imported.append(path)
+    return imported
+
+
+if __name__ == "__main__":
+    # One-time import of the CSV parts written before the store existed
+    for path in import_csv_data('data'):
+        print(f"Imported {path}")
+
+    for entry in list_parts('data'):
+        print(f"{entry['season']} part {entry['part']}: {entry['rows']} lineups")
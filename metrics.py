@@ -0,0 +1,278 @@
+from contextlib import contextmanager
+import threading
+import resource
+import bisect
+import json
+import time
+import os
+
+
+# Upper bounds in seconds of the latency and stage duration histograms
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of the calling process, in MiB.
+    """
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+class Metrics:
+    """
+    Thread-safe registry of the measurements of an ingestion run: histograms (stage durations,
+    endpoint latencies), counters (retries, rows) and the wall time of every stage of every game.
+
+    Worker processes have their own registry: they hand its contents back with `collect` and the
+    parent adds them to its own with `merge`, so the parent ends up with the whole run.
+
+    Histograms and counters are keyed by a name and labels, as in Prometheus.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self) -> None:
+        self.histograms = {}       # (name, labels) -> {'buckets': [...], 'sum': float, 'count': int}
+        self.counters = {}         # (name, labels) -> float
+        self.games = {}            # game ID -> {stage: seconds}
+        self.peak_rss = {}         # process ID -> peak RSS in MiB
+
+    def reset(self) -> None:
+        """
+        Discards every measurement.
+        """
+
+        with self._lock:
+            self._clear()
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """
+        Adds a value to a histogram.
+        """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * (len(BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+            histogram['buckets'][bisect.bisect_left(BUCKETS, value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        """
+        Adds a value to a counter.
+        """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def record_game(self, game_id: str, stage: str, seconds: float) -> None:
+        """
+        Adds to the wall time of a stage of a game, and to the stage duration histogram.
+        """
+
+        self.observe('stage_seconds', seconds, stage=stage)
+        with self._lock:
+            stages = self.games.setdefault(str(game_id), {})
+            stages[stage] = stages.get(stage, 0) + seconds
+
+    @contextmanager
+    def timed(self, stage: str, game_id: str = None):
+        """
+        Measures the wall time of a block as a stage, of a game if `game_id` is given.
+
+        Examples
+        --------
+        >>> with registry.timed('lineups', game_id):
+        ...     lineup = get_lineups(game_id)
+        """
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            if game_id is None:
+                self.observe('stage_seconds', seconds, stage=stage)
+            else:
+                self.record_game(game_id, stage, seconds)
+
+    def collect(self) -> dict:
+        """
+        Returns the measurements of this process, with its peak RSS, in a picklable form and
+        discards them, so that measurements are handed to the parent process only once.
+        """
+
+        with self._lock:
+            snapshot = {
+                'histograms': self.histograms,
+                'counters': self.counters,
+                'games': self.games,
+                'peak_rss': {**self.peak_rss, os.getpid(): peak_rss_mb()},
+            }
+            self._clear()
+        return snapshot
+
+    def merge(self, snapshot: dict) -> None:
+        """
+        Adds measurements returned by `collect` (usually in another process) to this registry.
+        """
+
+        with self._lock:
+            for key, histogram in snapshot['histograms'].items():
+                total = self.histograms.setdefault(key, {'buckets': [0] * (len(BUCKETS) + 1), 'sum': 0.0, 'count': 0})
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], histogram['buckets'])]
+                total['sum'] += histogram['sum']
+                total['count'] += histogram['count']
+            for key, value in snapshot['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for game_id, stages in snapshot['games'].items():
+                total = self.games.setdefault(game_id, {})
+                for stage, seconds in stages.items():
+                    total[stage] = total.get(stage, 0) + seconds
+            for pid, rss in snapshot['peak_rss'].items():
+                self.peak_rss[pid] = max(self.peak_rss.get(pid, 0), rss)
+
+    def report(self, wall_seconds: float = None) -> dict:
+        """
+        Summarizes the run in a JSON-serializable dict.
+
+        Parameters
+        ----------
+        wall_seconds : float, optional
+            Wall time of the whole run, to compute games per second.
+
+        Returns
+        -------
+        report : dict
+            - wall_seconds : as given.
+            - games        : number of games with a measured stage.
+            - stages       : {stage: {count, seconds, mean, rows, rows_per_second}} over all games.
+            - endpoints    : {endpoint: {source: latency histogram}}, source being 'network' or 'cache'.
+            - counters     : {name: {labels: value}}, e.g. retries by reason.
+            - peak_rss_mb  : {'max': ..., 'processes': {pid: MiB}}.
+            - per_game     : {game_id: {stage: seconds}}.
+        """
+
+        with self._lock:
+            histograms = dict(self.histograms)
+            counters = dict(self.counters)
+            games = {game_id: dict(stages) for game_id, stages in self.games.items()}
+            peak_rss = {**self.peak_rss, os.getpid(): peak_rss_mb()}
+
+        def labels_string(labels):
+            return ','.join(f'{k}={v}' for k, v in labels) or 'total'
+
+        rows = {dict(labels).get('stage'): value for (name, labels), value in counters.items() if name == 'rows_total'}
+        stages = {}
+        endpoints = {}
+        for (name, labels), histogram in sorted(histograms.items()):
+            labels = dict(labels)
+            summary = {
+                'count': histogram['count'],
+                'seconds': histogram['sum'],
+                'mean': histogram['sum'] / histogram['count'] if histogram['count'] else None,
+                'buckets': dict(zip([str(bound) for bound in BUCKETS] + ['+Inf'], histogram['buckets'])),
+            }
+            if name == 'stage_seconds':
+                stage_rows = rows.get(labels['stage'])
+                summary['rows'] = stage_rows
+                summary['rows_per_second'] = stage_rows / histogram['sum'] if stage_rows and histogram['sum'] > 0 else None
+                stages[labels['stage']] = summary
+            elif name == 'endpoint_seconds':
+                endpoints.setdefault(labels['endpoint'], {})[labels['source']] = summary
+
+        counter_report = {}
+        for (name, labels), value in sorted(counters.items()):
+            counter_report.setdefault(name, {})[labels_string(labels)] = value
+
+        return {
+            'wall_seconds': wall_seconds,
+            'games': len(games),
+            'games_per_second': len(games) / wall_seconds if wall_seconds else None,
+            'stages': stages,
+            'endpoints': endpoints,
+            'counters': counter_report,
+            'peak_rss_mb': {'max': max(peak_rss.values()), 'processes': {str(pid): rss for pid, rss in peak_rss.items()}},
+            'per_game': games,
+        }
+
+    def prometheus(self) -> str:
+        """
+        Renders the histograms, counters and peak RSS in the Prometheus text exposition format,
+        with metric names prefixed by apm_.
+        """
+
+        with self._lock:
+            histograms = dict(self.histograms)
+            counters = dict(self.counters)
+            peak_rss = {**self.peak_rss, os.getpid(): peak_rss_mb()}
+
+        def labels_string(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+        lines = []
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f'# TYPE apm_{name} histogram')
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip([str(bound) for bound in BUCKETS] + ['+Inf'], histogram['buckets']):
+                    cumulative += count
+                    lines.append(f'apm_{name}_bucket{labels_string(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'apm_{name}_sum{labels_string(labels)} {histogram["sum"]}')
+                lines.append(f'apm_{name}_count{labels_string(labels)} {histogram["count"]}')
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f'# TYPE apm_{name} counter')
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f'apm_{name}{labels_string(labels)} {value}')
+        lines.append('# TYPE apm_peak_rss_mebibytes gauge')
+        for pid, rss in sorted(peak_rss.items()):
+            lines.append(f'apm_peak_rss_mebibytes{{pid="{pid}"}} {rss}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str, wall_seconds: float = None) -> tuple[str, str]:
+        """
+        Writes the run report to {path}.json and {path}.prom.
+
+        Returns
+        -------
+        json_path, prometheus_path : str
+        """
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        paths = (f'{path}.json', f'{path}.prom')
+        contents = (json.dumps(self.report(wall_seconds), indent=1), self.prometheus())
+        for output_path, text in zip(paths, contents):
+            tmp_path = f'{output_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, output_path)
+        return paths
+
+
+# Registry of the current process
+registry = Metrics()
+
+
+def init_worker(initializer=None, *initargs) -> None:
+    """
+    Process pool initializer: empties the registry a forked worker inherits from its parent,
+    so that `collect` only returns the worker's own measurements, then calls `initializer`.
+    """
+
+    registry.reset()
+    if initializer is not None:
+        initializer(*initargs)
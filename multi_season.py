@@ -0,0 +1,350 @@
+from nba_api.stats.static import players
+from design_cache import design_key
+from incremental_rapm import game_statistics, stored_games, load_game_statistics, RunningStatistics
+from lineup_store import load_lineups
+from regression import data_columns, coefficient_table
+from ridge import ridge_path, ridge_covariance
+import pandas as pd
+import numpy as np
+import itertools
+import json
+import os
+
+
+# Statistics kept for every block, see incremental_rapm.game_statistics
+BLOCK_ARRAYS = ['players', 'G', 'b', 'possessions', 'appearances']
+BLOCK_SCALARS = ['yWy', 'n', 'weight']
+
+
+def _block(stats: dict, weight: float) -> dict:
+    block = {key: stats[key] for key in BLOCK_ARRAYS + ['yWy', 'n']}
+    block['weight'] = float(weight)
+    return block
+
+
+def season_blocks(directory: str = 'data', seasons=None, season_types=None, cache_directory: str = 'block_cache') -> dict:
+    """
+    Computes the normal-equation terms of every season of the lineup store separately, so that
+    seasons can be combined with any weights without going back to the lineups.
+
+    Blocks are cached in {cache_directory}/{key}.npz, with the key of design_cache.design_key: they
+    are only computed again when the selected parts of the store change.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Directory of the lineup store. Default is 'data'.
+    seasons, season_types : list of str, optional
+        Parts to include, see lineup_store.list_parts. Default is all parts.
+    cache_directory : str or None, optional
+        Directory of the cached blocks; None disables the cache. Default is 'block_cache'.
+
+    Returns
+    -------
+    blocks : dict
+        - unit    : 'season'.
+        - periods : list of str, seasons in chronological order.
+        - blocks  : list of dict, statistics of every season over its own players: players, G, b,
+                    possessions, appearances (see incremental_rapm.game_statistics), yWy, n and
+                    weight (sum of the regression weights).
+    """
+
+    path = None
+    if cache_directory is not None:
+        path = os.path.join(cache_directory, f'{design_key(directory, seasons, season_types)}.npz')
+        if os.path.isfile(path):
+            return load_blocks(path)
+
+    df = load_lineups(directory, columns=data_columns + ['Season'], seasons=seasons, season_types=season_types)
+    periods = sorted(df['Season'].unique())
+    blocks = []
+    for season in periods:
+        stats = game_statistics(df[df['Season'] == season].reset_index(drop=True))
+        blocks.append(_block(stats, stats['w'].sum()))
+
+    result = {'unit': 'season', 'periods': periods, 'blocks': blocks}
+    if path is not None:
+        save_blocks(path, result)
+    return result
+
+
+def stored_blocks(directory: str = 'stats', unit: str = 'month') -> dict:
+    """
+    Sums the per-game statistics of the incremental_rapm store by month or by season.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Directory of the statistics store. Default is 'stats'.
+    unit : str, optional
+        'month' (by game date) or 'season'. Default is 'month'.
+
+    Returns
+    -------
+    blocks : dict
+        See `season_blocks`; periods are 'YYYY-MM' months or seasons.
+    """
+
+    if unit not in ('month', 'season'):
+        raise ValueError(f"Unknown unit {unit}")
+    games = stored_games(directory)
+    periods = {}
+    for game_id, entry in games.items():
+        period = entry['date'][:7] if unit == 'month' else entry['season']
+        periods.setdefault(period, []).append(game_id)
+
+    blocks = []
+    for period in sorted(periods):
+        running = RunningStatistics()
+        weight = 0.0
+        for game_id in sorted(periods[period]):
+            stats = load_game_statistics(directory, game_id)
+            running.add(game_id, stats)
+            weight += stats['w'].sum()
+        stats = {key: getattr(running, key) for key in ['G', 'b', 'possessions', 'appearances', 'yWy', 'n']}
+        stats['players'] = running.players.to_numpy(dtype=np.int64)
+        blocks.append(_block(stats, weight))
+    return {'unit': unit, 'periods': sorted(periods), 'blocks': blocks}
+
+
+def save_blocks(path: str, blocks: dict) -> None:
+    """
+    Writes blocks (see `season_blocks`) to a .npz file, atomically.
+    """
+
+    arrays = {}
+    for i, block in enumerate(blocks['blocks']):
+        for key in BLOCK_ARRAYS + BLOCK_SCALARS:
+            arrays[f'{i}_{key}'] = block[key]
+    arrays['header'] = np.array(json.dumps({'unit': blocks['unit'], 'periods': blocks['periods']}))
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_blocks(path: str) -> dict:
+    """
+    Loads blocks saved by `save_blocks`.
+    """
+
+    with np.load(path) as f:
+        header = json.loads(f['header'].item())
+        blocks = []
+        for i in range(len(header['periods'])):
+            block = {key: f[f'{i}_{key}'] for key in BLOCK_ARRAYS}
+            block.update({key: f[f'{i}_{key}'].item() for key in BLOCK_SCALARS})
+            blocks.append(block)
+    return {'unit': header['unit'], 'periods': header['periods'], 'blocks': blocks}
+
+
+def period_ages(blocks: dict, last: str = None) -> np.ndarray:
+    """
+    Age of every period relative to `last` (default the most recent), in seasons or months.
+    Periods after `last` have a negative age.
+    """
+
+    def ordinal(period):
+        year, rest = int(period[:4]), period[5:]
+        return year * 12 + int(rest) - 1 if blocks['unit'] == 'month' else year
+
+    ordinals = np.array([ordinal(period) for period in blocks['periods']])
+    reference = ordinal(last) if last is not None else ordinals.max()
+    return reference - ordinals
+
+
+def decay_weights(blocks: dict, half_life: float = None, last: str = None) -> np.ndarray:
+    """
+    Exponential time-decay weight of every period: 0.5 ** (age / half_life), ages from `period_ages`.
+    Periods after `last` get a weight of zero.
+
+    Parameters
+    ----------
+    blocks : dict
+        See `season_blocks`.
+    half_life : float, optional
+        Age, in seasons or months, at which a period counts half. None weights all periods equally.
+    last : str, optional
+        Most recent period of the fit. Default is the last period of `blocks`.
+
+    Returns
+    -------
+    weights : numpy.ndarray (k,)
+    """
+
+    ages = period_ages(blocks, last)
+    weights = np.ones(len(ages)) if half_life is None else 0.5 ** (ages / half_life)
+    return np.where(ages >= 0, weights, 0.0)
+
+
+def combine_blocks(blocks: dict, weights, players: pd.Index = None) -> dict:
+    """
+    Weighted sum of the normal-equation terms of the blocks, over the players of the blocks
+    with a positive weight (or over `players`).
+
+    Multiplying the regression weights of a period by c multiplies its G, b, yWy and weight by c,
+    so this is the design of all periods with row weights scaled by period, without building it.
+
+    Returns
+    -------
+    combined : dict
+        - players     : pandas.Index of the p player IDs.
+        - G, b        : numpy.ndarray (p, p) and (p,), weighted X^T W X and X^T W y.
+        - yWy, weight : float, weighted y^T W y and sum of the regression weights.
+        - n           : int, number of regression rows with a positive weight.
+        - possessions : int array (p,), possessions played, unweighted.
+    """
+
+    weights = np.asarray(weights, dtype=float)
+    used = [(block, c) for block, c in zip(blocks['blocks'], weights) if c > 0]
+    if players is None:
+        players = pd.Index(pd.unique(np.concatenate([block['players'] for block, _ in used] or [np.zeros(0, dtype=np.int64)])))
+
+    p = len(players)
+    combined = {'players': players, 'G': np.zeros((p, p)), 'b': np.zeros(p), 'yWy': 0.0, 'weight': 0.0, 'n': 0,
+                'possessions': np.zeros(p, dtype=np.int64)}
+    for block, c in used:
+        positions = players.get_indexer(block['players'])
+        known = positions >= 0
+        positions = positions[known]
+        combined['G'][np.ix_(positions, positions)] += c * block['G'][np.ix_(known, known)]
+        combined['b'][positions] += c * block['b'][known]
+        combined['yWy'] += c * block['yWy']
+        combined['weight'] += c * block['weight']
+        combined['n'] += block['n']
+        combined['possessions'][positions] += block['possessions'][known]
+    return combined
+
+
+def prior_vector(prior: pd.Series, players: pd.Index) -> np.ndarray:
+    """
+    Aligns prior coefficients on a player index; players without a prior are shrunk toward zero.
+    """
+
+    if prior is None:
+        return None
+    return prior.reindex(players).fillna(0).to_numpy(dtype=float)
+
+
+def read_prior(path: str = 'player_coefficients.csv') -> pd.Series:
+    """
+    Reads coefficients exported by regression.py or this module, e.g. last season's, to use as a prior.
+    Files written before Player_ID was exported are matched to IDs by player name, and players
+    whose name is not found are left out (shrunk toward zero).
+
+    Returns
+    -------
+    pandas.Series
+        Coefficient indexed by player ID, without the intercept.
+    """
+
+    df = pd.read_csv(path)
+    if 'Player_ID' not in df.columns:
+        ids = {p['full_name']: p['id'] for p in players.get_players()}
+        df.insert(0, 'Player_ID', df['Player_Name'].map(ids))
+    df = df[df['Player_ID'].notna() & (df['Player_Name'] != 'Intercept')].drop_duplicates('Player_ID')
+    return pd.Series(df['Coefficient'].to_numpy(dtype=float), index=df['Player_ID'].astype(np.int64))
+
+
+def holdout_error(combined: dict, coef: np.ndarray) -> float:
+    """
+    Weighted mean squared error of coefficients on the rows of combined blocks, from their
+    normal-equation terms: (y^T W y - 2 coef^T X^T W y + coef^T X^T W X coef) / sum(w).
+    """
+
+    rss = combined['yWy'] - 2 * coef @ combined['b'] + coef @ combined['G'] @ coef
+    return float(rss / combined['weight'])
+
+
+def sweep(blocks: dict, half_lives, alphas, priors: dict = None, holdout: int = 1) -> pd.DataFrame:
+    """
+    Scores every combination of decay, penalty and prior by fitting on all periods but the last
+    `holdout` ones and predicting those.
+
+    Each half-life needs one weighted sum of the blocks and one eigendecomposition, shared by all
+    penalties and priors, so a grid costs a few p x p operations per combination.
+
+    Parameters
+    ----------
+    blocks : dict
+        See `season_blocks`.
+    half_lives : list
+        Half-lives of `decay_weights`, None for equal weights.
+    alphas : array-like
+        Penalties.
+    priors : dict, optional
+        {name: pandas.Series of coefficients indexed by player ID, or None for zero}.
+        Default is {'zero': None}.
+    holdout : int, optional
+        Number of most recent periods held out. Default is 1.
+
+    Returns
+    -------
+    pandas.DataFrame
+        half_life, prior, alpha and mse (weighted mean squared error on the held-out periods),
+        best first.
+    """
+
+    priors = priors or {'zero': None}
+    if not 0 < holdout < len(blocks['periods']):
+        raise ValueError(f"Cannot hold out {holdout} of {len(blocks['periods'])} periods")
+    last_fitted = blocks['periods'][-holdout - 1]
+    # Players of the held-out periods only have their prior (or zero) as coefficient
+    players = pd.Index(pd.unique(np.concatenate([block['players'] for block in blocks['blocks']])))
+    test = combine_blocks(blocks, (period_ages(blocks, last_fitted) < 0).astype(float), players=players)
+
+    rows = []
+    for half_life in half_lives:
+        train = combine_blocks(blocks, decay_weights(blocks, half_life, last=last_fitted), players=players)
+        eigh = np.linalg.eigh(train['G'])
+        for (name, prior), alpha in itertools.product(priors.items(), alphas):
+            coef = ridge_path(train['G'], train['b'], [alpha], prior=prior_vector(prior, players), eigh=eigh)[0]
+            rows.append({'half_life': half_life, 'prior': name, 'alpha': alpha, 'mse': holdout_error(test, coef)})
+    return pd.DataFrame(rows).sort_values('mse', ignore_index=True)
+
+
+def fit(blocks: dict, half_life: float = None, alpha: float = 1000, prior: pd.Series = None, covariance: str = 'sandwich') -> dict:
+    """
+    Fits the ridge regression on all periods, weighted by `decay_weights` and shrunk toward `prior`.
+
+    Returns
+    -------
+    fit : dict
+        - estimates   : pandas.DataFrame of Coefficient and Std_Error indexed by player ID,
+                        see regression.player_estimates.
+        - sample_size : pandas.Series of possessions played per player.
+    """
+
+    combined = combine_blocks(blocks, decay_weights(blocks, half_life))
+    result = ridge_covariance(combined['G'], combined['b'], combined['yWy'], combined['n'], alpha,
+                              covariance=covariance, prior=prior_vector(prior, combined['players']))
+    return {
+        'estimates': pd.DataFrame({'Coefficient': result['coef'], 'Std_Error': result['se']}, index=combined['players']),
+        'sample_size': pd.Series(combined['possessions'], index=combined['players']),
+    }
+
+
+if __name__ == "__main__":
+    directory = 'data'
+    seasons = ['2022-23', '2023-24', '2024-25']
+    half_lives = [None, 0.5, 1, 2, 4]  # In seasons
+    alphas = np.logspace(1, 4, 13)
+    prior_path = None  # e.g. last season's player_coefficients.csv, to shrink toward it
+
+    blocks = season_blocks(directory, seasons=seasons)
+    priors = {'zero': None}
+    if prior_path is not None:
+        prior = read_prior(prior_path)
+        priors.update({'prior': prior, 'half prior': prior / 2})
+
+    scores = sweep(blocks, half_lives, alphas, priors=priors)
+    print(scores.head(10))
+
+    best = scores.iloc[0]
+    half_life = None if pd.isna(best['half_life']) else best['half_life']
+    result = fit(blocks, half_life, best['alpha'], priors[best['prior']])
+
+    print("Exporting...")
+    coefficient_table(result['estimates'], result['sample_size']).to_csv('player_coefficients_multi_season.csv', index=False)
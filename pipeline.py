@@ -0,0 +1,168 @@
+from concurrent.futures import ProcessPoolExecutor, Future
+from api_cache import install_cache
+import multiprocessing
+import contextlib
+from metrics import registry, init_worker
+import collections
+import threading
+import queue
+
+
+# Marks the end of the fetched games in the fetch queue
+_DONE = object()
+
+
+def install_offline_cache(cache_directory: str) -> None:
+    """
+    Process pool initializer: workers read the responses fetched by the I/O stage from the raw
+    response cache and never send requests themselves.
+    """
+
+    install_cache(cache_directory, offline=True)
+
+
+def _process_and_collect(process, game_id: str) -> tuple:
+    # Runs in a worker process: hands the measurements of the game back with its result
+    return process(game_id), registry.collect()
+
+
+class GamePipeline:
+    """
+    Staged ingestion of a list of games:
+
+    1. I/O stage: a thread runs the fetch scheduler, which downloads the raw responses of each
+       game into the response cache, and puts the fetched games on a bounded queue.
+    2. CPU stage: a process pool runs `process` (labeling and lineup reconstruction) on each
+       fetched game, reading its responses from the cache. The pool starts its workers from a
+       forkserver, as forking the calling process while the fetch threads hold the locks of
+       requests or logging could deadlock a worker.
+    3. Aggregation stage: the caller, iterating over `run`, gets the results in input order.
+
+    Both queues are bounded: when the caller falls behind, at most `max_pending` games wait in
+    the process pool and at most `queue_size` fetched games wait for it, after which fetching
+    pauses. Results are released in input order whatever the number of workers and the order
+    in which games finish, so the output of a run does not depend on `workers`. Measurements
+    made in the workers (see metrics) are merged into the registry of the calling process.
+
+    Parameters
+    ----------
+    scheduler : FetchScheduler
+        Scheduler of the I/O stage (see fetch_scheduler).
+    process : callable
+        Picklable function called with a game ID in a worker process, returning a picklable result.
+    workers : int, optional
+        Number of worker processes. 0 runs `process` in the calling thread, inside
+        `local_context`. Default is 2.
+    queue_size : int, optional
+        Maximum number of fetched games waiting for a worker. Default is 16.
+    max_pending : int, optional
+        Maximum number of games submitted to the process pool and not yet consumed by the
+        caller. Default is twice the number of workers.
+    initializer : callable, optional
+        Called in every worker process on start-up, e.g. `install_offline_cache`. Never called
+        in the calling process, whose request handling the fetch threads depend on.
+    initargs : tuple, optional
+        Arguments of `initializer`.
+    local_context : callable, optional
+        Called without arguments when `workers` is 0, returning the context manager `process`
+        runs in, e.g. `functools.partial(api_cache.offline_cache, cache_directory)` to only
+        read the cache in the calling thread. Default is no context.
+    """
+
+    def __init__(self, scheduler, process, workers: int = 2, queue_size: int = 16, max_pending: int = None, initializer=None, initargs: tuple = (),
+                 local_context=contextlib.nullcontext):
+        self.scheduler = scheduler
+        self.process = process
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_pending = max_pending or 2 * max(workers, 1)
+        self.initializer = initializer
+        self.initargs = initargs
+        self.local_context = local_context
+
+    def _fetch(self, game_ids, fetched: queue.Queue, stop: threading.Event) -> None:
+        try:
+            for item in self.scheduler.fetch(game_ids):
+                while not stop.is_set():
+                    try:
+                        fetched.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except BaseException as e:
+            fetched.put((_DONE, e))
+            return
+        fetched.put((_DONE, None))
+
+    def _submit(self, executor, game_id: str) -> Future:
+        if executor is not None:
+            return executor.submit(_process_and_collect, self.process, game_id)
+        future = Future()
+        try:
+            with self.local_context():
+                future.set_result(self.process(game_id))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def run(self, game_ids):
+        """
+        Runs the stages over `game_ids` and yields (game_id, fetch_error, result) tuples in input
+        order. For games that could not be fetched, result is None and fetch_error the last
+        exception; otherwise fetch_error is None and result is the return value of `process`.
+        Exceptions raised by `process` are re-raised here.
+
+        Parameters
+        ----------
+        game_ids : iterable of str
+            Game IDs to process.
+
+        Yields
+        ------
+        game_id : str
+        fetch_error : Exception or None
+        result : object
+        """
+
+        fetched = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        fetcher = threading.Thread(target=self._fetch, args=(list(game_ids), fetched, stop), daemon=True)
+        executor = None
+        if self.workers:
+            executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('forkserver'),
+                                           initializer=init_worker, initargs=(self.initializer, *self.initargs))
+
+        pending = collections.deque()      # (game_id, fetch_error, future) in input order
+        try:
+            fetcher.start()
+            fetching = True
+            while fetching or pending:
+                # Keep the pool busy up to max_pending games, waiting for the I/O stage only when idle
+                while fetching and len(pending) < self.max_pending:
+                    try:
+                        game_id, fetch_error = fetched.get(block=not pending)
+                    except queue.Empty:
+                        break
+                    if game_id is _DONE:
+                        fetching = False
+                        if fetch_error is not None:
+                            raise fetch_error
+                        break
+                    future = self._submit(executor, game_id) if fetch_error is None else None
+                    pending.append((game_id, fetch_error, future))
+
+                if pending:
+                    game_id, fetch_error, future = pending.popleft()
+                    result = None
+                    if future is not None:
+                        result = future.result()
+                        if executor is not None:
+                            result, measurements = result
+                            registry.merge(measurements)
+                    yield game_id, fetch_error, result
+        finally:
+            stop.set()
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
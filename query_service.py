@@ -0,0 +1,480 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+from nba_api.stats.static import players
+from lineup_keys import home_slots, away_slots, canonical_lineups
+from lineup_store import load_lineups, team_id
+import pandas as pd
+import numpy as np
+import functools
+import threading
+import time
+import json
+import os
+
+
+# Columns of a 5-man unit, aggregated over every lineup (matchup) it played in, from its own side
+unit_columns = ['P1', 'P2', 'P3', 'P4', 'P5', 'Team_ID', 'Points_For', 'Points_Against', 'Poss_Off', 'Poss_Def', 'Poss_Tot', 'Time', 'Lineups']
+
+
+def unit_table(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Aggregates lineup data by 5-man unit: the home side of every lineup as is and the away side
+    with points and possessions swapped, so each unit is seen from its own side.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Aggregated lineup data (see lineup_store.load_lineups).
+
+    Returns
+    -------
+    pandas.DataFrame
+        The columns in `unit_columns`, players in ascending order, plus Off_Rating, Def_Rating and
+        Net_Rating per 100 possessions (NaN without possessions).
+    """
+
+    home, away = canonical_lineups(df[home_slots], df[away_slots])
+    sides = []
+    for players_, team, points_for, points_against, poss_off, poss_def in [
+        (home, 'Home_Team_ID', 'Plus_Off', 'Minus_Def', 'Home_Poss_Off', 'Home_Poss_Def'),
+        (away, 'Away_Team_ID', 'Minus_Def', 'Plus_Off', 'Home_Poss_Def', 'Home_Poss_Off'),
+    ]:
+        side = pd.DataFrame(players_, columns=unit_columns[:5])
+        side['Team_ID'] = df[team].fillna(0).to_numpy(dtype=np.int64)
+        side['Points_For'] = df[points_for].to_numpy()
+        side['Points_Against'] = df[points_against].to_numpy()
+        side['Poss_Off'] = df[poss_off].to_numpy()
+        side['Poss_Def'] = df[poss_def].to_numpy()
+        side['Poss_Tot'] = df['Poss_Tot'].to_numpy()
+        side['Time'] = df['Time'].to_numpy()
+        side['Lineups'] = 1
+        sides.append(side)
+
+    units = pd.concat(sides, ignore_index=True).groupby(unit_columns[:5], sort=False).agg(
+        Team_ID=('Team_ID', 'last'), **{col: (col, 'sum') for col in unit_columns[6:]}).reset_index()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        units['Off_Rating'] = np.where(units['Poss_Off'] > 0, units['Points_For'] / units['Poss_Off'] * 100, np.nan)
+        units['Def_Rating'] = np.where(units['Poss_Def'] > 0, units['Points_Against'] / units['Poss_Def'] * 100, np.nan)
+    units['Net_Rating'] = units['Off_Rating'] - units['Def_Rating']
+    return units
+
+
+def matchup_table(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Sums lineup data by lineup key over parts and seasons, and recomputes the ratings.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per lineup key: ID, players, teams, points, possessions, time, Off_Rating,
+        Def_Rating and Net_Rating, and Seasons (number of seasons the lineup played in).
+    """
+
+    counts = ['Plus_Off', 'Minus_Def', 'Plus/Minus', 'Home_Poss_Off', 'Home_Poss_Def', 'Poss_Tot', 'Time']
+    aggregations = {col: (col, 'first') for col in home_slots + away_slots}
+    aggregations.update({col: (col, 'last') for col in ['Home_Team_ID', 'Away_Team_ID']})
+    aggregations.update({col: (col, 'sum') for col in counts})
+    aggregations['Seasons'] = ('Season', 'nunique')
+    lineups = df.groupby('ID', sort=False).agg(**aggregations).reset_index()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lineups['Off_Rating'] = np.where(lineups['Home_Poss_Off'] > 0, lineups['Plus_Off'] / lineups['Home_Poss_Off'] * 100, np.nan)
+        lineups['Def_Rating'] = np.where(lineups['Home_Poss_Def'] > 0, lineups['Minus_Def'] / lineups['Home_Poss_Def'] * 100, np.nan)
+    lineups['Net_Rating'] = lineups['Off_Rating'] - lineups['Def_Rating']
+    return lineups
+
+
+def read_coefficients(path: str = 'player_coefficients.csv') -> pd.DataFrame:
+    """
+    Reads coefficients exported by regression.py, indexed by player ID. Files written before
+    Player_ID was exported are matched to IDs by player name.
+    """
+
+    df = pd.read_csv(path)
+    if 'Player_ID' not in df.columns:
+        ids = {p['full_name']: p['id'] for p in players.get_players()}
+        df.insert(0, 'Player_ID', df['Player_Name'].map(ids))
+    intercept = df.loc[df['Player_Name'] == 'Intercept', 'Coefficient']
+    df = df[df['Player_ID'].notna() & (df['Player_Name'] != 'Intercept')]
+    df = df.astype({'Player_ID': np.int64}).drop_duplicates('Player_ID').set_index('Player_ID')
+    df.attrs['intercept'] = float(intercept.iloc[0]) if len(intercept) else 0.0
+    return df
+
+
+def _record(columns: dict, position: int) -> dict:
+    # One row of column arrays as JSON-serializable values
+    record = {}
+    for name, values in columns.items():
+        value = values[position]
+        value = value.item() if hasattr(value, 'item') else value
+        record[name] = None if isinstance(value, float) and np.isnan(value) else value
+    return record
+
+
+class Snapshot:
+    """
+    Immutable in-memory indexes over one version of the coefficients and lineup data, with an
+    LRU cache of computed answers. A reload builds a new snapshot and swaps it in, which drops
+    the cache with the old one.
+
+    Indexes:
+    - coefficients by player ID, and player IDs by lower-case name;
+    - lineups (matchups of two units) by lineup key;
+    - 5-man units by their sorted player IDs, and unit positions by player and by team.
+    """
+
+    def __init__(self, coefficients: pd.DataFrame, lineups: pd.DataFrame, cache_size: int = 4096, version: dict = None):
+        self.version = version or {}
+        self.loaded_at = time.time()
+        self.intercept = coefficients.attrs.get('intercept', 0.0)
+        self.coefficients = {
+            player_id: {'player_id': player_id, 'name': row['Player_Name'], 'coefficient': row['Coefficient'],
+                        'std_error': row['Std_Error'], 'possessions': int(row['Possessions'])}
+            for player_id, row in zip(coefficients.index.tolist(), coefficients.to_dict('records'))
+        }
+        self.names = {record['name'].lower(): player_id for player_id, record in self.coefficients.items()}
+
+        matchups = matchup_table(lineups)
+        self.lineup_columns = {col: matchups[col].to_numpy() for col in matchups.columns}
+        self.lineup_index = pd.Index(matchups['ID'].to_numpy(dtype=np.int64))
+
+        units = unit_table(lineups)
+        self.unit_columns = {col: units[col].to_numpy() for col in units.columns}
+        self.unit_index = {key: position for position, key in enumerate(zip(*(self.unit_columns[col].tolist() for col in unit_columns[:5])))}
+        positions = np.tile(np.arange(len(units)), 5)
+        by_player = pd.Series(positions).groupby(units[unit_columns[:5]].to_numpy().T.ravel())
+        self.player_units = {player_id: group.to_numpy() for player_id, group in by_player}
+        self.team_units = {team: group.to_numpy() for team, group in pd.Series(np.arange(len(units))).groupby(self.unit_columns['Team_ID'])}
+
+        self._cached = functools.lru_cache(maxsize=cache_size)(self._compute)
+
+    def resolve(self, player) -> int:
+        """
+        Resolves a player ID (int or digit string) or a full name to a player ID.
+        """
+
+        if isinstance(player, (int, np.integer)) or str(player).strip().isdigit():
+            return int(player)
+        player_id = self.names.get(str(player).strip().lower())
+        if player_id is None:
+            found = players.find_players_by_full_name(f'^{str(player).strip()}$')
+            if not found:
+                raise KeyError(f"Unknown player {player}")
+            player_id = found[0]['id']
+        return player_id
+
+    def unit_key(self, unit) -> tuple:
+        """
+        Sorted player IDs of a 5-man unit given by IDs or names.
+        """
+
+        key = tuple(sorted(self.resolve(player) for player in unit))
+        if len(key) != 5:
+            raise ValueError(f"A unit has 5 players, not {len(key)}")
+        return key
+
+    def query(self, name: str, *args):
+        """
+        Answers a query through the LRU cache; arguments must be hashable.
+        """
+
+        return self._cached(name, *args)
+
+    def _compute(self, name: str, *args):
+        return getattr(self, f'_{name}')(*args)
+
+    def _player(self, player_id: int) -> dict:
+        record = self.coefficients.get(player_id)
+        if record is None:
+            raise KeyError(f"No coefficient for player {player_id}")
+        return {**record, 'units': len(self.player_units.get(player_id, ()))}
+
+    def _lineup(self, lineup_id: int) -> dict:
+        if lineup_id not in self.lineup_index:
+            raise KeyError(f"Unknown lineup {lineup_id}")
+        record = _record(self.lineup_columns, self.lineup_index.get_loc(lineup_id))
+        record['ID'] = str(record['ID'])       # 64-bit keys do not survive JSON numbers
+        return record
+
+    def _unit(self, key: tuple) -> dict:
+        position = self.unit_index.get(key)
+        if position is None:
+            raise KeyError(f"Unit {list(key)} never played")
+        return _record(self.unit_columns, position)
+
+    def _top_units(self, positions_key: tuple, n: int, min_possessions: int, sort_by: str) -> list:
+        kind, value = positions_key
+        positions = (self.player_units if kind == 'player' else self.team_units).get(value, np.zeros(0, dtype=np.int64))
+        if sort_by not in self.unit_columns:
+            raise ValueError(f"Unknown column {sort_by}")
+        positions = positions[self.unit_columns['Poss_Tot'][positions] >= min_possessions]
+        values = self.unit_columns[sort_by][positions].astype(float)
+        order = np.argsort(-np.nan_to_num(values, nan=-np.inf), kind='stable')[:n]
+        return [_record(self.unit_columns, position) for position in positions[order]]
+
+    def _predict(self, home: tuple, away: tuple, possessions: float) -> dict:
+        def side(key):
+            return sum(self.coefficients[player_id]['coefficient'] for player_id in key if player_id in self.coefficients)
+
+        rating = self.intercept + side(home) - side(away)
+        return {
+            'home': list(home),
+            'away': list(away),
+            'net_rating': rating,
+            'possessions': possessions,
+            'margin': rating * possessions / 100,
+            'unknown_players': [player_id for player_id in home + away if player_id not in self.coefficients],
+        }
+
+
+class QueryService:
+    """
+    Local query service over the latest coefficients (player_coefficients.csv) and the lineup store.
+
+    Queries are answered from the in-memory indexes of a `Snapshot`. With `watch`, a background
+    thread checks every `reload_interval` seconds whether the coefficients file or the store
+    manifest changed (regression.py and the lineup store replace them atomically) and swaps in
+    a new snapshot; queries keep using the old one until then.
+
+    Parameters
+    ----------
+    coefficients_path : str, optional
+        Coefficients exported by regression.py. Default is 'player_coefficients.csv'.
+    directory : str, optional
+        Directory of the lineup store. Default is 'data'.
+    seasons, season_types : list of str, optional
+        Parts of the store to load, see lineup_store.list_parts. Default is all parts.
+    cache_size : int, optional
+        Maximum number of answers in the LRU cache. Default is 4096.
+    reload_interval : float, optional
+        Seconds between checks for new output. Default is 1.
+
+    Examples
+    --------
+    >>> service = QueryService()
+    >>> service.unit(['Jayson Tatum', 'Jaylen Brown', 'Derrick White', 'Jrue Holiday', 'Kristaps Porzingis'])
+    >>> service.top_units('Derrick White', n=5, min_possessions=200)
+    >>> service.predict(home=[...], away=[...])
+    """
+
+    def __init__(self, coefficients_path: str = 'player_coefficients.csv', directory: str = 'data', seasons=None, season_types=None,
+                 cache_size: int = 4096, reload_interval: float = 1.0):
+        self.coefficients_path = coefficients_path
+        self.directory = directory
+        self.seasons = seasons
+        self.season_types = season_types
+        self.cache_size = cache_size
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watcher = None
+        self.snapshot = None
+        self.reload()
+
+    def _version(self) -> dict:
+        version = {}
+        for name, path in [('coefficients', self.coefficients_path), ('manifest', os.path.join(self.directory, 'manifest.json'))]:
+            stat = os.stat(path) if os.path.isfile(path) else None
+            version[name] = (stat.st_mtime_ns, stat.st_size) if stat else None
+        return version
+
+    def reload(self, force: bool = True) -> bool:
+        """
+        Loads the coefficients and lineups into a new snapshot, if they changed or `force` is True.
+
+        Returns
+        -------
+        reloaded : bool
+        """
+
+        with self._lock:
+            version = self._version()
+            if not force and self.snapshot is not None and version == self.snapshot.version:
+                return False
+            coefficients = read_coefficients(self.coefficients_path)
+            lineups = load_lineups(self.directory, seasons=self.seasons, season_types=self.season_types)
+            self.snapshot = Snapshot(coefficients, lineups, cache_size=self.cache_size, version=version)
+            return True
+
+    def watch(self) -> None:
+        """
+        Starts the background thread reloading new output.
+        """
+
+        def loop():
+            while not self._stop.wait(self.reload_interval):
+                try:
+                    if self.reload(force=False):
+                        print(f"Reloaded {self.coefficients_path} and {self.directory}")
+                except Exception as e:
+                    # Keep serving the previous snapshot, e.g. while a part is being written
+                    print(f"[Reload] {e}")
+
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=loop, daemon=True)
+            self._watcher.start()
+
+    def close(self) -> None:
+        """
+        Stops the background thread.
+        """
+
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    def player(self, player) -> dict:
+        """
+        Coefficient, standard error and possessions of a player, by ID or full name.
+        """
+
+        snapshot = self.snapshot
+        return snapshot.query('player', snapshot.resolve(player))
+
+    def lineup(self, lineup_id) -> dict:
+        """
+        Aggregated data of a lineup (two units facing each other) over the loaded parts, by lineup key.
+        """
+
+        return self.snapshot.query('lineup', int(lineup_id))
+
+    def unit(self, unit) -> dict:
+        """
+        Points, possessions and ratings of a 5-man unit, given by player IDs or names.
+        """
+
+        snapshot = self.snapshot
+        return snapshot.query('unit', snapshot.unit_key(unit))
+
+    def top_units(self, player=None, team=None, n: int = 10, min_possessions: int = 0, sort_by: str = 'Net_Rating') -> list:
+        """
+        Best units containing a player, or of a team (ID or abbreviation), by `sort_by` (descending).
+        """
+
+        snapshot = self.snapshot
+        if (player is None) == (team is None):
+            raise ValueError("Give either a player or a team")
+        key = ('player', snapshot.resolve(player)) if player is not None else ('team', team_id(team))
+        return snapshot.query('top_units', key, int(n), int(min_possessions), sort_by)
+
+    def predict(self, home, away, possessions: float = 100) -> dict:
+        """
+        Predicted net rating and scoring margin of unit `home` against unit `away` over `possessions`,
+        from the coefficients (plus the intercept, if fitted). Players without a coefficient count as 0.
+        """
+
+        snapshot = self.snapshot
+        return snapshot.query('predict', snapshot.unit_key(home), snapshot.unit_key(away), float(possessions))
+
+    def health(self) -> dict:
+        """
+        Loaded version and index sizes.
+        """
+
+        snapshot = self.snapshot
+        info = snapshot._cached.cache_info()
+        return {
+            'loaded_at': snapshot.loaded_at,
+            'players': len(snapshot.coefficients),
+            'lineups': len(snapshot.lineup_index),
+            'units': len(snapshot.unit_index),
+            'cache': {'hits': info.hits, 'misses': info.misses, 'size': info.currsize},
+        }
+
+
+def _players_argument(values: list) -> list:
+    return [player for value in values for player in value.split(',') if player]
+
+
+def make_handler(service: QueryService):
+    """
+    Request handler class of the HTTP interface of `service`. Every endpoint answers JSON:
+
+    - GET /player/{id or name}
+    - GET /lineup/{lineup key}
+    - GET /unit?players=id,id,id,id,id
+    - GET /units?player=...|team=...&n=10&min_possessions=0&sort_by=Net_Rating
+    - GET /predict?home=id,...&away=id,...&possessions=100
+    - GET /health
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send(self, status: int, body) -> None:
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = [unquote(part) for part in url.path.strip('/').split('/')]
+            params = parse_qs(url.query)
+
+            def param(name, default=None):
+                return params[name][0] if name in params else default
+
+            try:
+                if parts[0] == 'player' and len(parts) == 2:
+                    body = service.player(parts[1])
+                elif parts[0] == 'lineup' and len(parts) == 2:
+                    body = service.lineup(parts[1])
+                elif parts == ['unit']:
+                    body = service.unit(_players_argument(params.get('players', [])))
+                elif parts == ['units']:
+                    body = service.top_units(player=param('player'), team=param('team'), n=int(param('n', 10)),
+                                             min_possessions=int(param('min_possessions', 0)), sort_by=param('sort_by', 'Net_Rating'))
+                elif parts == ['predict']:
+                    body = service.predict(_players_argument(params.get('home', [])), _players_argument(params.get('away', [])),
+                                           float(param('possessions', 100)))
+                elif parts == ['health']:
+                    body = service.health()
+                else:
+                    return self._send(404, {'error': f"Unknown endpoint {url.path}"})
+            except KeyError as e:
+                return self._send(404, {'error': e.args[0]})
+            except ValueError as e:
+                return self._send(400, {'error': str(e)})
+            self._send(200, body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(service: QueryService, host: str = '127.0.0.1', port: int = 8765) -> ThreadingHTTPServer:
+    """
+    Creates the HTTP server of `service`; call serve_forever() on it to answer requests.
+    """
+
+    return ThreadingHTTPServer((host, port), make_handler(service))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve player coefficients and lineup data over HTTP.")
+    parser.add_argument('--coefficients', default='player_coefficients.csv', help="Coefficients exported by regression.py.")
+    parser.add_argument('--directory', default='data', help="Directory of the lineup store.")
+    parser.add_argument('--seasons', nargs='*', default=None, help="Seasons to load (default: all).")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cache-size', type=int, default=4096, help="Answers kept in the LRU cache.")
+    parser.add_argument('--reload-interval', type=float, default=1.0, help="Seconds between checks for new output.")
+    args = parser.parse_args()
+
+    service = QueryService(args.coefficients, args.directory, seasons=args.seasons, cache_size=args.cache_size,
+                           reload_interval=args.reload_interval)
+    service.watch()
+    server = serve(service, args.host, args.port)
+    print(f"Serving on http://{args.host}:{args.port} ({service.health()['units']} units)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
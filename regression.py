@@ -1,97 +1,375 @@
-import statsmodels.api as sm
 from nba_api.stats.static import players
+from lineup_keys import all_slots
+from lineup_store import iter_lineups, load_lineups
+from ridge import fit_ridge, fit_cg_ridge, normal_equations, ridge_covariance, gcv_scores
+import scipy.sparse as sp
 import pandas as pd
 import numpy as np
 import os
-from tqdm import tqdm
 
-all_players = players.get_players()
-player_id_map = { p['id']: p['full_name'] for p in all_players }
 
-directory = 'data'
-print('Importing')
-df = pd.concat([pd.read_csv(os.path.join(directory, f'data_20{year}-{year + 1}_{i}.csv')) for i in range(1, 12) for year in range(22, 25)], ignore_index=True)
+# Columns of the lineup store used by the regression
+data_columns = ['ID'] + all_slots + ['Poss_Tot', 'Net_Rating', 'h']
 
-all_slots = ["P1H","P2H","P3H","P4H","P5H","P1V","P2V","P3V","P4V","P5V"]
-plyrs = pd.unique(df[all_slots].values.ravel())
+# +1 for the five home players of a lineup, -1 for the five away players
+slot_signs = np.array([1] * 5 + [-1] * 5, dtype=float)
 
-X = pd.DataFrame(0, index=df.index, columns = plyrs)
-player_sample_size = {}
 
-for i, row in tqdm(df.iterrows(), desc = "Processing lineups"):
-    if not np.isnan(row['Net_Rating']):
-        for slot in ["P1H","P2H","P3H","P4H","P5H"]:
-            player_id = row[slot]
-            player_sample_size[player_id] = player_sample_size.get(player_id, 0) + row['Poss_Tot']
-            X.at[i, player_id] = +1
-        for slot in ["P1V","P2V","P3V","P4V","P5V"]:
-            player_id = row[slot]
-            player_sample_size[player_id] = player_sample_size.get(player_id, 0) + row['Poss_Tot']
-            X.at[i, player_id] = -1
+def build_design(df: pd.DataFrame) -> dict:
+    """
+    Builds the sparse APM design matrix from aggregated lineup data in one vectorized pass.
 
-mask = (X != 0).any(axis=1) & (df['h'] > 0)
+    Every lineup with a net rating and a positive weight term h is a row, with +1 in the columns
+    of its home players and -1 in those of its away players.
 
-X = X.loc[mask]
-y = df.loc[mask, 'Net_Rating']
-w = 1 / df.loc[mask, 'h']
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Aggregated lineup data with the columns in `data_columns`.
 
-from sklearn.linear_model import RidgeCV
-alphas = np.logspace(-2, 4, 50)
-model = RidgeCV(alphas=alphas, fit_intercept=False, cv=5, scoring='neg_mean_squared_error')
-model.fit(X.values, y.values, sample_weight=w.values)
+    Returns
+    -------
+    design : dict
+        - X           : scipy.sparse.csr_matrix (n, p), ten nonzeros per row.
+        - players     : pandas.Index of the p player IDs, in order of first appearance in `df`.
+        - mask        : bool array (len(df),), rows of `df` kept in X.
+        - y           : float array (n,), net rating of every row.
+        - w           : float array (n,), regression weight 1 / h of every row.
+        - sample_size : pandas.Series of possessions played per player, over the lineups with a net rating.
+    """
 
-player_coefs = pd.Series(model.coef_, index=X.columns)
+    slots = df[all_slots].to_numpy()
+    players = pd.Index(pd.unique(slots.ravel()))
+    columns = players.get_indexer(slots.ravel()).reshape(slots.shape)
 
-# ref_pid   = X.columns[-1]
-# X_ref     = X.drop(columns=[ref_pid])
-# X_sm_ref  = sm.add_constant(X_ref)
+    rated = df['Net_Rating'].notna().to_numpy()
+    mask = rated & (df['h'] > 0).to_numpy()
+    n = int(mask.sum())
 
-# alpha     = 100
+    X = sp.csr_matrix(
+        (np.tile(slot_signs, n), columns[mask].ravel(), np.arange(0, 10 * n + 1, 10)),
+        shape=(n, len(players)),
+    )
+    X.sort_indices()
 
-# # Weights
-# w_sqrt = np.sqrt(weights.values)
-# Xw = X_sm_ref.values * w_sqrt[:, None]
-# yw = y.values * w_sqrt
+    possessions = np.repeat(df['Poss_Tot'].to_numpy(dtype=float)[rated], len(all_slots))
+    sample_size = np.bincount(columns[rated].ravel(), weights=possessions, minlength=len(players)).astype(np.int64)
 
-# # Prepare penalization
-# p = X_sm_ref.shape[1]
-# pen_mask = np.ones(p, dtype=float)
-# pen_mask[0] = 0.0
+    return {
+        'X': X,
+        'players': players,
+        'mask': mask,
+        'y': df['Net_Rating'].to_numpy(dtype=float)[mask],
+        'w': 1 / df['h'].to_numpy(dtype=float)[mask],
+        'sample_size': pd.Series(sample_size, index=players),
+    }
 
-# # Augment rows
-# X_aug = np.vstack([Xw, np.sqrt(alpha) * np.diag(pen_mask)])
-# y_aug = np.concatenate([yw, np.zeros(p)])
 
-# # OLS on augmented system
-# print("Fitting model...")
-# ols_aug = sm.OLS(y_aug, X_aug).fit()
+# Columns of the lineup store used by the offense/defense regression
+od_columns = all_slots + ['Plus_Off', 'Minus_Def', 'Home_Poss_Off', 'Home_Poss_Def']
 
-# params = pd.Series(ols_aug.params, index = X_sm_ref.columns)
-# stderrs = pd.Series(ols_aug.bse, index = X_sm_ref.columns)
 
-# # Intercept
-# intercept = params['const']
-# inter_se = stderrs['const']
+def build_od_design(df: pd.DataFrame) -> dict:
+    """
+    Builds the sparse design of the offense/defense (O-RAPM/D-RAPM) regression: one row per
+    lineup and side with the ball, whose target is that side's points per 100 possessions.
 
-# # Player coefficients
-# player_coefs = params.drop('const').copy()
-# player_stderrs = stderrs.drop('const').copy()
+    Columns are an intercept (the league average rating), then the offense of the p players, then
+    their defense. A row has +1 in the offense columns of the five players with the ball and -1
+    in the defense columns of the five others, so a positive defensive coefficient means fewer
+    points allowed. Rows of a lineup are adjacent, so contiguous CV folds keep lineups whole.
 
-# player_coefs[ref_pid] = -player_coefs.sum()
-# player_stderrs[ref_pid] = np.nan
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Aggregated lineup data with the columns in `od_columns`.
 
-output_df = pd.DataFrame({
-    'Player_Name': [player_id_map.get(pid, pid) for pid in player_coefs.index],
-    'Coefficient': player_coefs.values,
-    # 'Std_Error': player_stderrs.values,
-    'Possessions': [player_sample_size.get(pid, 0) for pid in player_coefs.index]
-})
+    Returns
+    -------
+    design : dict
+        - X       : scipy.sparse.csr_matrix (n, 1 + 2p), eleven nonzeros per row.
+        - players : pandas.Index of the p player IDs, in order of first appearance in `df`.
+        - y       : float array (n,), points per 100 possessions of every row.
+        - w       : float array (n,), regression weight (possessions) of every row.
+    """
 
-# output_df.loc[len(output_df)] = ['Intercept', intercept, inter_se, 0]
+    slots = df[all_slots].to_numpy()
+    players = pd.Index(pd.unique(slots.ravel()))
+    p = len(players)
+    columns = players.get_indexer(slots.ravel()).reshape(slots.shape)
+    home, away = columns[:, :5], columns[:, 5:]
 
-output_df.sort_values(by='Coefficient', ascending=False, inplace=True)
-output_df.reset_index(drop=True, inplace=True)
-output_df = output_df[output_df['Possessions'] > 3000]
+    # (lineups, 2 sides, ...): home team with the ball, then away team with the ball
+    offense = np.stack([home, away], axis=1)
+    defense = np.stack([away, home], axis=1) + p
+    points = np.stack([df['Plus_Off'].to_numpy(dtype=float), df['Minus_Def'].to_numpy(dtype=float)], axis=1).ravel()
+    possessions = np.stack([df['Home_Poss_Off'].to_numpy(dtype=float), df['Home_Poss_Def'].to_numpy(dtype=float)], axis=1).ravel()
+    mask = possessions > 0
+    n = int(mask.sum())
 
-print("Exporting...")
-output_df.to_csv('player_coefficients.csv', index=False)
\ No newline at end of file
+    indices = np.concatenate([np.zeros((len(df), 2, 1), dtype=np.int64), offense + 1, defense + 1], axis=2).reshape(-1, 11)[mask]
+    X = sp.csr_matrix(
+        (np.tile(np.r_[1.0, slot_signs], n), indices.ravel(), np.arange(0, 11 * n + 1, 11)),
+        shape=(n, 1 + 2 * p),
+    )
+    X.sort_indices()
+    return {
+        'X': X,
+        'players': players,
+        'y': points[mask] / possessions[mask] * 100,
+        'w': possessions[mask],
+    }
+
+
+def od_estimates(design: dict, alphas=np.logspace(2, 5, 31), cv=5, tol: float = 1e-8) -> tuple[pd.DataFrame, float]:
+    """
+    Fits the offense/defense regression with an unpenalized intercept, choosing the penalty by
+    cross-validation with the conjugate gradient solver (see `ridge.fit_cg_ridge`).
+
+    Parameters
+    ----------
+    design : dict
+        Design as returned by `build_od_design`.
+    alphas : array-like, optional
+        Penalties to choose from. Default is 31 values from 1e2 to 1e5, see `ridge.fit_cg_ridge`.
+    cv : int or array-like, optional
+        See `ridge.fit_cg_ridge`. Default is 5.
+    tol : float, optional
+        Tolerance of the solver. Default is 1e-8.
+
+    Returns
+    -------
+    estimates : pandas.DataFrame
+        O_Coefficient and D_Coefficient indexed by player ID, in points per 100 possessions
+        above the league average; their sum is comparable to the net Coefficient.
+    alpha : float
+        Chosen penalty.
+    """
+
+    p = len(design['players'])
+    penalized = np.r_[False, np.ones(2 * p, dtype=bool)]
+    fit = fit_cg_ridge(design['X'], design['y'], design['w'], alphas=alphas, cv=cv, penalized=penalized, tol=tol)
+    estimates = pd.DataFrame({'O_Coefficient': fit['coef'][1:p + 1], 'D_Coefficient': fit['coef'][p + 1:]}, index=design['players'])
+    estimates.attrs['intercept'] = fit['coef'][0]
+    return estimates, fit['alpha']
+
+
+def stream_normal_equations(directory: str = 'data', seasons=None, season_types=None, batch_size: int = 100_000) -> dict:
+    """
+    Accumulates the normal equations of the APM regression over the lineup store chunk by chunk,
+    without building the design: memory is bounded by the p x p Gram matrix and one chunk, however
+    many seasons are read.
+
+    A first pass reads the player slots only, to fix the player index (in the order of
+    `build_design`); a second pass adds the X^T W X, X^T W y and possessions of every chunk.
+    Ratings and h are read as float32 and the sums kept in float64, so the result matches
+    `build_design` followed by `ridge.normal_equations` to float32 precision of the inputs.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Directory of the lineup store. Default is 'data'.
+    seasons, season_types : list of str, optional
+        Parts to include, see lineup_store.list_parts. Default is all parts.
+    batch_size : int, optional
+        Lineups per chunk. Default is 100000.
+
+    Returns
+    -------
+    statistics : dict
+        - players     : pandas.Index of the p player IDs.
+        - G, b, yWy   : X^T W X (p, p), X^T W y (p,) and y^T W y, see `ridge.normal_equations`.
+        - Xw, wy      : X^T w (p,) and w^T y, the intercept terms.
+        - weight      : float, sum of the weights.
+        - n           : int, number of regression rows.
+        - sample_size : pandas.Series of possessions played per player, as in `build_design`.
+    """
+
+    seen = []
+    for chunk in iter_lineups(directory, columns=all_slots, seasons=seasons, season_types=season_types, batch_size=batch_size):
+        seen.append(pd.unique(chunk.to_numpy().ravel()))
+    players = pd.Index(pd.unique(np.concatenate(seen)) if seen else np.zeros(0, dtype=np.int32))
+    del seen
+
+    p = len(players)
+    statistics = {'players': players, 'G': np.zeros((p, p)), 'b': np.zeros(p), 'yWy': 0.0, 'Xw': np.zeros(p), 'wy': 0.0,
+                  'weight': 0.0, 'n': 0}
+    sample_size = np.zeros(p)
+    for chunk in iter_lineups(directory, columns=data_columns, seasons=seasons, season_types=season_types, batch_size=batch_size):
+        columns = players.get_indexer(chunk[all_slots].to_numpy().ravel()).reshape(-1, len(all_slots))
+        rated = chunk['Net_Rating'].notna().to_numpy()
+        mask = rated & (chunk['h'] > 0).to_numpy()
+        n = int(mask.sum())
+
+        possessions = np.repeat(chunk['Poss_Tot'].to_numpy(dtype=float)[rated], len(all_slots))
+        sample_size += np.bincount(columns[rated].ravel(), weights=possessions, minlength=p)
+        if n == 0:
+            continue
+
+        X = sp.csr_matrix((np.tile(slot_signs, n), columns[mask].ravel(), np.arange(0, 10 * n + 1, 10)), shape=(n, p))
+        y = chunk['Net_Rating'].to_numpy(dtype=float)[mask]
+        w = 1 / chunk['h'].to_numpy(dtype=float)[mask]
+
+        gram = (X.T @ X.multiply(w[:, None]).tocsr()).tocoo()
+        statistics['G'][gram.row, gram.col] += gram.data
+        statistics['b'] += X.T @ (w * y)
+        statistics['yWy'] += float(w @ (y * y))
+        statistics['Xw'] += X.T @ w
+        statistics['wy'] += float(w @ y)
+        statistics['weight'] += float(w.sum())
+        statistics['n'] += n
+
+    statistics['sample_size'] = pd.Series(sample_size.astype(np.int64), index=players)
+    return statistics
+
+
+def player_estimates(design: dict, alpha: float, reference=None, intercept: bool = False, covariance: str = 'sandwich') -> pd.DataFrame:
+    """
+    Ridge coefficients and standard errors of every player at a given penalty.
+
+    Everything is computed from the penalized normal equations, which take one pass over the
+    design; the rest only depends on the number of players.
+
+    Parameters
+    ----------
+    design : dict
+        Design as returned by `build_design`, or normal equations as returned by `stream_normal_equations`.
+    alpha : float
+        Penalty, e.g. chosen by `ridge.fit_ridge`.
+    reference : int, optional
+        Player ID left out of the fit. The reference player's coefficient is minus the sum of
+        the others, with the standard error of that sum. Default is None (no reference player).
+    intercept : bool, optional
+        Fit an unpenalized intercept. Default is False.
+    covariance : str, optional
+        'sandwich' or 'augmented', see `ridge.ridge_covariance`. Default is 'sandwich'.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Coefficient and Std_Error columns, indexed by player ID, with a leading 'Intercept' row if
+        `intercept` is True. Without reference and intercept, the coefficients are those of
+        `ridge.fit_ridge` at `alpha`.
+    """
+
+    players = design['players']
+    if 'G' in design:
+        G, b, yWy = design['G'], design['b'], design['yWy']
+        if intercept:
+            G = np.block([[np.array([[design['weight']]]), design['Xw'][None, :]], [design['Xw'][:, None], G]])
+            b = np.r_[design['wy'], b]
+        n = design['n']
+    else:
+        G, b, yWy = normal_equations(design['X'], design['y'], design['w'], intercept=intercept)
+        n = len(design['y'])
+
+    offset = int(intercept)
+    keep = np.ones(len(b), dtype=bool)
+    if reference is not None:
+        keep[offset + players.get_loc(reference)] = False
+    penalized = np.ones(len(b), dtype=bool)
+    penalized[:offset] = False
+
+    result = ridge_covariance(G[np.ix_(keep, keep)], b[keep], yWy, n, alpha,
+                              penalized=penalized[keep], covariance=covariance)
+    coef = np.full(len(b), np.nan)
+    se = np.full(len(b), np.nan)
+    coef[keep] = result['coef']
+    se[keep] = result['se']
+
+    if reference is not None:
+        others = np.arange(offset, keep.sum())           # kept players in the fitted coefficients
+        coef[offset + players.get_loc(reference)] = -result['coef'][others].sum()
+        se[offset + players.get_loc(reference)] = np.sqrt(result['cov'][np.ix_(others, others)].sum())
+
+    index = (['Intercept'] if intercept else []) + list(players)
+    return pd.DataFrame({'Coefficient': coef, 'Std_Error': se}, index=index)
+
+
+def coefficient_table(estimates: pd.DataFrame, sample_size: pd.Series, min_possessions: int = 3000, names: pd.Series = None) -> pd.DataFrame:
+    """
+    Formats player coefficients for export, best first.
+
+    Parameters
+    ----------
+    estimates : pandas.DataFrame
+        Coefficient and Std_Error of every player, as returned by `player_estimates`.
+    sample_size : pandas.Series
+        Possessions played per player, indexed by player ID.
+    min_possessions : int, optional
+        Players with fewer possessions are left out. Default is 3000.
+    names : pandas.Series, optional
+        Player names indexed by player ID, e.g. from a cached design (see design_cache). Default
+        is looked up in nba_api's static player list.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Player_ID, Player_Name, Coefficient, Std_Error and Possessions columns, with the
+        intercept (if any) on the last row.
+    """
+
+    if names is None:
+        player_id_map = {p['id']: p['full_name'] for p in players.get_players()}
+    else:
+        player_id_map = names.dropna().to_dict()
+    player_estimates = estimates.drop(index='Intercept', errors='ignore')
+
+    output_df = pd.DataFrame({
+        'Player_ID': player_estimates.index,
+        'Player_Name': [player_id_map.get(pid, pid) for pid in player_estimates.index],
+        'Coefficient': player_estimates['Coefficient'].values,
+        'Std_Error': player_estimates['Std_Error'].values,
+        'Possessions': sample_size.reindex(player_estimates.index, fill_value=0).values
+    })
+
+    output_df.sort_values(by='Coefficient', ascending=False, inplace=True)
+    output_df.reset_index(drop=True, inplace=True)
+    output_df = output_df[output_df['Possessions'] > min_possessions]
+
+    if 'Intercept' in estimates.index:
+        intercept = estimates.loc['Intercept']
+        output_df.loc[len(output_df)] = [None, 'Intercept', intercept['Coefficient'], intercept['Std_Error'], 0]
+    return output_df
+
+
+if __name__ == "__main__":
+    directory = 'data'
+    seasons = ['2022-23', '2023-24', '2024-25']
+    reference_player = None  # Player ID left out of the fit, e.g. design['players'][-1]
+    intercept = False
+    streaming = False  # Accumulate the normal equations chunk by chunk instead of building the design, e.g. for ten seasons
+    offense_defense = False  # Add O-RAPM and D-RAPM columns, from one row per lineup and side with the ball
+    alphas = np.logspace(-2, 4, 50)
+    od_alphas = np.logspace(2, 5, 31)  # Grid of the conjugate gradient solver, inaccurate at small penalties
+
+    from design_cache import cached_design
+
+    print('Importing')
+    if streaming:
+        # Memory bounded by the p x p Gram matrix; the penalty is chosen by GCV, which needs no second pass
+        design = stream_normal_equations(directory, seasons=seasons)
+        alpha = alphas[np.argmax(gcv_scores(design['G'], design['b'], design['yWy'], design['n'], design['weight'], alphas))]
+    else:
+        # Built from the lineup store on the first run, then loaded from design_cache/ until the parts change
+        design = cached_design(directory, seasons=seasons, cache_directory='design_cache')
+        alpha = fit_ridge(design['X'], design['y'], design['w'], alphas=alphas, cv=5)['alpha']
+    print(f"Alpha: {alpha:g}")
+
+    # Standard errors; a reference player and an intercept change the fitted model, not just the errors
+    estimates = player_estimates(design, alpha, reference=reference_player, intercept=intercept, covariance='sandwich')
+
+    output_df = coefficient_table(estimates, design['sample_size'], names=design.get('names'))
+
+    if offense_defense:
+        od_design = build_od_design(load_lineups(directory, columns=od_columns, seasons=seasons))
+        od, od_alpha = od_estimates(od_design, alphas=od_alphas)
+        print(f"O/D alpha: {od_alpha:g}, league average: {od.attrs['intercept']:.1f} points per 100 possessions")
+        output_df = output_df.merge(od, left_on='Player_ID', right_index=True, how='left')
+
+    print("Exporting...")
+    # Replaced atomically: query_service.py reloads the file when it changes
+    output_path = 'player_coefficients.csv'
+    tmp_path = f'{output_path}.{os.getpid()}.tmp'
+    output_df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, output_path)
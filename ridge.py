@@ -0,0 +1,443 @@
+from scipy.sparse.linalg import LinearOperator, cg
+import scipy.sparse as sp
+import numpy as np
+import warnings
+
+
+def weighted_gram(X, y: np.ndarray, w: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Computes the weighted normal-equation terms X^T W X and X^T W y.
+
+    Parameters
+    ----------
+    X : scipy.sparse matrix or numpy.ndarray (n, p)
+        Design matrix.
+    y : numpy.ndarray (n,)
+        Targets.
+    w : numpy.ndarray (n,)
+        Sample weights.
+
+    Returns
+    -------
+    G : numpy.ndarray (p, p)
+        X^T W X.
+    b : numpy.ndarray (p,)
+        X^T W y.
+    """
+
+    if sp.issparse(X):
+        Xw = sp.csr_matrix(X).multiply(w[:, None]).tocsr()
+        G = (X.T @ Xw).toarray()
+    else:
+        Xw = X * w[:, None]
+        G = X.T @ Xw
+    b = np.asarray(Xw.T @ y).ravel()
+    return G, b
+
+
+def normal_equations(X, y: np.ndarray, w: np.ndarray, intercept: bool = False) -> tuple[np.ndarray, np.ndarray, float]:
+    """
+    Computes X^T W X, X^T W y and y^T W y in one pass over X, optionally with a leading constant column.
+
+    Parameters
+    ----------
+    X : scipy.sparse matrix or numpy.ndarray (n, p)
+        Design matrix.
+    y : numpy.ndarray (n,)
+        Targets.
+    w : numpy.ndarray (n,)
+        Sample weights.
+    intercept : bool, optional
+        Prepend a column of ones to X. Default is False.
+
+    Returns
+    -------
+    G : numpy.ndarray (p, p), or (p + 1, p + 1) with intercept
+    b : numpy.ndarray (p,), or (p + 1,) with intercept
+    yWy : float
+    """
+
+    G, b = weighted_gram(X, y, w)
+    if intercept:
+        Xw = np.asarray(X.T @ w).ravel()
+        G = np.block([[np.array([[w.sum()]]), Xw[None, :]], [Xw[:, None], G]])
+        b = np.r_[w @ y, b]
+    return G, b, float(w @ (y * y))
+
+
+def ridge_path(G: np.ndarray, b: np.ndarray, alphas, prior: np.ndarray = None, eigh: tuple = None) -> np.ndarray:
+    """
+    Solves (G + alpha I) coef = b + alpha prior for every alpha from one eigendecomposition of G.
+
+    With a prior, the penalty is alpha |coef - prior|^2: coefficients are shrunk toward the prior
+    (e.g. last season's estimates) instead of toward zero.
+
+    Parameters
+    ----------
+    G : numpy.ndarray (p, p)
+        X^T W X, see `weighted_gram`.
+    b : numpy.ndarray (p,)
+        X^T W y.
+    alphas : array-like (a,)
+        Penalties.
+    prior : numpy.ndarray (p,), optional
+        Coefficients the penalty shrinks toward. Default is zero.
+    eigh : tuple, optional
+        (eigenvalues, eigenvectors) of G, to reuse a decomposition across calls.
+
+    Returns
+    -------
+    coefs : numpy.ndarray (a, p)
+        Ridge coefficients for every alpha.
+    """
+
+    eigenvalues, V = np.linalg.eigh(G) if eigh is None else eigh
+    alphas = np.asarray(alphas, dtype=float)
+    rhs = (V.T @ b)[None, :]
+    if prior is not None:
+        rhs = rhs + alphas[:, None] * (V.T @ prior)
+    return (rhs / (eigenvalues + alphas[:, None])) @ V.T
+
+
+def fold_labels(n: int, n_folds: int) -> np.ndarray:
+    """
+    Assigns n rows to contiguous folds like sklearn.model_selection.KFold without shuffling:
+    the first n % n_folds folds get one row more than the others.
+    """
+
+    sizes = np.full(n_folds, n // n_folds)
+    sizes[:n % n_folds] += 1
+    return np.repeat(np.arange(n_folds), sizes)
+
+
+def cv_scores(X, y: np.ndarray, w: np.ndarray, alphas, folds) -> np.ndarray:
+    """
+    Cross-validated negative mean squared error of ridge fits for every alpha.
+
+    The Gram matrix of every training set is the full Gram matrix minus that of the held-out
+    fold, so X is only multiplied once per fold, and each fold needs one eigendecomposition
+    for the whole alpha grid. As in RidgeCV(cv=...), the weights are used for fitting only and
+    the score is the unweighted mean of the per-fold mean squared errors.
+
+    Parameters
+    ----------
+    X : scipy.sparse matrix or numpy.ndarray (n, p)
+        Design matrix.
+    y : numpy.ndarray (n,)
+        Targets.
+    w : numpy.ndarray (n,)
+        Sample weights.
+    alphas : array-like (a,)
+        Penalties.
+    folds : array-like (n,)
+        Fold of every row, e.g. from `fold_labels`, or a grouping (season, game...) for grouped CV.
+
+    Returns
+    -------
+    scores : numpy.ndarray (a,)
+    """
+
+    X = sp.csr_matrix(X) if sp.issparse(X) else np.asarray(X)
+    folds = np.asarray(folds)
+    G, b = weighted_gram(X, y, w)
+
+    scores = []
+    for fold in np.unique(folds):
+        test = np.flatnonzero(folds == fold)
+        G_test, b_test = weighted_gram(X[test], y[test], w[test])
+        coefs = ridge_path(G - G_test, b - b_test, alphas)
+        residuals = y[test][:, None] - X[test] @ coefs.T
+        scores.append(-np.mean(residuals ** 2, axis=0))
+    return np.mean(scores, axis=0)
+
+
+def loo_scores(X, y: np.ndarray, w: np.ndarray, alphas, gcv: bool = False, chunk_size: int = 20000) -> np.ndarray:
+    """
+    Leave-one-out (or generalized cross-validation) negative weighted mean squared error of
+    ridge fits for every alpha, from a single eigendecomposition of X^T W X.
+
+    Leverages are computed in chunks of rows, so memory stays in O(chunk_size * p).
+
+    Parameters
+    ----------
+    X : scipy.sparse matrix or numpy.ndarray (n, p)
+        Design matrix.
+    y : numpy.ndarray (n,)
+        Targets.
+    w : numpy.ndarray (n,)
+        Sample weights.
+    alphas : array-like (a,)
+        Penalties.
+    gcv : bool, optional
+        Replace every leverage by their mean (GCV) instead of exact LOO. Default is False.
+    chunk_size : int, optional
+        Rows processed at a time. Default is 20000.
+
+    Returns
+    -------
+    scores : numpy.ndarray (a,)
+    """
+
+    alphas = np.asarray(alphas, dtype=float)
+    G, b = weighted_gram(X, y, w)
+    eigenvalues, V = np.linalg.eigh(G)
+    shrink = 1 / (eigenvalues + alphas[:, None])         # (a, p)
+    coef_rotated = (V.T @ b) * shrink                    # (a, p), coefficients in the eigenbasis
+
+    n = X.shape[0]
+    mean_leverage = (eigenvalues * shrink).sum(axis=1) / n
+    errors = np.zeros(len(alphas))
+    for start in range(0, n, chunk_size):
+        rows = slice(start, start + chunk_size)
+        Z = np.asarray(X[rows] @ V)                      # rows in the eigenbasis
+        residuals = y[rows][:, None] - Z @ coef_rotated.T
+        if gcv:
+            leverage = mean_leverage
+        else:
+            leverage = w[rows][:, None] * ((Z ** 2) @ shrink.T)
+        errors += (w[rows][:, None] * (residuals / (1 - leverage)) ** 2).sum(axis=0)
+    return -errors / w.sum()
+
+
+def gcv_scores(G: np.ndarray, b: np.ndarray, yWy: float, n: int, weight: float, alphas, eigh: tuple = None) -> np.ndarray:
+    """
+    Generalized cross-validation scores of `loo_scores(..., gcv=True)` from the normal equations
+    alone, for designs too large to go over again (see regression.stream_normal_equations).
+
+    With beta = (G + alpha I)^-1 b, the weighted residual sum of squares is
+    yWy - 2 beta^T b + beta^T G beta and the mean leverage trace(G (G + alpha I)^-1) / n.
+
+    Parameters
+    ----------
+    G, b, yWy : see `normal_equations`
+    n : int
+        Number of rows of the design.
+    weight : float
+        Sum of the sample weights.
+    alphas : array-like (a,)
+        Penalties.
+    eigh : tuple, optional
+        (eigenvalues, eigenvectors) of G.
+
+    Returns
+    -------
+    scores : numpy.ndarray (a,)
+    """
+
+    alphas = np.asarray(alphas, dtype=float)
+    eigenvalues, V = np.linalg.eigh(G) if eigh is None else eigh
+    Vb2 = (V.T @ b) ** 2
+    shrink = 1 / (eigenvalues + alphas[:, None])         # (a, p)
+    rss = yWy - 2 * (Vb2 * shrink).sum(axis=1) + (eigenvalues * Vb2 * shrink ** 2).sum(axis=1)
+    mean_leverage = (eigenvalues * shrink).sum(axis=1) / n
+    return -rss / (1 - mean_leverage) ** 2 / weight
+
+
+def fit_ridge(X, y: np.ndarray, w: np.ndarray, alphas=np.logspace(-2, 4, 50), cv=5) -> dict:
+    """
+    Fits a ridge regression without intercept, choosing the penalty on the whole alpha grid from
+    eigendecompositions of p x p matrices instead of refitting on the design for every alpha.
+
+    With an integer `cv`, the folds, scores and chosen alpha are those of
+    sklearn.linear_model.RidgeCV(fit_intercept=False, cv=cv, scoring='neg_mean_squared_error').
+
+    Parameters
+    ----------
+    X : scipy.sparse matrix or numpy.ndarray (n, p)
+        Design matrix.
+    y : numpy.ndarray (n,)
+        Targets.
+    w : numpy.ndarray (n,)
+        Sample weights.
+    alphas : array-like, optional
+        Penalties to choose from. Default is 50 values from 1e-2 to 1e4.
+    cv : int, array-like, 'loo' or 'gcv', optional
+        Number of contiguous folds, fold label of every row (grouped CV), exact leave-one-out
+        or generalized cross-validation. Default is 5.
+
+    Returns
+    -------
+    fit : dict
+        - coef   : numpy.ndarray (p,), coefficients at the chosen alpha.
+        - alpha  : float, chosen alpha.
+        - alphas : numpy.ndarray (a,).
+        - scores : numpy.ndarray (a,), negative mean squared error of every alpha.
+    """
+
+    alphas = np.asarray(alphas, dtype=float)
+    if isinstance(cv, str):
+        if cv not in ('loo', 'gcv'):
+            raise ValueError(f"Unknown cv {cv}")
+        scores = loo_scores(X, y, w, alphas, gcv=(cv == 'gcv'))
+    else:
+        folds = fold_labels(X.shape[0], cv) if np.isscalar(cv) else cv
+        scores = cv_scores(X, y, w, alphas, folds)
+
+    alpha = alphas[np.argmax(scores)]
+    G, b = weighted_gram(X, y, w)
+    return {
+        'coef': ridge_path(G, b, [alpha])[0],
+        'alpha': alpha,
+        'alphas': alphas,
+        'scores': scores,
+    }
+
+
+def cg_ridge_path(X, y: np.ndarray, w: np.ndarray, alphas, penalized=None, tol: float = 1e-8, maxiter: int = None, x0: np.ndarray = None) -> np.ndarray:
+    """
+    Solves (X^T W X + alpha P) coef = X^T W y for every alpha with the conjugate gradient method,
+    without forming X^T W X: each iteration costs two sparse products with X. For designs too
+    wide for the eigendecomposition of `ridge_path`, e.g. separate offense and defense columns.
+
+    Penalties are solved from the largest down, each solve starting from the previous solution,
+    and preconditioned by the diagonal of X^T W X + alpha P.
+
+    Parameters
+    ----------
+    X : scipy.sparse matrix (n, p)
+        Design matrix.
+    y : numpy.ndarray (n,)
+        Targets.
+    w : numpy.ndarray (n,)
+        Sample weights.
+    alphas : array-like (a,)
+        Penalties.
+    penalized : bool or float array-like (p,), optional
+        Coefficients the penalty applies to, e.g. all but an intercept column, or the penalty of
+        every coefficient relative to alpha. Default is all.
+    tol : float, optional
+        Relative tolerance on the residual of the normal equations. Default is 1e-8: in nearly
+        flat directions of the design (e.g. offense columns summing to five times an intercept)
+        the residual is small long before the coefficients converge, the more so at small alphas.
+    maxiter : int, optional
+        Maximum number of iterations per penalty. Default is scipy's (10 p).
+    x0 : numpy.ndarray (p,), optional
+        Starting point of the first solve, e.g. the solution of a nearby problem. Default is zero.
+
+    Returns
+    -------
+    coefs : numpy.ndarray (a, p)
+        Ridge coefficients for every alpha, in the order of `alphas`.
+    """
+
+    X = sp.csr_matrix(X)
+    Xt = X.T.tocsr()
+    p = X.shape[1]
+    penalty = np.ones(p) if penalized is None else np.asarray(penalized, dtype=float)
+    b = Xt @ (w * y)
+    diagonal = np.asarray(X.multiply(X).T @ w).ravel()
+
+    alphas = np.asarray(alphas, dtype=float)
+    coefs = np.zeros((len(alphas), p))
+    coef = np.zeros(p) if x0 is None else x0
+    for i in np.argsort(-alphas, kind='stable'):
+        alpha = alphas[i]
+        A = LinearOperator((p, p), matvec=lambda v: Xt @ (w * (X @ v)) + alpha * penalty * v, dtype=float)
+        preconditioner = np.where(diagonal + alpha * penalty > 0, 1 / (diagonal + alpha * penalty), 1.0)
+        M = LinearOperator((p, p), matvec=lambda v: preconditioner * v, dtype=float)
+        coef, info = cg(A, b, x0=coef, rtol=tol, atol=0.0, maxiter=maxiter, M=M)
+        if info > 0:
+            warnings.warn(f"Conjugate gradient did not converge in {info} iterations for alpha {alpha:g}")
+        coefs[i] = coef
+    return coefs
+
+
+def fit_cg_ridge(X, y: np.ndarray, w: np.ndarray, alphas=np.logspace(2, 5, 31), cv=5, penalized=None, tol: float = 1e-8) -> dict:
+    """
+    Like `fit_ridge`, for wide sparse designs: every training set is solved along the alpha grid
+    with `cg_ridge_path`, and the score is the unweighted mean of the per-fold mean squared errors.
+    Warns when the chosen alpha is at an end of the grid.
+
+    Parameters
+    ----------
+    X, y, w : see `fit_ridge`
+    alphas : array-like, optional
+        Penalties to choose from. Default is 31 values from 1e2 to 1e5: the solver needs many
+        more iterations to be accurate below, and adjusted plus-minus designs select penalties
+        in the thousands or more.
+    cv : int or array-like, optional
+        Number of contiguous folds or fold label of every row. Default is 5.
+    penalized, tol : see `cg_ridge_path`
+
+    Returns
+    -------
+    fit : dict
+        See `fit_ridge`.
+    """
+
+    X = sp.csr_matrix(X)
+    alphas = np.asarray(alphas, dtype=float)
+    folds = fold_labels(X.shape[0], cv) if np.isscalar(cv) else np.asarray(cv)
+
+    scores = []
+    for fold in np.unique(folds):
+        test = folds == fold
+        coefs = cg_ridge_path(X[~test], y[~test], w[~test], alphas, penalized=penalized, tol=tol)
+        residuals = y[test][:, None] - X[test] @ coefs.T
+        scores.append(-np.mean(residuals ** 2, axis=0))
+    scores = np.mean(scores, axis=0)
+
+    alpha = alphas[np.argmax(scores)]
+    if len(alphas) > 1 and alpha in (alphas.min(), alphas.max()):
+        warnings.warn(f"Chosen alpha {alpha:g} is at an end of the grid [{alphas.min():g}, {alphas.max():g}]; consider extending it")
+    return {
+        'coef': cg_ridge_path(X, y, w, [alpha], penalized=penalized, tol=tol)[0],
+        'alpha': alpha,
+        'alphas': alphas,
+        'scores': scores,
+    }
+
+
+def ridge_covariance(G: np.ndarray, b: np.ndarray, yWy: float, n: int, alpha: float, penalized=None, covariance: str = 'sandwich', prior: np.ndarray = None) -> dict:
+    """
+    Ridge coefficients and their covariance from the penalized normal equations alone, without the design.
+
+    Parameters
+    ----------
+    G, b, yWy : see `normal_equations`
+    n : int
+        Number of rows of the design.
+    alpha : float
+        Penalty.
+    penalized : bool array-like (p,), optional
+        Coefficients the penalty applies to, e.g. all but the intercept. Default is all.
+    covariance : str, optional
+        - 'sandwich'  : sigma^2 M^-1 G M^-1 with M = G + alpha P and
+                        sigma^2 = RSS / (n - trace(M^-1 G)), the covariance of the ridge estimator.
+        - 'augmented' : sigma^2 M^-1 with sigma^2 = (RSS + alpha |P coef|^2) / n, what OLS on the
+                        weighted design stacked over sqrt(alpha) P gives (statsmodels' bse).
+        Default is 'sandwich'.
+    prior : numpy.ndarray (p,), optional
+        Coefficients the penalty shrinks toward, see `ridge_path`. Default is zero.
+
+    Returns
+    -------
+    result : dict
+        - coef   : numpy.ndarray (p,)
+        - cov    : numpy.ndarray (p, p)
+        - se     : numpy.ndarray (p,), standard errors.
+        - sigma2 : float, residual variance.
+    """
+
+    p = len(b)
+    penalized = np.ones(p, dtype=bool) if penalized is None else np.asarray(penalized, dtype=bool)
+    prior = np.zeros(p) if prior is None else np.where(penalized, prior, 0)
+    M_inv = np.linalg.inv(G + alpha * np.diag(penalized.astype(float)))
+    coef = M_inv @ (b + alpha * prior)
+    rss = yWy - 2 * coef @ b + coef @ G @ coef
+
+    if covariance == 'sandwich':
+        sigma2 = rss / (n - np.trace(M_inv @ G))
+        cov = sigma2 * M_inv @ G @ M_inv
+    elif covariance == 'augmented':
+        sigma2 = (rss + alpha * np.sum((coef - prior)[penalized] ** 2)) / n
+        cov = sigma2 * M_inv
+    else:
+        raise ValueError(f"Unknown covariance {covariance}")
+
+    return {
+        'coef': coef,
+        'cov': cov,
+        'se': np.sqrt(np.diag(cov)),
+        'sigma2': sigma2,
+    }
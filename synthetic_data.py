@@ -0,0 +1,390 @@
+from nba_api.stats.endpoints import GameRotation, LeagueGameLog, PlayByPlayV3
+from api_cache import store_response
+import random
+import json
+
+
+TEAMS = [
+    ('ATL', 'Atlanta', 'Hawks'), ('BOS', 'Boston', 'Celtics'), ('BKN', 'Brooklyn', 'Nets'),
+    ('CHA', 'Charlotte', 'Hornets'), ('CHI', 'Chicago', 'Bulls'), ('CLE', 'Cleveland', 'Cavaliers'),
+    ('DAL', 'Dallas', 'Mavericks'), ('DEN', 'Denver', 'Nuggets'), ('DET', 'Detroit', 'Pistons'),
+    ('GSW', 'Golden State', 'Warriors'), ('HOU', 'Houston', 'Rockets'), ('IND', 'Indiana', 'Pacers'),
+    ('LAC', 'LA', 'Clippers'), ('LAL', 'Los Angeles', 'Lakers'), ('MEM', 'Memphis', 'Grizzlies'),
+    ('MIA', 'Miami', 'Heat'), ('MIL', 'Milwaukee', 'Bucks'), ('MIN', 'Minnesota', 'Timberwolves'),
+    ('NOP', 'New Orleans', 'Pelicans'), ('NYK', 'New York', 'Knicks'), ('OKC', 'Oklahoma City', 'Thunder'),
+    ('ORL', 'Orlando', 'Magic'), ('PHI', 'Philadelphia', '76ers'), ('PHX', 'Phoenix', 'Suns'),
+    ('POR', 'Portland', 'Trail Blazers'), ('SAC', 'Sacramento', 'Kings'), ('SAS', 'San Antonio', 'Spurs'),
+    ('TOR', 'Toronto', 'Raptors'), ('UTA', 'Utah', 'Jazz'), ('WAS', 'Washington', 'Wizards'),
+]
+
+FIRST_NAMES = ['James', 'Chris', 'Anthony', 'Kevin', 'Jalen', 'Marcus', 'Tyrese', 'Devin', 'Jaylen', 'Luka',
+               'Nikola', 'Stephen', 'Damian', 'Jamal', 'Derrick', 'Darius', 'Miles', 'Cam', 'Josh', 'Scottie']
+LAST_NAMES = ['Adams', 'Brooks', 'Carter', 'Davis', 'Edwards', 'Fox', 'Green', 'Harris', 'Irving', 'Johnson',
+              'King', 'Lopez', 'Mitchell', 'Nance', 'Oubre', 'Porter', 'Quickley', 'Reid', 'Smith', 'Thompson',
+              'Udoka', 'Vucevic', 'Walker', 'Young', 'Zubac']
+
+ROSTER_SIZE = 13
+ORDINALS = {1: '1st', 2: '2nd', 3: '3rd', 4: '4th'}
+ROTATION_HEADERS = ['GAME_ID', 'TEAM_ID', 'TEAM_CITY', 'TEAM_NAME', 'PERSON_ID', 'PLAYER_FIRST', 'PLAYER_LAST',
+                    'IN_TIME_REAL', 'OUT_TIME_REAL', 'PLAYER_PTS', 'PT_DIFF', 'USG_PCT']
+GAME_LOG_HEADERS = ['SEASON_ID', 'TEAM_ID', 'TEAM_ABBREVIATION', 'TEAM_NAME', 'GAME_ID', 'GAME_DATE', 'MATCHUP', 'WL',
+                    'MIN', 'PTS', 'PLUS_MINUS', 'VIDEO_AVAILABLE']
+
+
+def make_league(n_seasons: int = 1, first_season: int = 2022, turnover: float = 0.15, seed: int = 0) -> dict:
+    """
+    Creates 30 teams and their rosters for consecutive seasons. Between seasons a fraction
+    `turnover` of each roster is replaced by new players or players traded from other teams.
+
+    Parameters
+    ----------
+    n_seasons : int, optional
+        Number of seasons. Default is 1.
+    first_season : int, optional
+        Starting year of the first season. Default is 2022 (i.e. '2022-23').
+    turnover : float, optional
+        Fraction of roster spots changing between seasons. Default is 0.15.
+    seed : int, optional
+        Random seed. Default is 0.
+
+    Returns
+    -------
+    league : dict
+        'teams' maps team ID to (tricode, city, name), 'players' maps player ID to
+        (first name, last name), and 'rosters' maps season string to {team ID: [player IDs]}.
+    """
+
+    rng = random.Random(seed)
+    teams = {1610612737 + i: team for i, team in enumerate(TEAMS)}
+    players = {}
+
+    def new_player():
+        n = len(players)
+        player_id = 1626000 + n if n % 4 else 201000 + n
+        last = LAST_NAMES[n % len(LAST_NAMES)] + ('' if n < len(LAST_NAMES) else f'-{LAST_NAMES[(n // len(LAST_NAMES)) % len(LAST_NAMES)]}{n // len(LAST_NAMES) ** 2 or ""}')
+        players[player_id] = (rng.choice(FIRST_NAMES), last)
+        return player_id
+
+    rosters = {}
+    current = {team_id: [new_player() for _ in range(ROSTER_SIZE)] for team_id in teams}
+    for k in range(n_seasons):
+        if k > 0:
+            leaving = []
+            for team_id, roster in current.items():
+                rng.shuffle(roster)
+                n_out = round(turnover * ROSTER_SIZE)
+                leaving.extend(roster[:n_out])
+                del roster[:n_out]
+            rng.shuffle(leaving)
+            for team_id, roster in current.items():
+                while len(roster) < ROSTER_SIZE:
+                    roster.append(leaving.pop() if leaving and rng.random() < 0.5 else new_player())
+        year = first_season + k
+        rosters[f'{year}-{(year + 1) % 100:02d}'] = {team_id: list(roster) for team_id, roster in current.items()}
+
+    return {'teams': teams, 'players': players, 'rosters': rosters}
+
+
+def make_schedule(league: dict, season: str, n_games: int = 1230, seed: int = 0) -> list:
+    """
+    Draws `n_games` (game ID, home team ID, away team ID) matchups for a season.
+    """
+
+    rng = random.Random(f'{seed}-{season}-schedule')
+    team_ids = list(league['teams'])
+    schedule = []
+    for n in range(1, n_games + 1):
+        home, away = rng.sample(team_ids, 2)
+        schedule.append((f'002{season[2:4]}{n:05d}', home, away))
+    return schedule
+
+
+def _clock(remaining: int) -> str:
+    return f'PT{remaining // 600:02d}M{(remaining % 600) / 10:05.2f}S'
+
+
+def simulate_game(league: dict, season: str, game_id: str, home: int, away: int, seed: int = 0) -> dict:
+    """
+    Simulates one game and returns its raw PlayByPlayV3 and GameRotation responses (as dicts in
+    the stats.nba.com JSON layout).
+
+    The play-by-play covers made and missed shots, offensive and defensive rebounds, and-ones,
+    shooting fouls with one to three free throws, turnovers, violations, technical fouls,
+    timeouts, substitutions, jump balls and overtime periods.
+    """
+
+    rng = random.Random(f'{seed}-{game_id}')
+    teams = {'h': home, 'v': away}
+    roster = {side: list(league['rosters'][season][team_id]) for side, team_id in teams.items()}
+    players = league['players']
+
+    actions = []
+    score = {'h': 0, 'v': 0}
+    points = {}
+    stints = {}
+    on_court = {}
+    bench = {}
+    state = {'period': 1, 'length': 7200, 'offset': 0, 't': 0}
+
+    for side in ('h', 'v'):
+        rng.shuffle(roster[side])
+        rotation_size = rng.randint(9, ROSTER_SIZE - 1)
+        on_court[side] = roster[side][:5]
+        bench[side] = roster[side][5:rotation_size]
+        for player_id in on_court[side]:
+            stints[player_id] = [[0, None]]
+
+    def add(action_type, sub_type='', side='', player_id=0, description='', scoring=False, shot_result='', shot_value=0):
+        t = state['t']
+        tricode = league['teams'][teams[side]][0] if side else ''
+        first, last = players.get(player_id, ('', ''))
+        actions.append({
+            'actionNumber': len(actions) + 1,
+            'clock': _clock(state['length'] - t),
+            'period': state['period'],
+            'teamId': teams[side] if side else 0,
+            'teamTricode': tricode,
+            'personId': player_id,
+            'playerName': last,
+            'playerNameI': f'{first[:1]}. {last}' if player_id else '',
+            'xLegacy': 0,
+            'yLegacy': 0,
+            'shotDistance': 0,
+            'shotResult': shot_result,
+            'isFieldGoal': int(action_type in ('Made Shot', 'Missed Shot')),
+            'scoreHome': str(score['h']) if scoring else '',
+            'scoreAway': str(score['v']) if scoring else '',
+            'pointsTotal': score['h'] + score['v'] if scoring else 0,
+            'location': side,
+            'description': description or f'{last} {sub_type} {action_type}'.strip(),
+            'actionType': action_type,
+            'subType': sub_type,
+            'videoAvailable': 1,
+            'actionId': len(actions) + 1,
+            'shotValue': shot_value,
+        })
+
+    def other(side):
+        return 'v' if side == 'h' else 'h'
+
+    def substitute(side, n):
+        now = state['offset'] + state['t']
+        for _ in range(n):
+            if not bench[side]:
+                return
+            out_player = rng.choice(on_court[side])
+            in_player = rng.choice(bench[side])
+            on_court[side][on_court[side].index(out_player)] = in_player
+            bench[side][bench[side].index(in_player)] = out_player
+            stints[out_player][-1][1] = now
+            stints.setdefault(in_player, []).append([now, None])
+            add('Substitution', 'out', side, out_player, f'SUB: {players[in_player][1]} FOR {players[out_player][1]}')
+
+    def dead_ball():
+        r = rng.random()
+        if r < 0.25:
+            substitute(rng.choice('hv'), rng.randint(1, 2))
+        elif r < 0.30:
+            add('Timeout', 'Regular', rng.choice('hv'))
+        elif r < 0.31:
+            side = rng.choice('hv')
+            add('Foul', 'Technical', side, rng.choice(on_court[side]))
+            shooter = rng.choice(on_court[other(side)])
+            free_throw(other(side), shooter, 'Free Throw Technical', rng.random() < 0.85)
+
+    def free_throw(side, shooter, sub_type, made):
+        if made:
+            score[side] += 1
+            points[shooter] = points.get(shooter, 0) + 1
+        add('Free Throw', sub_type, side, shooter, scoring=made, shot_result='Made' if made else 'Missed')
+
+    def rebound(offense):
+        # Returns the team in possession after the rebound
+        side = offense if rng.random() < 0.27 else other(offense)
+        add('Rebound', 'offensive' if side == offense else 'defensive', side, rng.choice(on_court[side]))
+        return side
+
+    def possession(offense):
+        """Plays out one possession and returns the team with the ball afterwards."""
+        shooter = rng.choice(on_court[offense])
+        defender = rng.choice(on_court[other(offense)])
+        r = rng.random()
+
+        if r < 0.44:
+            value = 3 if rng.random() < 0.35 else 2
+            score[offense] += value
+            points[shooter] = points.get(shooter, 0) + value
+            add('Made Shot', 'Jump Shot' if value == 3 else 'Layup', offense, shooter, scoring=True, shot_result='Made', shot_value=value)
+            if rng.random() < 0.08:
+                add('Foul', 'Shooting', other(offense), defender)
+                made = rng.random() < 0.75
+                free_throw(offense, shooter, 'Free Throw 1 of 1', made)
+                if not made:
+                    return rebound(offense)
+            dead_ball()
+            return other(offense)
+
+        if r < 0.86:
+            value = 3 if rng.random() < 0.4 else 2
+            add('Missed Shot', 'Jump Shot' if value == 3 else 'Layup', offense, shooter, shot_result='Missed', shot_value=value)
+            return rebound(offense)
+
+        if r < 0.95:
+            add('Turnover', rng.choice(['Bad Pass', 'Lost Ball', 'Traveling']), offense, shooter)
+            if rng.random() < 0.3:
+                dead_ball()
+            return other(offense)
+
+        if r < 0.96:
+            add('Violation', 'Kicked Ball', other(offense), defender)
+            return offense
+
+        if r < 0.97:
+            add('Foul', 'Offensive', offense, shooter)
+            add('Turnover', 'Offensive Foul', offense, shooter)
+            dead_ball()
+            return other(offense)
+
+        n = 3 if rng.random() < 0.1 else 2
+        add('Foul', 'Shooting', other(offense), defender)
+        if rng.random() < 0.2:
+            dead_ball()
+        for k in range(1, n + 1):
+            made = rng.random() < 0.78
+            free_throw(offense, shooter, f'Free Throw {k} of {n}', made)
+        if not made:
+            return rebound(offense)
+        dead_ball()
+        return other(offense)
+
+    tip_winner = None
+    period = 1
+    while True:
+        regular = period <= 4
+        state.update(period=period, length=7200 if regular else 3000, t=0,
+                     offset=(period - 1) * 7200 if regular else 28800 + (period - 5) * 3000)
+        label = f'{ORDINALS[period]} Period' if regular else f'{ORDINALS.get(period - 4, f"{period - 4}th")} OT'
+        add('period', 'start', description=f'Start of {label} (7:10 PM EST)', scoring=period == 1)
+        if period > 1:
+            for side in ('h', 'v'):
+                substitute(side, rng.randint(0, 2))
+
+        if period == 1 or not regular:
+            offense = rng.choice('hv')
+            add('Jump Ball', 'Recovered', offense, rng.choice(on_court[offense]))
+            if tip_winner is None:
+                tip_winner = offense
+        else:
+            offense = other(tip_winner) if period in (2, 3) else tip_winner
+
+        while True:
+            state['t'] += rng.randint(40, 240)
+            if state['t'] >= state['length']:
+                state['t'] = state['length']
+                break
+            offense = possession(offense)
+
+        add('period', 'end', description=f'End of {label} (8:02 PM EST)')
+
+        if period >= 4 and (score['h'] != score['v'] or period >= 7):
+            break
+
+        period += 1
+
+    end_time = state['offset'] + state['t']
+    for player_id, player_stints in stints.items():
+        if player_stints[-1][1] is None:
+            player_stints[-1][1] = end_time
+
+    # A zero-length stint, as the API sometimes reports
+    zero_player = rng.choice(bench['h'] or on_court['h'])
+    stints.setdefault(zero_player, []).append([1200, 1200])
+
+    def rotation_rows(side):
+        team_id = teams[side]
+        tricode, city, name = league['teams'][team_id]
+        rows = []
+        for player_id in roster[side]:
+            for in_time, out_time in stints.get(player_id, []):
+                first, last = players[player_id]
+                rows.append([game_id, team_id, city, name, player_id, first, last, float(in_time), float(out_time),
+                             points.get(player_id, 0), 0, 0.2])
+        return rows
+
+    rotation = {
+        'resource': 'gamerotation',
+        'parameters': {'GameID': game_id, 'LeagueID': '00'},
+        'resultSets': [
+            {'name': 'AwayTeam', 'headers': ROTATION_HEADERS, 'rowSet': rotation_rows('v')},
+            {'name': 'HomeTeam', 'headers': ROTATION_HEADERS, 'rowSet': rotation_rows('h')},
+        ],
+    }
+
+    play_by_play = {
+        'meta': {'version': 1, 'request': f'playbyplayv3?GameID={game_id}'},
+        'game': {'gameId': game_id, 'videoAvailable': 1, 'actions': actions},
+    }
+
+    return {'playbyplayv3': play_by_play, 'gamerotation': rotation, 'score': dict(score), 'periods': period}
+
+
+def write_season(cache_directory: str, league: dict, season: str, n_games: int = 1230, seed: int = 0) -> list:
+    """
+    Simulates a season and stores all of its raw responses (LeagueGameLog and, for every game,
+    GameRotation and PlayByPlayV3) in a raw response cache, so the
+    pipeline can replay it offline.
+
+    Parameters
+    ----------
+    cache_directory : str
+        Root directory of the raw response cache (see api_cache).
+    league : dict
+        League as returned by `make_league`.
+    season : str
+        Season string, e.g. '2022-23'. Must be a key of league['rosters'].
+    n_games : int, optional
+        Number of games. Default is 1230.
+    seed : int, optional
+        Random seed. Default is 0.
+
+    Returns
+    -------
+    game_ids : list of str
+    """
+
+    game_log_rows = []
+    game_ids = []
+    for game_id, home, away in make_schedule(league, season, n_games, seed):
+        game = simulate_game(league, season, game_id, home, away, seed)
+        for endpoint in (GameRotation, PlayByPlayV3):
+            parameters = endpoint(game_id=game_id, get_request=False).parameters
+            store_response(cache_directory, endpoint.endpoint, parameters, json.dumps(game[endpoint.endpoint.lower()]))
+        for side, team_id, opponent in (('h', home, away), ('v', away, home)):
+            margin = game['score'][side] - game['score']['v' if side == 'h' else 'h']
+            tricode, city, name = league['teams'][team_id]
+            matchup = f"{tricode} vs. {league['teams'][opponent][0]}" if side == 'h' else f"{tricode} @ {league['teams'][opponent][0]}"
+            game_log_rows.append([f'2{season[:4]}', team_id, tricode, f'{city} {name}', game_id, f'{season[:4]}-11-01',
+                                  matchup, 'W' if margin > 0 else 'L', 240, game['score'][side], margin, 1])
+        game_ids.append(game_id)
+
+    game_log = {
+        'resource': 'leaguegamelog',
+        'resultSets': [{'name': 'LeagueGameLog', 'headers': GAME_LOG_HEADERS, 'rowSet': game_log_rows}],
+    }
+    parameters = LeagueGameLog(season=season, get_request=False).parameters
+    store_response(cache_directory, LeagueGameLog.endpoint, parameters, json.dumps(game_log))
+
+    return game_ids
+
+
+if __name__ == "__main__":
+    # Writes synthetic seasons into a raw response cache, to replay with aggregate_plus_minus_data.py --offline
+    cache_directory = 'synthetic_cache'
+    n_seasons = 1
+    games_per_season = 1230
+    seed = 0
+
+    league = make_league(n_seasons=n_seasons, seed=seed)
+    for season in league['rosters']:
+        game_ids = write_season(cache_directory, league, season, n_games=games_per_season, seed=seed)
+        print(f"{season}: {len(game_ids)} games written to {cache_directory}")